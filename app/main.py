@@ -138,7 +138,8 @@ def initialize_app():
     FileHandler(app)
     ModelHandler(watcher=model_watcher)
     ImageHandler()
-    CacheHandler()
+    cache_handler = CacheHandler()
+    socket_handler.register("cache_stats", cache_handler.socket_get_stats)
     user_handler.initialize(app, socket_handler)
     # Now that all the other handlers are alive, initialize modules and extensions
     module_handler = ModuleHandler(os.path.join(app_path, "core", "modules"), socket_handler)
@@ -366,4 +367,5 @@ def startup_event():
 
 @app.on_event("shutdown")
 def shutdown_event():
-    model_watcher.stop()
\ No newline at end of file
+    model_watcher.stop()
+    CacheHandler().flush()
\ No newline at end of file
@@ -37,6 +37,8 @@ class InferSettings:
     prompt: str = ""
     prompts = []
     scale: float = 7.5
+    # The scheduler name, empty to use the pipeline's default
+    scheduler: str = ""
     seed: int = -1
     steps: int = 30
     use_control_resolution = True
@@ -1,43 +1,89 @@
-import hashlib
 import logging
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Dict
 
-from core.handlers.cache import CacheHandler
+from core.handlers.catalog import ModelCatalog
+from core.handlers.hashes import HashHandler, get_cached_hash, set_cached_hash, get_cached_directory_hash, \
+    hash_file, hash_directory, quick_hash
+
 logger = logging.getLogger(__name__)
 
-@dataclass
+
+@dataclass(init=False)
 class ModelData:
     name: str
     path: str
     hash: str
+    quick_hash: str = field(default="", compare=False)
     is_url: bool
     loader: any
-    data: Dict
+    # Loader options like the VAE or ControlNets, which don't make it a different model
+    data: Dict = field(compare=False)
     display_name: ""
 
     def __init__(self, model_path, name=None, loader=None):
         self.path = model_path
         self.loader = loader
         self.data = {}
+        self.quick_hash = ""
+        # The hash is only calculated when first accessed
+        self._hash = None
         if not os.path.exists(model_path):
             if "http" not in model_path:
                 raise Exception("File does not exist at the specified path")
             else:
-                self.hash = ""
+                self._hash = ""
                 self.is_url = True
         else:
             self.is_url = False
-            self.get_hash(model_path)
         self.name = name if name else os.path.basename(model_path)
-        self.display_name = self.name + " [" + self.hash[:6] + "]" if self.hash else self.name
+
+    @classmethod
+    def from_catalog(cls, entry: Dict, name=None):
+        """
+        Create a ModelData from a ModelCatalog entry without touching the file.
+        """
+        model_data = cls.__new__(cls)
+        model_data.path = entry["path"]
+        model_data.loader = None
+        model_data.data = {}
+        model_data.is_url = False
+        model_data.quick_hash = entry.get("quick_hash", None) or ""
+        model_data._hash = entry.get("hash", None) or model_data.quick_hash or None
+        model_data.name = name if name else os.path.basename(entry["path"])
+        return model_data
+
+    # The hash and display name are computed lazily, comparing or printing a model must not compute them
+    def __eq__(self, other):
+        if not isinstance(other, ModelData):
+            return NotImplemented
+        return self.path == other.path
+
+    def __repr__(self):
+        return f"ModelData(name={self.name!r}, path={self.path!r}, hash={self._hash!r}, is_url={self.is_url!r})"
+
+    @property
+    def hash(self):
+        if self._hash is None:
+            self.get_hash(self.path)
+        return self._hash
+
+    @hash.setter
+    def hash(self, value):
+        self._hash = value
+
+    @property
+    def display_name(self):
+        # Only include the hash if we already have it, never hash just to build a label
+        return self.name + " [" + self._hash[:6] + "]" if self._hash else self.name
 
     def serialize(self):
         return {
             "name": self.name,
             "path": self.path,
             "hash": self.hash,
+            "quick_hash": self.quick_hash,
             "is_url": self.is_url,
             "loader": self.loader,
             "display_name": self.display_name,
@@ -45,39 +91,51 @@ class ModelData:
         }
 
     def get_hash(self, model_path):
-        cache_handler = CacheHandler()
+        """
+        Set the hash for the model. If the full hash isn't cached and quick hashing is enabled, a quick hash is
+        used and the full hash is calculated in the background by the HashHandler.
+        """
+        hash_handler = HashHandler()
+        existing_hash = self._cached_hash(model_path)
+        if existing_hash is not None:
+            self.hash = existing_hash
+        elif hash_handler.use_quick_hash:
+            self.quick_hash = quick_hash(model_path)
+            self.hash = self.quick_hash
+            hash_handler.submit(model_path, self.quick_hash)
+        elif os.path.isfile(model_path):
+            self.hash = hash_file(model_path)
+            set_cached_hash(model_path, self.hash)
+        else:
+            self.hash = hash_directory(model_path)
+
+    @staticmethod
+    def _cached_hash(model_path):
         if os.path.isfile(model_path):
-            # If model_path is a file, calculate the hash for the file
-            existing_hash = cache_handler.get("model_hash", model_path)
-            if existing_hash is not None:
-                self.hash = existing_hash
-            else:
-                with open(model_path, "rb") as f:
-                    # use sha256 hash algorithm to calculate the hash
-                    hash_obj = hashlib.sha256()
-                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
-                        hash_obj.update(chunk)
-                    self.hash = hash_obj.hexdigest()
-                    cache_handler.set("model_hash", model_path, self.hash)
+            # If model_path is a file, use the cached hash if the file is unchanged
+            return get_cached_hash(model_path)
         elif os.path.isdir(model_path):
-            # If model_path is a directory, calculate the hash for all files in the directory
-            existing_hash = cache_handler.get("directory_hash", model_path)
-            if existing_hash is not None:
-                self.hash = existing_hash
-            else:
-                hash_obj = hashlib.sha256()
-                for dirpath, dirnames, filenames in os.walk(model_path):
-                    for filename in filenames:
-                        filepath = os.path.join(dirpath, filename)
-                        with open(filepath, "rb") as f:
-                            for chunk in iter(lambda: f.read(1024 * 1024), b""):
-                                hash_obj.update(chunk)
-                self.hash = hash_obj.hexdigest()
-                cache_handler.set("directory_hash", model_path, self.hash)
+            return get_cached_directory_hash(model_path)
         else:
             raise ValueError(f"{model_path} is not a valid file or directory.")
 
     def deserialize(self, data: Dict):
         for key, value in data.items():
+            if key in ["hash", "quick_hash", "display_name"]:
+                continue
             if hasattr(self, key):
-                setattr(self, key, value)
\ No newline at end of file
+                setattr(self, key, value)
+        self.is_url = not os.path.exists(self.path)
+        client_hash = data.get("hash", None)
+        if client_hash and not self.is_url:
+            # Only trust a client-supplied hash if the catalog has it for this file, otherwise hash lazily
+            entry = ModelCatalog().get_entry(self.path) or {}
+            if client_hash == entry.get("hash", None):
+                self._hash = client_hash
+            elif client_hash == entry.get("quick_hash", None):
+                self.quick_hash = client_hash
+                self._hash = entry.get("hash", None) or client_hash
+            else:
+                self._hash = None
+        elif self.is_url:
+            self._hash = client_hash or ""
@@ -1,16 +1,288 @@
+import atexit
 import json
 import logging
 import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
 
+from core.handlers.config import ConfigHandler
 from core.handlers.directories import DirectoryHandler
 
 logger = logging.getLogger(__name__)
 
 
+# Suffix of the namespace holding when each entry of a namespace was written
+STORED_AT_SUFFIX = ".stored_at"
+# The longest time between sweeps for expired entries of a namespace with a TTL, they also expire when read
+TTL_SWEEP_INTERVAL = 60.0
+
+
+class JsonCacheBackend:
+    """
+    Stores each cache as a <cache_name>.json file, kept in memory and written back in batches. When each entry
+    was written is kept in <cache_name>.stored_at.json.
+    """
+
+    def __init__(self, cache_dir, write_behind=True, flush_interval=5.0, flush_threshold=500):
+        self.cache_dir = cache_dir
+        self.cache = {}
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        # Names of caches with changes that have not been written to disk yet
+        self._dirty = set()
+        self._pending = 0
+        self._lock = threading.RLock()
+        self._flush_timer = None
+
+    def get(self, cache_name, key, default=None):
+        return self.get_all(cache_name).get(key, default)
+
+    def get_all(self, cache_name):
+        with self._lock:
+            if cache_name not in self.cache:
+                self.cache[cache_name] = self._read_cache_file(cache_name)
+            return self.cache[cache_name]
+
+    def get_entry(self, cache_name, key):
+        """
+        @return: The value and when it was written, (None, None) if there is no entry.
+        """
+        with self._lock:
+            value = self.get_all(cache_name).get(key, None)
+            if value is None:
+                return None, None
+            return value, self.get_all(cache_name + STORED_AT_SUFFIX).get(key, None)
+
+    def get_stored_at(self, cache_name):
+        with self._lock:
+            return dict(self.get_all(cache_name + STORED_AT_SUFFIX))
+
+    def set_stored_at(self, cache_name, stored_at):
+        with self._lock:
+            self.get_all(cache_name + STORED_AT_SUFFIX).update(stored_at)
+            self._mark_dirty(cache_name + STORED_AT_SUFFIX)
+
+    def set(self, cache_name, key, value, stored_at=None):
+        with self._lock:
+            self.get_all(cache_name)[key] = value
+            self.get_all(cache_name + STORED_AT_SUFFIX)[key] = stored_at or time.time()
+            self._mark_dirty(cache_name + STORED_AT_SUFFIX)
+            self._mark_dirty(cache_name)
+
+    def set_all(self, cache_name, cache_data, stored_at=None):
+        with self._lock:
+            self.cache[cache_name] = cache_data
+            now = stored_at or time.time()
+            self.cache[cache_name + STORED_AT_SUFFIX] = {key: now for key in cache_data}
+            self._mark_dirty(cache_name + STORED_AT_SUFFIX)
+            self._mark_dirty(cache_name)
+
+    def delete(self, cache_name, key):
+        with self._lock:
+            if self.get_all(cache_name).pop(key, None) is not None:
+                self.get_all(cache_name + STORED_AT_SUFFIX).pop(key, None)
+                self._mark_dirty(cache_name + STORED_AT_SUFFIX)
+                self._mark_dirty(cache_name)
+
+    def flush(self, cache_name=None):
+        with self._lock:
+            names = [cache_name] if cache_name is not None else list(self._dirty)
+            for name in names:
+                if name not in self._dirty:
+                    continue
+                try:
+                    self._write_cache_file(name, self.cache.get(name, {}))
+                    self._dirty.discard(name)
+                except OSError as e:
+                    logger.warning(f"Error writing cache file: {e}")
+            if not self._dirty:
+                self._pending = 0
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+
+    def _mark_dirty(self, cache_name):
+        self._dirty.add(cache_name)
+        self._pending += 1
+        if not self.write_behind or self._pending >= self.flush_threshold:
+            self.flush()
+        elif self._flush_timer is None or not self._flush_timer.is_alive():
+            timer = threading.Timer(self.flush_interval, self.flush)
+            timer.daemon = True
+            self._flush_timer = timer
+            timer.start()
+
+    def _read_cache_file(self, cache_name):
+        cache_file = os.path.join(self.cache_dir, cache_name + ".json")
+        if os.path.exists(cache_file):
+            with open(cache_file, "r") as f:
+                try:
+                    return json.load(f)
+                except json.JSONDecodeError as e:
+                    logger.warning(f"Error reading cache file: {e}")
+        return {}
+
+    def _write_cache_file(self, cache_name, data):
+        # Write to a temp file in the same directory and swap it in, so a crash mid-write never truncates the cache
+        cache_file = os.path.join(self.cache_dir, cache_name + ".json")
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=f".{cache_name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(temp_path, cache_file)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+class SqliteCacheBackend:
+    """
+    Stores every cache as rows of a single SQLite database in WAL mode, so reads and writes touch one key at a
+    time. Each thread gets its own connection, and SQLite's file locking keeps multiple server processes safe.
+    """
+
+    def __init__(self, cache_dir, db_name="cache.db"):
+        self.cache_dir = cache_dir
+        self.db_path = os.path.join(cache_dir, db_name)
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute("CREATE TABLE IF NOT EXISTS cache (namespace TEXT NOT NULL, key TEXT NOT NULL, "
+                     "value TEXT NOT NULL, stored_at REAL NOT NULL DEFAULT 0, PRIMARY KEY (namespace, key)) "
+                     "WITHOUT ROWID")
+        conn.execute("CREATE TABLE IF NOT EXISTS migrated (namespace TEXT PRIMARY KEY)")
+        self._add_stored_at()
+        self._migrate_json()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, cache_name, key, default=None):
+        row = self._connection().execute("SELECT value FROM cache WHERE namespace = ? AND key = ?",
+                                         (cache_name, key)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def get_all(self, cache_name):
+        rows = self._connection().execute("SELECT key, value FROM cache WHERE namespace = ?", (cache_name,))
+        return {key: json.loads(value) for key, value in rows}
+
+    def get_entry(self, cache_name, key):
+        """
+        @return: The value and when it was written, (None, None) if there is no entry.
+        """
+        row = self._connection().execute("SELECT value, stored_at FROM cache WHERE namespace = ? AND key = ?",
+                                         (cache_name, key)).fetchone()
+        return (json.loads(row[0]), row[1] or None) if row else (None, None)
+
+    def get_stored_at(self, cache_name):
+        rows = self._connection().execute("SELECT key, stored_at FROM cache WHERE namespace = ? AND stored_at > 0",
+                                          (cache_name,))
+        return {key: stored_at for key, stored_at in rows}
+
+    def set_stored_at(self, cache_name, stored_at):
+        self._connection().executemany("UPDATE cache SET stored_at = ? WHERE namespace = ? AND key = ?",
+                                       [(value, cache_name, key) for key, value in stored_at.items()])
+
+    def set(self, cache_name, key, value, stored_at=None):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO cache (namespace, key, value, stored_at) VALUES (?, ?, ?, ?)",
+            (cache_name, key, json.dumps(value), stored_at or time.time()))
+
+    def set_all(self, cache_name, cache_data, stored_at=None):
+        conn = self._connection()
+        now = stored_at or time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM cache WHERE namespace = ?", (cache_name,))
+            conn.executemany("INSERT INTO cache (namespace, key, value, stored_at) VALUES (?, ?, ?, ?)",
+                             [(cache_name, key, json.dumps(value), now) for key, value in cache_data.items()])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def delete(self, cache_name, key):
+        self._connection().execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (cache_name, key))
+
+    def flush(self, cache_name=None):
+        # Every write is committed immediately, nothing to do here.
+        pass
+
+    def _add_stored_at(self):
+        # Databases created before entries had a write time. Their entries count as written now.
+        conn = self._connection()
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(cache)")]
+        if "stored_at" in columns:
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(cache)")]
+            if "stored_at" not in columns:
+                conn.execute("ALTER TABLE cache ADD COLUMN stored_at REAL NOT NULL DEFAULT 0")
+                conn.execute("UPDATE cache SET stored_at = ?", (time.time(),))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _migrate_json(self):
+        # Import caches written by the JSON backend once; the migrated table keeps other processes from repeating it.
+        json_backend = JsonCacheBackend(self.cache_dir)
+        conn = self._connection()
+        for file in os.listdir(self.cache_dir):
+            if not file.endswith(".json") or file.endswith(STORED_AT_SUFFIX + ".json"):
+                continue
+            cache_name = file[:-5]
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if conn.execute("SELECT 1 FROM migrated WHERE namespace = ?", (cache_name,)).fetchone() is None:
+                    data = json_backend.get_all(cache_name)
+                    stored_at = json_backend.get_stored_at(cache_name)
+                    now = time.time()
+                    conn.executemany("INSERT OR IGNORE INTO cache (namespace, key, value, stored_at) "
+                                     "VALUES (?, ?, ?, ?)",
+                                     [(cache_name, key, json.dumps(value), stored_at.get(key, now))
+                                      for key, value in data.items()])
+                    conn.execute("INSERT INTO migrated (namespace) VALUES (?)", (cache_name,))
+                    logger.info(f"Migrated {len(data)} entries from {file} to {self.db_path}")
+                conn.execute("COMMIT")
+            except Exception as e:
+                conn.execute("ROLLBACK")
+                logger.warning(f"Error migrating cache file {file}: {e}")
+
+
+class CachePolicy:
+    """Limits applied to a single cache namespace. A value of 0 disables that limit."""
+
+    def __init__(self, max_entries: int = 0, max_bytes: int = 0, ttl: float = 0):
+        self.max_entries = int(max_entries)
+        self.max_bytes = int(max_bytes)
+        self.ttl = float(ttl)
+
+
 class CacheHandler:
     _instance = None
     cache_dir = ""
-    cache = {}
+    backend = None
+    policies = {}
+    stats = {}
+    # Per-namespace LRU order of keys for namespaces with a policy, mapping key -> (size, stored_at)
+    _entries = {}
+    # Per-namespace total size of the entries in _entries
+    _bytes = {}
+    # Per-namespace time of the last sweep for expired entries
+    _swept = {}
+    _lock = threading.RLock()
 
     def __new__(cls):
         if cls._instance is None:
@@ -21,49 +293,195 @@ class CacheHandler:
             if cache_dir:
                 if not os.path.exists(cache_dir):
                     os.makedirs(cache_dir)
+            ch = ConfigHandler()
+            backend = ch.get_item_protected("backend", "cache", "sqlite")
+            if backend == "sqlite":
+                cls._instance.backend = SqliteCacheBackend(cache_dir)
+            else:
+                cls._instance.backend = JsonCacheBackend(
+                    cache_dir,
+                    write_behind=ch.get_item_protected("write_behind", "cache", True),
+                    flush_interval=float(ch.get_item_protected("flush_interval", "cache", 5.0)),
+                    flush_threshold=int(ch.get_item_protected("flush_threshold", "cache", 500))
+                )
+            policies = ch.get_item_protected("policies", "cache", {})
+            for cache_name, policy in policies.items():
+                cls._instance.set_policy(cache_name, CachePolicy(**policy))
+            atexit.register(cls._instance.flush)
         return cls._instance
 
+    def set_policy(self, cache_name, policy: CachePolicy):
+        with self._lock:
+            self.policies[cache_name] = policy
+            self._entries.pop(cache_name, None)
+            self._swept.pop(cache_name, None)
+        self._enforce(cache_name)
+
     def get(self, cache_name, key=None, default=None):
-        if cache_name in self.cache:
-            if key is None:
-                return self.cache[cache_name]
-            else:
-                return self.cache[cache_name].get(key, default)
+        # The lock only guards the statistics and the LRU index, the backends are thread-safe
+        start = time.perf_counter()
+        if key is None:
+            # Reading the whole namespace is linear anyway, so don't return anything expired
+            self._enforce(cache_name, evict=False, sweep=True)
+            value = self.backend.get_all(cache_name)
+            with self._lock:
+                self._stats(cache_name)["load_time"] += time.perf_counter() - start
+            return value
+        policy = self.policies.get(cache_name)
+        if policy is None:
+            value, stored_at = self.backend.get(cache_name, key, None), None
         else:
-            cache_file = os.path.join(self.cache_dir, cache_name + ".json")
-            if os.path.exists(cache_file):
-                with open(cache_file, "r") as f:
-                    try:
-                        self.cache[cache_name] = json.load(f)
-                        if key is None:
-                            return self.cache[cache_name]
-                        else:
-                            return self.cache[cache_name].get(key, default)
-                    except json.JSONDecodeError as e:
-                        logger.warning(f"Error reading cache file: {e}")
-                        self.cache[cache_name] = {}
+            value, stored_at = self.backend.get_entry(cache_name, key)
+        now = time.time()
+        expired = False
+        with self._lock:
+            stats = self._stats(cache_name)
+            stats["load_time"] += time.perf_counter() - start
+            if value is not None and policy is not None:
+                entries = self._entries.get(cache_name, None)
+                if policy.ttl and stored_at and now - stored_at > policy.ttl:
+                    expired = True
+                    self._untrack(cache_name, key)
+                    stats["expired"] += 1
+                    value = None
+                elif entries is not None:
+                    if key in entries:
+                        entries.move_to_end(key)
+                    else:
+                        # Written by another process
+                        self._track(cache_name, key, self._size(value, policy), stored_at or now)
+            if value is None:
+                stats["misses"] += 1
             else:
-                self.cache[cache_name] = {}
-        return default
+                stats["hits"] += 1
+        if expired:
+            self.backend.delete(cache_name, key)
+        return default if value is None else value
 
     def set(self, cache_name, key=None, value=None, cache_data=None):
-        cache_file = os.path.join(self.cache_dir, cache_name + ".json")
+        now = time.time()
         if cache_data:
-            with open(cache_file, "w") as f:
-                json.dump(cache_data, f)
+            self.backend.set_all(cache_name, cache_data, stored_at=now)
+            with self._lock:
+                self._entries.pop(cache_name, None)
         elif key and value:
-            if cache_name in self.cache:
-                self.cache[cache_name][key] = value
-            else:
-                if os.path.exists(cache_file):
-                    with open(cache_file, "r") as f:
-                        try:
-                            self.cache[cache_name] = json.load(f)
-                        except json.JSONDecodeError as e:
-                            logger.warning(f"Error reading cache file: {e}")
-                            self.cache[cache_name] = {}
-                else:
-                    self.cache[cache_name] = {}
-                self.cache[cache_name][key] = value
-            with open(cache_file, "w") as f:
-                json.dump(self.cache[cache_name], f)
+            self.backend.set(cache_name, key, value, stored_at=now)
+            policy = self.policies.get(cache_name)
+            if policy is not None:
+                with self._lock:
+                    if cache_name in self._entries:
+                        self._track(cache_name, key, self._size(value, policy), now)
+        else:
+            return
+        self._enforce(cache_name)
+
+    def delete(self, cache_name, key):
+        self.backend.delete(cache_name, key)
+        with self._lock:
+            self._untrack(cache_name, key)
+
+    def flush(self, cache_name=None):
+        """
+        Write pending cache changes to disk.
+
+        @param cache_name: Only flush this cache. If None, all dirty caches are written.
+        """
+        self.backend.flush(cache_name)
+
+    def get_stats(self, cache_name=None):
+        with self._lock:
+            output = {}
+            names = [cache_name] if cache_name is not None else list(self.stats.keys())
+            for name in names:
+                stats = self._stats(name).copy()
+                if name in self._entries:
+                    stats["entries"] = len(self._entries[name])
+                    stats["bytes"] = self._bytes.get(name, 0)
+                output[name] = stats
+            return output
+
+    async def socket_get_stats(self, msg):
+        data = msg.get("data", {}) or {}
+        return {"stats": self.get_stats(data.get("cache_name", None))}
+
+    def _stats(self, cache_name):
+        if cache_name not in self.stats:
+            self.stats[cache_name] = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "load_time": 0.0}
+        return self.stats[cache_name]
+
+    def _index(self, cache_name):
+        """
+        Build the LRU index of a namespace with a policy from the backend, oldest writes first.
+        """
+        with self._lock:
+            if cache_name in self._entries:
+                return
+        start = time.perf_counter()
+        policy = self.policies[cache_name]
+        data = self.backend.get_all(cache_name)
+        stored_at = self.backend.get_stored_at(cache_name)
+        now = time.time()
+        missing = {key: now for key in data if key not in stored_at}
+        if missing:
+            # Entries from before write times were stored, their time to live starts now
+            self.backend.set_stored_at(cache_name, missing)
+            stored_at.update(missing)
+        entries = OrderedDict(sorted([(key, (self._size(value, policy), stored_at[key])) for key, value in data.items()],
+                                     key=lambda item: item[1][1]))
+        with self._lock:
+            if cache_name not in self._entries:
+                self._entries[cache_name] = entries
+                self._bytes[cache_name] = sum(size for size, _ in entries.values())
+            self._stats(cache_name)["load_time"] += time.perf_counter() - start
+
+    def _track(self, cache_name, key, size: int, stored_at: float):
+        # Add or replace an entry of the LRU index, as the most recently used. Called with the lock held.
+        entries = self._entries[cache_name]
+        previous = entries.pop(key, None)
+        total = self._bytes.get(cache_name, 0) - (previous[0] if previous is not None else 0)
+        entries[key] = (size, stored_at)
+        self._bytes[cache_name] = total + size
+
+    def _untrack(self, cache_name, key):
+        # Remove an entry from the LRU index, if the namespace is indexed. Called with the lock held.
+        entries = self._entries.get(cache_name, None)
+        if entries is not None and key in entries:
+            size, _ = entries.pop(key)
+            self._bytes[cache_name] = self._bytes.get(cache_name, 0) - size
+
+    @staticmethod
+    def _size(value, policy: CachePolicy):
+        # Only serialize to measure when a byte limit is actually configured
+        return len(json.dumps(value)) if policy.max_bytes else 0
+
+    def _enforce(self, cache_name, evict=True, sweep=False):
+        """
+        With evict, remove the least recently used entries over the limits of the policy. Expired entries are
+        swept at most every TTL_SWEEP_INTERVAL seconds, or right away with sweep, so a write doesn't scan the
+        whole namespace, entries that are read are expired by get() instead.
+        """
+        policy = self.policies.get(cache_name)
+        if policy is None or not (policy.ttl or evict):
+            return
+        self._index(cache_name)
+        removed = []
+        now = time.time()
+        with self._lock:
+            entries = self._entries.get(cache_name, OrderedDict())
+            stats = self._stats(cache_name)
+            if policy.ttl and (sweep or now - self._swept.get(cache_name, 0) >= min(policy.ttl, TTL_SWEEP_INTERVAL)):
+                self._swept[cache_name] = now
+                cutoff = now - policy.ttl
+                for key in [key for key, (_, stored_at) in entries.items() if stored_at < cutoff]:
+                    self._untrack(cache_name, key)
+                    removed.append(key)
+                    stats["expired"] += 1
+            if evict:
+                while entries and ((policy.max_entries and len(entries) > policy.max_entries) or
+                                   (policy.max_bytes and self._bytes.get(cache_name, 0) > policy.max_bytes)):
+                    key, _ = next(iter(entries.items()))
+                    self._untrack(cache_name, key)
+                    removed.append(key)
+                    stats["evictions"] += 1
+        for key in removed:
+            self.backend.delete(cache_name, key)
@@ -0,0 +1,245 @@
+import json
+import logging
+import os
+import struct
+import threading
+import time
+from typing import Dict, List
+
+from core.handlers.cache import CacheHandler
+from core.handlers.hashes import HashHandler, get_cached_hash, get_cached_directory_hash, quick_hash
+
+logger = logging.getLogger(__name__)
+
+# Model types stored as diffusers directories (containing a model_index.json) instead of single files
+DIRECTORY_TYPES = ["diffusers", "dreambooth"]
+
+
+def get_arch(model_path: str):
+    """
+    Read architecture info without loading weights: the pipeline class of a diffusers directory, or the
+    architecture recorded in a safetensors header.
+    """
+    try:
+        if os.path.isdir(model_path):
+            with open(os.path.join(model_path, "model_index.json"), "r") as f:
+                return json.load(f).get("_class_name", None)
+        if model_path.endswith(".safetensors"):
+            with open(model_path, "rb") as f:
+                header_size = struct.unpack("<Q", f.read(8))[0]
+                if header_size > 16 * 1024 * 1024:
+                    return None
+                metadata = json.loads(f.read(header_size)).get("__metadata__", {}) or {}
+            for key in ["modelspec.architecture", "ss_base_model_version", "ss_network_module"]:
+                if key in metadata:
+                    return metadata[key]
+    except Exception as e:
+        logger.debug(f"Unable to read arch for {model_path}: {e}")
+    return None
+
+
+class ModelCatalog:
+    """
+    A persistent index of every model file/directory under the model roots. It is loaded from the cache at
+    startup and updated incrementally with a single pruned scandir pass per root and model type, so listing
+    models never walks the disk or hashes anything.
+    """
+    _instance = None
+    entries = {}
+    # (root, model_type) -> {path: entry}
+    _index = {}
+    _scanned = set()
+    _lock = threading.RLock()
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(ModelCatalog, cls).__new__(cls)
+            HashHandler().register_callback(cls._instance._on_hash)
+            cls._instance._load()
+        return cls._instance
+
+    def _load(self):
+        start = time.perf_counter()
+        for path, entry in CacheHandler().get("model_catalog").items():
+            self._add(entry)
+            # The app stopped before the full hash was calculated
+            self._resubmit(entry)
+        logger.debug(f"Loaded {len(self.entries)} catalog entries in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    @staticmethod
+    def _resubmit(entry: Dict):
+        if entry.get("hash", None) is None and entry.get("quick_hash", None):
+            HashHandler().submit(entry["path"], entry["quick_hash"])
+
+    def get_entries(self, model_type: str, roots: List[str], refresh: bool = False) -> List[Dict]:
+        """
+        Get the catalog entries for a model type under the given model roots.
+
+        @param model_type: The model type, which is also the directory name under each root.
+        @param roots: The model directories to search.
+        @param refresh: Rescan the directories even if they have already been scanned.
+        """
+        for root in roots:
+            if refresh or (root, model_type) not in self._scanned:
+                self.scan(root, model_type)
+        with self._lock:
+            output = []
+            for root in roots:
+                output.extend(self._index.get((root, model_type), {}).values())
+            return output
+
+    def get_entry(self, path: str):
+        return self.entries.get(path, None)
+
+    def scan(self, root: str, model_type: str):
+        start = time.perf_counter()
+        model_dir = os.path.join(root, model_type)
+        if not os.path.exists(model_dir):
+            os.makedirs(model_dir)
+        found = {}
+        self._walk(model_dir, model_type in DIRECTORY_TYPES, found)
+        with self._lock:
+            existing = dict(self._index.get((root, model_type), {}))
+        for path in [path for path in existing if path not in found]:
+            self.remove(path)
+        changed = 0
+        for path, (is_dir, size, mtime_ns) in found.items():
+            entry = existing.get(path, None)
+            if entry is not None and entry["size"] == size and entry["mtime_ns"] == mtime_ns:
+                self._resubmit(entry)
+                continue
+            # Hashing happens outside the lock, update() only holds it to store the entry
+            self.update(path, model_type, root, is_dir, size, mtime_ns)
+            changed += 1
+        with self._lock:
+            self._scanned.add((root, model_type))
+        logger.debug(f"Scanned {model_dir}: {len(found)} models, {changed} changed in "
+                     f"{(time.perf_counter() - start) * 1000:.1f}ms")
+
+    def _walk(self, directory: str, model_dirs: bool, found: Dict):
+        try:
+            with os.scandir(directory) as it:
+                items = list(it)
+        except OSError:
+            return
+        if model_dirs:
+            index_file = next((item for item in items if item.name == "model_index.json"), None)
+            if index_file is not None:
+                # A diffusers model, don't look any deeper
+                stat = index_file.stat()
+                found[directory] = (True, stat.st_size, max(stat.st_mtime_ns, os.stat(directory).st_mtime_ns))
+                return
+        for item in items:
+            try:
+                if item.is_dir():
+                    self._walk(item.path, model_dirs, found)
+                elif not model_dirs and item.is_file():
+                    # is_file follows symlinks, so broken links are skipped
+                    stat = item.stat()
+                    found[item.path] = (False, stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                continue
+
+    def apply_changes(self, root: str, model_type: str, paths: List[str]) -> Dict:
+        """
+        Update the catalog for a batch of changed paths under root/model_type, e.g. from file system events.
+
+        @return: A dict with the "added", "updated" and "removed" model paths.
+        """
+        with self._lock:
+            known = dict(self._index.get((root, model_type), {}))
+            before = {path: (entry["size"], entry["mtime_ns"]) for path, entry in known.items()}
+        if model_type in DIRECTORY_TYPES:
+            # Picks up added and removed model directories, then re-checks models with changed files inside
+            self.scan(root, model_type)
+            type_dir = os.path.join(root, model_type)
+            touched = set()
+            for path in paths:
+                model_dir = self._find_model_dir(path, type_dir)
+                if model_dir is not None and model_dir in self.entries:
+                    touched.add(model_dir)
+            for model_dir in touched:
+                entry = self.entries.get(model_dir, None)
+                if entry is not None:
+                    self.update(model_dir, model_type, root, True, entry["size"], entry["mtime_ns"])
+        else:
+            touched = set()
+            for path in paths:
+                if os.path.isfile(path):
+                    stat = os.stat(path)
+                    entry = self.entries.get(path, None)
+                    if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+                        self.update(path, model_type, root, False, stat.st_size, stat.st_mtime_ns)
+                        touched.add(path)
+                elif os.path.isdir(path):
+                    self.scan(root, model_type)
+                else:
+                    # Deleted or moved away, along with anything below it if it was a directory
+                    for known_path in [p for p in list(known) if p == path or p.startswith(path + os.path.sep)]:
+                        self.remove(known_path)
+        with self._lock:
+            after = dict(self._index.get((root, model_type), {}))
+        return {
+            "added": [path for path in after if path not in before],
+            "updated": [path for path in after if path in before and
+                        (before[path] != (after[path]["size"], after[path]["mtime_ns"]) or path in touched)],
+            "removed": [path for path in before if path not in after]
+        }
+
+    @staticmethod
+    def _find_model_dir(path: str, type_dir: str):
+        current = path if os.path.isdir(path) else os.path.dirname(path)
+        while current.startswith(type_dir) and current != type_dir:
+            if os.path.exists(os.path.join(current, "model_index.json")):
+                return current
+            current = os.path.dirname(current)
+        return None
+
+    def update(self, path: str, model_type: str, root: str, is_dir: bool, size: int, mtime_ns: int):
+        """
+        Add or replace the entry for a model, reusing a cached full hash if there is one, otherwise taking a
+        quick hash and queueing the full hash.
+        """
+        hash_handler = HashHandler()
+        full_hash = get_cached_directory_hash(path) if is_dir else get_cached_hash(path)
+        model_quick_hash = None
+        if full_hash is None and hash_handler.use_quick_hash:
+            model_quick_hash = quick_hash(path)
+            hash_handler.submit(path, model_quick_hash)
+        entry = {
+            "path": path,
+            "type": model_type,
+            "root": root,
+            "is_dir": is_dir,
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "quick_hash": model_quick_hash,
+            "hash": full_hash,
+            "arch": get_arch(path)
+        }
+        with self._lock:
+            self._add(entry)
+            CacheHandler().set("model_catalog", path, entry)
+        return entry
+
+    def remove(self, path: str):
+        with self._lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                self._index.get((entry["root"], entry["type"]), {}).pop(path, None)
+                CacheHandler().delete("model_catalog", path)
+        return entry
+
+    def _add(self, entry: Dict):
+        self.entries[entry["path"]] = entry
+        key = (entry["root"], entry["type"])
+        if key not in self._index:
+            self._index[key] = {}
+        self._index[key][entry["path"]] = entry
+
+    def _on_hash(self, model_path: str, model_quick_hash: str, full_hash: str):
+        with self._lock:
+            entry = self.entries.get(model_path, None)
+            if entry is not None:
+                entry["hash"] = full_hash
+                CacheHandler().set("model_catalog", model_path, entry)
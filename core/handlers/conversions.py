@@ -0,0 +1,182 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional
+
+from core.handlers.cache import CacheHandler
+from core.handlers.hashes import cached_file_hash, file_identity
+
+logger = logging.getLogger(__name__)
+
+# Written last by save_pretrained, so a directory that has it is a complete model
+MODEL_INDEX = "model_index.json"
+
+
+def conversion_key(source_hash: str, params: Dict) -> str:
+    """
+    The key a conversion is stored under: the content hash of the source file and every parameter that changes
+    the output.
+    """
+    identity = {"source": source_hash, "params": params}
+    return hashlib.sha256(json.dumps(identity, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _link_tree(source: str, dest: str):
+    """
+    Recreate a directory by hard linking its files, copying them where hard links aren't possible, like across
+    file systems.
+    """
+    for dirpath, dirnames, filenames in os.walk(source):
+        target_dir = os.path.join(dest, os.path.relpath(dirpath, source))
+        os.makedirs(target_dir, exist_ok=True)
+        for filename in filenames:
+            target = os.path.join(target_dir, filename)
+            try:
+                os.link(os.path.join(dirpath, filename), target)
+            except OSError:
+                shutil.copy2(os.path.join(dirpath, filename), target)
+
+
+class ConversionCache:
+    """
+    Keeps track of checkpoints that were converted to diffusers, by the content hash of the checkpoint and the
+    conversion parameters, so converting the same file again is skipped even when it was renamed or copied to
+    another user's models. The existing output is linked to the new destination instead.
+
+    Conversions of the same file with the same parameters that are requested while one is running wait for it
+    and use its result.
+    """
+    _instance = None
+    _lock = threading.Lock()
+    # key -> future of the output path
+    _in_flight = {}
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(ConversionCache, cls).__new__(cls)
+            cls._instance._in_flight = {}
+        return cls._instance
+
+    def convert(self, source_path: str, dest_path: str, params: Dict, converter: Callable[[str], None]) \
+            -> Optional[str]:
+        """
+        Convert a checkpoint, unless it was already converted with the same parameters.
+
+        A model that is already at dest_path is only reused if it was recorded as a conversion of this checkpoint,
+        one that isn't, e.g. of a different checkpoint that had the same name, is replaced.
+
+        @param source_path: The checkpoint file.
+        @param dest_path: Where the converted model should be.
+        @param params: The conversion parameters that change the output, e.g. EMA, image size and prediction type.
+        @param converter: Called with a directory to write the converted model to.
+        @return: Where the converted model is, usually dest_path, or None if the conversion failed.
+        """
+        key = conversion_key(cached_file_hash(source_path), params)
+        with self._lock:
+            future = self._in_flight.get(key, None)
+            running = future is not None
+            if not running:
+                future = Future()
+                self._in_flight[key] = future
+        if running:
+            logger.info(f"Waiting for the conversion of {source_path} in progress.")
+            output = future.result()
+            return self._place(key, output, dest_path) if output else None
+
+        output = None
+        try:
+            output = self.get(key, prefer=dest_path)
+            if output is None:
+                logger.info(f"Converting {source_path} to diffusers.")
+                if self._convert_to(dest_path, converter):
+                    output = dest_path
+                    self._record(key, dest_path)
+                else:
+                    logger.warning(f"Conversion of {source_path} didn't produce a model.")
+            else:
+                logger.info(f"{source_path} was already converted: {output}")
+            return self._place(key, output, dest_path) if output else None
+        finally:
+            future.set_result(output)
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def get(self, key: str, prefer: str = None) -> Optional[str]:
+        """
+        Get a converted model that is still unchanged on disk.
+
+        @param key: The conversion key.
+        @param prefer: The output to return if it is one of them, e.g. the destination of a new conversion.
+        """
+        outputs = CacheHandler().get("conversions", key, {}) or {}
+        valid = []
+        for path, identity in list(outputs.items()):
+            try:
+                if file_identity(os.path.join(path, MODEL_INDEX)) == identity:
+                    valid.append(path)
+            except OSError:
+                pass
+        if prefer is not None and prefer in valid:
+            return prefer
+        return valid[0] if valid else None
+
+    @staticmethod
+    def _convert_to(dest_path: str, converter: Callable[[str], None]) -> bool:
+        """
+        Convert next to dest_path and then move the result there, so an unrelated model at dest_path is only
+        replaced by a complete conversion.
+        """
+        temp_path = f"{dest_path}.converting"
+        shutil.rmtree(temp_path, ignore_errors=True)
+        try:
+            converter(temp_path)
+            if not os.path.isfile(os.path.join(temp_path, MODEL_INDEX)):
+                return False
+            if os.path.exists(dest_path):
+                logger.info(f"Replacing {dest_path}, it isn't a known conversion of this checkpoint.")
+                old_path = f"{dest_path}.old"
+                shutil.rmtree(old_path, ignore_errors=True)
+                os.replace(dest_path, old_path)
+                os.replace(temp_path, dest_path)
+                shutil.rmtree(old_path, ignore_errors=True)
+            else:
+                os.replace(temp_path, dest_path)
+            return True
+        finally:
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+    def _record(self, key: str, path: str):
+        cache_handler = CacheHandler()
+        outputs = dict(cache_handler.get("conversions", key, {}) or {})
+        # Drop outputs that were deleted or overwritten since
+        for output, identity in list(outputs.items()):
+            try:
+                if file_identity(os.path.join(output, MODEL_INDEX)) != identity:
+                    outputs.pop(output)
+            except OSError:
+                outputs.pop(output)
+        outputs[path] = file_identity(os.path.join(path, MODEL_INDEX))
+        cache_handler.set("conversions", key, outputs)
+
+    def _place(self, key: str, output: str, dest_path: str) -> Optional[str]:
+        if os.path.abspath(output) == os.path.abspath(dest_path):
+            return dest_path
+        if os.path.exists(dest_path):
+            # Something else by that name, leave it alone
+            logger.warning(f"{dest_path} already exists, using the existing conversion: {output}")
+            return output
+        temp_path = f"{dest_path}.linking"
+        try:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            _link_tree(output, temp_path)
+            os.replace(temp_path, dest_path)
+        except OSError as e:
+            logger.warning(f"Unable to link {output} to {dest_path}: {e}")
+            shutil.rmtree(temp_path, ignore_errors=True)
+            return None
+        self._record(key, dest_path)
+        return dest_path
@@ -0,0 +1,188 @@
+import logging
+import os
+import threading
+from typing import Dict, List
+
+from core.handlers.config import ConfigHandler
+from core.handlers.directories import DirectoryHandler
+from core.handlers.hashes import cached_file_hash, get_cached_hash, set_cached_hash
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 ** 2
+# From linux/fs.h
+FICLONE = 0x40049409
+# Model types whose files are rewritten in place, e.g. by training, which would change every hard link
+SKIP_TYPES = ["dreambooth"]
+
+
+def model_roots() -> List[str]:
+    """
+    The shared models directory and the models directory of every user.
+    """
+    dir_handler = DirectoryHandler()
+    roots = [os.path.join(dir_handler.shared_path, "models")]
+    users_dir = os.path.join(dir_handler.protected_path, "users")
+    try:
+        for user in sorted(os.listdir(users_dir)):
+            roots.append(os.path.join(users_dir, user, "models"))
+    except OSError:
+        pass
+    return [root for root in roots if os.path.isdir(root)]
+
+
+def _reflink(source: str, dest: str):
+    try:
+        import fcntl
+    except ImportError:
+        # Windows
+        raise OSError("Reflinks aren't supported on this platform")
+    with open(source, "rb") as src, open(dest, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    stat = os.stat(source)
+    os.utime(dest, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+class ModelDeduplicator:
+    """
+    Finds byte-identical model files across the shared and user model directories, using the hashes in the
+    model hash cache, and replaces the copies with links to one file. Besides the disk space, this means users
+    loading their own copy of the same model share the page cache.
+
+    Hard links are used by default. With dedupe_method set to "reflink", copy-on-write clones are made instead,
+    on file systems that support them, so a copy can still be changed without affecting the others. Where reflinks
+    aren't supported, e.g. on Windows, hard links are used.
+    """
+    _instance = None
+    _lock = threading.Lock()
+    method = "hardlink"
+    min_size = 0
+    last_report = {}
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(ModelDeduplicator, cls).__new__(cls)
+            ch = ConfigHandler()
+            cls._instance.method = ch.get_item_protected("dedupe_method", "models", "hardlink")
+            cls._instance.min_size = int(float(ch.get_item_protected("dedupe_min_mb", "models", 16)) * MB)
+            cls._instance.last_report = {}
+        return cls._instance
+
+    def find_duplicates(self, roots: List[str] = None) -> List[List[str]]:
+        """
+        Group the model files with the same content. Only files that have the same size as another file are
+        hashed, and hashes already in the cache are reused.
+
+        @return: Groups of paths of identical files on the same device, with more than one inode each.
+        """
+        by_size = {}
+        for root in roots or model_roots():
+            for path in self._files(root):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if stat.st_size >= self.min_size:
+                    by_size.setdefault((stat.st_dev, stat.st_size), []).append(path)
+
+        groups = []
+        for (device, size), paths in by_size.items():
+            if len(set([os.stat(path).st_ino for path in paths])) < 2:
+                continue
+            by_hash = {}
+            for path in paths:
+                try:
+                    by_hash.setdefault(cached_file_hash(path), []).append(path)
+                except OSError as e:
+                    logger.debug(f"Unable to hash {path}: {e}")
+            groups.extend([group for group in by_hash.values()
+                           if len(set([os.stat(path).st_ino for path in group])) > 1])
+        return groups
+
+    def deduplicate(self, roots: List[str] = None, dry_run: bool = False) -> Dict:
+        """
+        Replace identical model files with links to one of them.
+
+        @param roots: The model directories to search, all of them by default.
+        @param dry_run: Only report what would be reclaimed.
+        @return: The number of files linked, the bytes reclaimed, and the duplicate groups found.
+        """
+        if not self._lock.acquire(blocking=False):
+            return {"running": True, **self.last_report}
+        try:
+            report = {"groups": 0, "linked": 0, "reclaimed": 0, "errors": 0, "dry_run": dry_run}
+            for group in self.find_duplicates(roots):
+                report["groups"] += 1
+                # Keep the file with the most links, so every copy ends up on one inode
+                group.sort(key=lambda path: (-os.stat(path).st_nlink, path))
+                source = group[0]
+                source_hash = get_cached_hash(source)
+                source_inode = os.stat(source).st_ino
+                if source_hash is None:
+                    continue
+                for path in group[1:]:
+                    try:
+                        stat = os.stat(path)
+                        if stat.st_ino == source_inode:
+                            continue
+                        # Skip files that changed since they were hashed
+                        if get_cached_hash(path) != source_hash:
+                            continue
+                        # Space is only freed when the last link to the copy goes
+                        freed = stat.st_size if stat.st_nlink == 1 else 0
+                        if not dry_run:
+                            self._link(source, path)
+                            set_cached_hash(path, source_hash)
+                        report["linked"] += 1
+                        report["reclaimed"] += freed
+                    except OSError as e:
+                        report["errors"] += 1
+                        logger.warning(f"Unable to deduplicate {path}: {e}")
+            logger.info(f"Model deduplication {'(dry run) ' if dry_run else ''}linked {report['linked']} files in "
+                        f"{report['groups']} groups, reclaimed {report['reclaimed'] / MB:.0f}MB")
+            self.last_report = report
+            return report
+        finally:
+            self._lock.release()
+
+    def _link(self, source: str, path: str):
+        # Link to a temporary name first, so the copy is replaced in one step and never missing
+        temp_path = f"{path}.dedupe"
+        try:
+            linked = False
+            if self.method == "reflink":
+                try:
+                    _reflink(source, temp_path)
+                    linked = True
+                except OSError as e:
+                    logger.debug(f"Unable to reflink {path}, hard linking it instead: {e}")
+                    self._remove(temp_path)
+            if not linked:
+                os.link(source, temp_path)
+            os.replace(temp_path, path)
+        except OSError:
+            self._remove(temp_path)
+            raise
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _files(root: str) -> List[str]:
+        files = []
+        try:
+            model_types = [entry.name for entry in os.scandir(root) if entry.is_dir()]
+        except OSError:
+            return files
+        for model_type in model_types:
+            # Hidden directories hold partial downloads and the like
+            if model_type.startswith(".") or model_type in SKIP_TYPES:
+                continue
+            for dirpath, dirnames, filenames in os.walk(os.path.join(root, model_type)):
+                dirnames[:] = [name for name in dirnames if not name.startswith(".")]
+                files.extend([os.path.join(dirpath, name) for name in filenames if not name.startswith(".")])
+        return files
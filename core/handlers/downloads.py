@@ -0,0 +1,267 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from typing import Callable, Dict, List, Optional
+
+import requests
+
+from core.handlers.config import ConfigHandler
+from core.handlers.hashes import hash_file, set_cached_hash
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 ** 2
+CHUNK_SIZE = MB
+PART_EXTENSION = ".part"
+# How often the download state is written, so an interrupted download resumes close to where it stopped
+STATE_INTERVAL = 2.0
+PROGRESS_INTERVAL = 0.5
+RETRIES = 3
+TIMEOUT = 30
+
+
+def _probe(url: str) -> Dict:
+    """
+    Find the final URL, size and version of a file, and whether the server supports range requests.
+    """
+    with requests.get(url, headers={"Range": "bytes=0-0"}, stream=True, allow_redirects=True,
+                      timeout=TIMEOUT) as response:
+        response.raise_for_status()
+        size = None
+        ranges = False
+        content_range = response.headers.get("Content-Range", "")
+        match = re.match(r"bytes 0-0/(\d+)", content_range)
+        if response.status_code == 206 and match:
+            size = int(match.group(1))
+            ranges = True
+        elif "Content-Length" in response.headers:
+            size = int(response.headers["Content-Length"])
+        return {
+            "url": response.url,
+            "size": size,
+            "ranges": ranges,
+            "validator": response.headers.get("ETag", None) or response.headers.get("Last-Modified", None)
+        }
+
+
+def _split(size: int, segments: int, min_segment: int) -> List[List[int]]:
+    # [start, end (inclusive), bytes done]
+    count = max(1, min(segments, size // max(min_segment, 1)))
+    step = -(-size // count)
+    return [[start, min(start + step, size) - 1, 0] for start in range(0, size, step)]
+
+
+class DownloadManager:
+    """
+    Downloads model files with several range requests per file, writing each segment to its place in a partial
+    file. The segments already written are saved next to it, so a download that was interrupted resumes where it
+    stopped, unless the file changed on the server.
+
+    Finished files are checked against their sha256, if it's known, and moved into place in one step, so model
+    handlers never see a partial file. The number of downloads running at once is limited for the whole app.
+    """
+    _instance = None
+    _lock = threading.Lock()
+    # partial file -> [lock, number of requests using it], so a file is only downloaded once at a time
+    _active = {}
+    slot = None
+    segments = 4
+    min_segment = 0
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(DownloadManager, cls).__new__(cls)
+            ch = ConfigHandler()
+            cls._instance.segments = max(1, int(ch.get_item_protected("download_segments", "models", 4)))
+            cls._instance.min_segment = int(float(ch.get_item_protected("download_segment_min_mb", "models", 16)) * MB)
+            max_downloads = max(1, int(ch.get_item_protected("max_downloads", "models", 2)))
+            cls._instance.slot = threading.BoundedSemaphore(max_downloads)
+            cls._instance._active = {}
+        return cls._instance
+
+    async def download_async(self, url: str, dest_path: str, staging_dir: str = None, sha256: str = None,
+                             progress: Callable[[int, int], None] = None) -> Optional[str]:
+        return await asyncio.to_thread(self.download, url, dest_path, staging_dir, sha256, progress)
+
+    def download(self, url: str, dest_path: str, staging_dir: str = None, sha256: str = None,
+                 progress: Callable[[int, int], None] = None) -> Optional[str]:
+        """
+        Download a file.
+
+        @param url: The URL to download.
+        @param dest_path: Where the finished file goes.
+        @param staging_dir: Where the partial file is kept. Must be on the same file system as dest_path, and
+        shouldn't be watched for models. Defaults to the directory of dest_path.
+        @param sha256: The expected sha256 of the file, if known.
+        @param progress: Called with the bytes downloaded and the total size (0 if unknown).
+        @return: dest_path, or None if the download failed.
+        """
+        staging_dir = staging_dir or os.path.dirname(dest_path)
+        os.makedirs(staging_dir, exist_ok=True)
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        name = hashlib.sha1(f"{url}\0{os.path.abspath(dest_path)}".encode()).hexdigest()[:16]
+        part_path = os.path.join(staging_dir, name + PART_EXTENSION)
+        with self._lock:
+            active = self._active.setdefault(part_path, [threading.Lock(), 0])
+            active[1] += 1
+        file_lock = active[0]
+        waited = not file_lock.acquire(blocking=False)
+        if waited:
+            file_lock.acquire()
+        try:
+            if waited and os.path.isfile(dest_path):
+                # Downloaded by the request we waited for
+                return dest_path
+            with self.slot:
+                if not self._download(url, part_path, progress):
+                    return None
+                if sha256:
+                    digest = hash_file(part_path)
+                    if digest.lower() != sha256.lower():
+                        logger.warning(f"Checksum mismatch for {url}: expected {sha256}, got {digest}")
+                        self._discard(part_path)
+                        return None
+                os.replace(part_path, dest_path)
+                self._remove(part_path + ".json")
+                if sha256:
+                    set_cached_hash(dest_path, sha256.lower())
+                logger.info(f"Downloaded {url} to {dest_path}")
+                return dest_path
+        except Exception as e:
+            logger.warning(f"Download of {url} failed: {e}")
+            if not os.path.isfile(part_path + ".json"):
+                # Nothing to resume from
+                self._remove(part_path)
+            return None
+        finally:
+            file_lock.release()
+            with self._lock:
+                active[1] -= 1
+                if not active[1]:
+                    # Nobody is waiting for this file anymore
+                    del self._active[part_path]
+
+    def _download(self, url: str, part_path: str, progress: Callable = None) -> bool:
+        info = _probe(url)
+        state_path = part_path + ".json"
+        state = self._read_state(state_path)
+        resumable = info["ranges"] and bool(info["size"])
+        if resumable and state and os.path.isfile(part_path) and state.get("url") == url and \
+                state.get("size") == info["size"] and state.get("validator") == info["validator"]:
+            segments = state["segments"]
+            logger.debug(f"Resuming download of {url}: {sum([s[2] for s in segments])} / {info['size']} bytes")
+        else:
+            if resumable:
+                segments = _split(info["size"], self.segments, self.min_segment)
+            else:
+                # One stream from the start, the size may be unknown
+                segments = [[0, info["size"] - 1 if info["size"] else None, 0]]
+            with open(part_path, "wb") as f:
+                if info["size"]:
+                    f.truncate(info["size"])
+        state = {"url": url, "size": info["size"], "validator": info["validator"], "segments": segments}
+        total = info["size"] or 0
+        cancel = threading.Event()
+        pending = [segment for segment in segments if segment[1] is None or segment[2] < segment[1] - segment[0] + 1]
+        with ThreadPoolExecutor(max_workers=max(1, len(pending))) as pool:
+            futures = [pool.submit(self._fetch, info["url"], part_path, segment, resumable, cancel)
+                       for segment in pending]
+            last_state = time.monotonic()
+            while True:
+                done, not_done = wait(futures, timeout=PROGRESS_INTERVAL, return_when=FIRST_EXCEPTION)
+                if progress is not None:
+                    progress(sum([segment[2] for segment in segments]), total)
+                failed = [future for future in done if future.exception() is not None]
+                if failed:
+                    cancel.set()
+                    wait(futures)
+                    if resumable:
+                        self._write_state(part_path, state_path, state)
+                    raise failed[0].exception()
+                if not not_done:
+                    break
+                if resumable and time.monotonic() - last_state >= STATE_INTERVAL:
+                    self._write_state(part_path, state_path, state)
+                    last_state = time.monotonic()
+        downloaded = sum([segment[2] for segment in segments])
+        if info["size"] is not None and downloaded != info["size"]:
+            logger.warning(f"Incomplete download of {url}: {downloaded} / {info['size']} bytes")
+            return False
+        self._sync(part_path)
+        return True
+
+    @staticmethod
+    def _fetch(url: str, part_path: str, segment: List, ranges: bool, cancel: threading.Event):
+        start, end, _ = segment
+        for attempt in range(RETRIES):
+            headers = {}
+            if ranges:
+                headers["Range"] = f"bytes={start + segment[2]}-{end}"
+            elif segment[2]:
+                # Can't continue without range support
+                segment[2] = 0
+            try:
+                with requests.get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+                    response.raise_for_status()
+                    if ranges and response.status_code != 206:
+                        raise IOError(f"Range request returned status {response.status_code}")
+                    # Unbuffered, so what the state says was written is always in the file
+                    with open(part_path, "r+b", buffering=0) as f:
+                        f.seek(start + segment[2])
+                        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                            if cancel.is_set():
+                                return
+                            if end is not None:
+                                chunk = chunk[:end - start + 1 - segment[2]]
+                            view = memoryview(chunk)
+                            while len(view):
+                                written = f.write(view)
+                                view = view[written:]
+                                segment[2] += written
+                if end is None or segment[2] >= end - start + 1:
+                    return
+                raise IOError("Connection closed early")
+            except (requests.RequestException, IOError) as e:
+                if attempt == RETRIES - 1 or cancel.is_set():
+                    raise
+                logger.debug(f"Retrying download segment {start}-{end}: {e}")
+                time.sleep(1 + attempt)
+
+    @staticmethod
+    def _read_state(state_path: str) -> Optional[Dict]:
+        try:
+            with open(state_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_state(self, part_path: str, state_path: str, state: Dict):
+        # The data has to be on disk before the state says it is
+        self._sync(part_path)
+        temp_path = state_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(temp_path, state_path)
+
+    @staticmethod
+    def _sync(path: str):
+        # Windows can only fsync files open for writing
+        with open(path, "r+b") as f:
+            os.fsync(f.fileno())
+
+    def _discard(self, part_path: str):
+        self._remove(part_path)
+        self._remove(part_path + ".json")
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
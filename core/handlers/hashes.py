@@ -0,0 +1,305 @@
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from typing import Dict, List
+
+from core.handlers.cache import CacheHandler
+from core.handlers.config import ConfigHandler
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_COUNT = 8
+MAX_HEADER_SIZE = 16 * 1024 * 1024
+HASH_WORKERS = min(8, os.cpu_count() or 1)
+
+_buffers = threading.local()
+
+
+def file_identity(file_path: str) -> Dict:
+    """
+    Get the metadata used to tell whether a file has changed since it was hashed.
+    """
+    stat = os.stat(file_path)
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "inode": stat.st_ino,
+        "device": stat.st_dev
+    }
+
+
+def _identity_key(identity: Dict) -> str:
+    return f"{identity['device']}:{identity['inode']}:{identity['size']}:{identity['mtime_ns']}"
+
+
+def model_identity(model_path: str) -> str:
+    """
+    Identify the weights of a model by its path and the device, inode, size and modification time of its file, or
+    of every file in its directory. Unlike the model hash it is known immediately and doesn't change once the full
+    hash is calculated, so it can key things that must stay the same for the life of the file.
+
+    @return: The identity, or the path itself if it isn't a local file or directory, e.g. a URL.
+    """
+    path = os.path.realpath(model_path)
+    try:
+        if not os.path.isdir(path):
+            return f"{path}|{_identity_key(file_identity(path))}"
+        parts = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                filepath = os.path.join(dirpath, filename)
+                parts.append(f"{os.path.relpath(filepath, path)}={_identity_key(file_identity(filepath))}")
+        return f"{path}|{hashlib.sha256(';'.join(parts).encode()).hexdigest()}"
+    except OSError:
+        return model_path
+
+
+def get_cached_hash(file_path: str):
+    """
+    Look up the cached hash for a file, validated against its size, mtime and inode.
+
+    Entries for a path whose file was replaced are dropped. If the path is unknown, a hash stored for the same
+    inode (e.g. before the file was renamed or moved) is reused and recorded under the new path.
+    """
+    cache_handler = CacheHandler()
+    identity = file_identity(file_path)
+    cached = cache_handler.get("model_hash", file_path)
+    if isinstance(cached, dict):
+        if all(cached.get(key) == value for key, value in identity.items()):
+            return cached["hash"]
+        cache_handler.delete("model_identity", _identity_key(cached))
+    if cached is not None:
+        # Replaced file, or a legacy entry without identity info
+        cache_handler.delete("model_hash", file_path)
+
+    existing_hash = cache_handler.get("model_identity", _identity_key(identity))
+    if existing_hash is not None:
+        cache_handler.set("model_hash", file_path, {"hash": existing_hash, **identity})
+    return existing_hash
+
+
+def set_cached_hash(file_path: str, file_hash: str):
+    cache_handler = CacheHandler()
+    identity = file_identity(file_path)
+    cache_handler.set("model_hash", file_path, {"hash": file_hash, **identity})
+    cache_handler.set("model_identity", _identity_key(identity), file_hash)
+
+
+def _read_into(hash_obj, file_path: str, throttle: float = 0):
+    # Reuse one buffer per thread; hashlib releases the GIL on large updates, so threads hash in parallel
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None:
+        buffer = _buffers.buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    start = time.monotonic()
+    read = 0
+    with open(file_path, "rb", buffering=0) as f:
+        while True:
+            size = f.readinto(view)
+            if not size:
+                break
+            hash_obj.update(view[:size])
+            if throttle:
+                read += size
+                ahead = read / throttle - (time.monotonic() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+def hash_file(file_path: str, throttle: float = 0) -> str:
+    """
+    Calculate the sha256 of a file.
+
+    @param file_path: The file to hash.
+    @param throttle: Maximum read rate in bytes per second, 0 for unlimited.
+    """
+    hash_obj = hashlib.sha256()
+    _read_into(hash_obj, file_path, throttle)
+    return hash_obj.hexdigest()
+
+
+def cached_file_hash(file_path: str, throttle: float = 0) -> str:
+    """
+    Get the sha256 of a file, hashing it only if it changed since it was last hashed.
+    """
+    file_hash = get_cached_hash(file_path)
+    if file_hash is None:
+        file_hash = hash_file(file_path, throttle)
+        set_cached_hash(file_path, file_hash)
+    return file_hash
+
+
+def _list_files(model_path: str) -> List[str]:
+    files = []
+    for dirpath, dirnames, filenames in os.walk(model_path):
+        for filename in filenames:
+            files.append(os.path.relpath(os.path.join(dirpath, filename), model_path).replace(os.path.sep, "/"))
+    return sorted(files)
+
+
+def _directory_identity(model_path: str, files: List[str]) -> Dict:
+    identity = {}
+    for file in files:
+        stat = os.stat(os.path.join(model_path, file))
+        identity[file] = [stat.st_size, stat.st_mtime_ns]
+    return identity
+
+
+def get_cached_directory_hash(model_path: str):
+    """
+    Look up the cached hash for a directory, valid as long as no file was added, removed or modified.
+    """
+    cached = CacheHandler().get("directory_hash", model_path)
+    if isinstance(cached, dict):
+        if cached.get("files") == _directory_identity(model_path, _list_files(model_path)):
+            return cached["hash"]
+    return None
+
+
+def hash_directory(model_path: str, throttle: float = 0) -> str:
+    """
+    Calculate a Merkle-style hash for a directory: every file is hashed on its own in a thread pool, with the
+    per-file digests cached, and the directory hash is the sha256 of the sorted relative paths and digests.
+    Only files that changed since they were last hashed are read again.
+
+    @param model_path: The directory to hash.
+    @param throttle: Maximum total read rate in bytes per second, 0 for unlimited.
+    """
+    files = _list_files(model_path)
+    workers = max(1, min(len(files), HASH_WORKERS))
+    file_throttle = throttle / workers if throttle else 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        digests = list(pool.map(lambda file: cached_file_hash(os.path.join(model_path, file), file_throttle), files))
+    hash_obj = hashlib.sha256()
+    for file, digest in zip(files, digests):
+        hash_obj.update(f"{file}\0{digest}\n".encode())
+    directory_hash = hash_obj.hexdigest()
+    CacheHandler().set("directory_hash", model_path,
+                       {"hash": directory_hash, "files": _directory_identity(model_path, files)})
+    return directory_hash
+
+
+def _update_quick_hash(hash_obj, file_path: str):
+    size = os.path.getsize(file_path)
+    hash_obj.update(str(size).encode())
+    with open(file_path, "rb") as f:
+        if file_path.endswith(".safetensors") and size > 8:
+            # The safetensors header lists every tensor name, dtype, shape and offset
+            header_size = struct.unpack("<Q", f.read(8))[0]
+            if header_size <= min(size - 8, MAX_HEADER_SIZE):
+                hash_obj.update(f.read(header_size))
+        if size <= SAMPLE_SIZE * SAMPLE_COUNT:
+            f.seek(0)
+            hash_obj.update(f.read())
+        else:
+            step = (size - SAMPLE_SIZE) // (SAMPLE_COUNT - 1)
+            for i in range(SAMPLE_COUNT):
+                f.seek(i * step)
+                hash_obj.update(f.read(SAMPLE_SIZE))
+
+
+def quick_hash(model_path: str) -> str:
+    """
+    Calculate a cheap identity hash from the size, safetensors header and a few sampled blocks of a file,
+    or of every file in a directory. Used until the full hash is available.
+    """
+    hash_obj = hashlib.sha256()
+    if os.path.isdir(model_path):
+        for dirpath, dirnames, filenames in os.walk(model_path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                filepath = os.path.join(dirpath, filename)
+                hash_obj.update(os.path.relpath(filepath, model_path).encode())
+                _update_quick_hash(hash_obj, filepath)
+    else:
+        _update_quick_hash(hash_obj, model_path)
+    return hash_obj.hexdigest()
+
+
+class HashHandler:
+    """
+    Calculates full model hashes on a background thread, storing them in the CacheHandler and notifying
+    clients when the hash for a model they were given a quick hash for is ready.
+    """
+    _instance = None
+    _queue = None
+    _pending = set()
+    _callbacks = []
+    _lock = threading.Lock()
+    use_quick_hash = True
+    throttle = 0
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(HashHandler, cls).__new__(cls)
+            ch = ConfigHandler()
+            cls._instance.use_quick_hash = ch.get_item_protected("quick_hash", "models", True)
+            cls._instance.throttle = float(ch.get_item_protected("hash_throttle_mb", "models", 0)) * 1024 * 1024
+            cls._instance._queue = Queue()
+            worker = threading.Thread(target=cls._instance._run, daemon=True)
+            worker.start()
+        return cls._instance
+
+    def submit(self, model_path: str, model_quick_hash: str):
+        with self._lock:
+            if model_path in self._pending:
+                return
+            self._pending.add(model_path)
+        self._queue.put((model_path, model_quick_hash))
+
+    def register_callback(self, callback):
+        """
+        Register a method called with (model_path, quick_hash, full_hash) whenever a full hash is calculated.
+        """
+        if callback not in self._callbacks:
+            self._callbacks.append(callback)
+
+    def _run(self):
+        while True:
+            model_path, model_quick_hash = self._queue.get()
+            try:
+                if os.path.isdir(model_path):
+                    full_hash = hash_directory(model_path, self.throttle)
+                else:
+                    full_hash = hash_file(model_path, self.throttle)
+                    set_cached_hash(model_path, full_hash)
+                logger.debug(f"Hashed {model_path}: {full_hash}")
+            except Exception as e:
+                logger.warning(f"Unable to hash {model_path}: {e}")
+                full_hash = None
+            finally:
+                with self._lock:
+                    self._pending.discard(model_path)
+            if full_hash is not None:
+                for callback in self._callbacks:
+                    try:
+                        callback(model_path, model_quick_hash, full_hash)
+                    except Exception as e:
+                        logger.warning(f"Exception in hash callback: {e}")
+                try:
+                    self._notify({"name": "model_hash", "path": model_path, "quick_hash": model_quick_hash,
+                                  "hash": full_hash})
+                except Exception as e:
+                    logger.debug(f"Unable to send model hash: {e}")
+            self._queue.task_done()
+
+    @staticmethod
+    def _notify(message: Dict):
+        from core.handlers.websocket import SocketHandler
+        socket_handler = SocketHandler()
+        if socket_handler is None or socket_handler.queue is None:
+            return
+        if socket_handler.manager.user_auth:
+            # Broadcasts without a user are dropped when auth is enabled, so address every session
+            for user in list(socket_handler.manager.sessions.keys()):
+                socket_handler.queue.put_nowait({**message, "user": user})
+        else:
+            socket_handler.queue.put_nowait(message)
@@ -224,7 +224,7 @@ class ImageHandler:
             for k, v in prompt_data.__dict__.items():
                 try:
                     if k == "model":
-                        v = v.__dict__
+                        v = v.serialize()
                     val = json.dumps(v)
                     pnginfo_data.add_text(k, val)
                 except TypeError:
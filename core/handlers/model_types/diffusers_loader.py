@@ -1,30 +1,51 @@
 import importlib
 import inspect
+import json
 import logging
 import os.path
 import sys
 import traceback
 
+from typing import Dict
+
+import diffusers
 import tomesd
 import torch
-from diffusers import DiffusionPipeline, UniPCMultistepScheduler, ControlNetModel, \
-    AutoencoderKL, StableDiffusionPipeline
+from diffusers import DiffusionPipeline, ControlNetModel, AutoencoderKL, StableDiffusionPipeline
 from diffusers.models.attention_processor import AttnProcessor2_0
-from safetensors.torch import load_file
 
 from core.dataclasses.model_data import ModelData
+from core.handlers.catalog import get_arch
+from core.handlers.config import ConfigHandler
+from core.handlers.hashes import model_identity
+from core.handlers.model_types.lazy_safetensors import load_component_lazy, measure_load
+from core.handlers.model_types.lora_weights import LORA_COMPONENTS, LoraManager
+from core.handlers.model_types.schedulers import DEFAULT_SCHEDULER, get_scheduler
+from core.handlers.models import report_load_progress
+from core.handlers.residency import ComponentCache, ModelResidency, residency_key
+from core.handlers.snapshots import PipelineSnapshots, snapshot_key
 from core.handlers.model_types.controlnet_processors import model_data as controlnet_data
 
 logger = logging.getLogger(__name__)
 
 
-def initialize_pipeline(pipeline, loras, weight: float = 0.9):
-    try:
-        pipeline.unet.set_attn_processor(AttnProcessor2_0())
-        if os.name != "nt":
-            pipeline.unet = torch.compile(pipeline.unet)
-    except:
-        logger.debug("Unable to set attention processor.")
+def initialize_pipeline(pipeline, loras, weight: float = 0.9, reused: bool = False):
+    """
+    Set up a newly created pipeline.
+
+    @param pipeline: The pipeline.
+    @param loras: LoRAs to merge into the weights.
+    @param weight: The LoRA weight.
+    @param reused: The pipeline was built from the components of a pipeline that was already initialized, so
+    the UNet is already compiled and the LoRAs are already applied.
+    """
+    if not reused:
+        try:
+            pipeline.unet.set_attn_processor(AttnProcessor2_0())
+            if os.name != "nt":
+                pipeline.unet = torch.compile(pipeline.unet)
+        except:
+            logger.debug("Unable to set attention processor.")
 
     try:
         pipeline.enable_xformers_memory_efficient_attention()
@@ -36,20 +57,25 @@ def initialize_pipeline(pipeline, loras, weight: float = 0.9):
             tomesd.apply_patch(pipeline, ratio=0.5)
         except:
             logger.debug("Unable to apply tomesd patch.")
-        # If our pipeline inherits from StableDiffusionPipeline, we need to set the scheduler to UniPCMultistepScheduler
+        # The default scheduler, inference requests can pick their own with with_scheduler
         try:
-            logger.debug("Setting scheduler to UniPCMultistepScheduler.")
-            pipeline.scheduler = UniPCMultistepScheduler.from_config(pipeline.scheduler.config)
-            pipeline.scheduler.config["solver_type"] = "bh2"
+            logger.debug(f"Setting scheduler to {DEFAULT_SCHEDULER}.")
+            pipeline.scheduler = get_scheduler(DEFAULT_SCHEDULER, pipeline.scheduler.config)
         except:
             logger.debug("Unable to initialize scheduler.")
 
-    if len(loras):
-        for lora in loras:
-            if "path" in lora:
-                pipeline = apply_lora(pipeline, lora['path'], weight)
-                logger.debug(f"Loading lora: {lora['name']}")
-    return pipeline.to("cuda")
+    report_load_progress("Moving pipeline to GPU")
+    pipeline = pipeline.to("cuda")
+    # LoRAs are merged on the GPU
+    if len(loras) and not reused:
+        lora_manager = LoraManager()
+        paths = [lora["path"] for lora in loras if "path" in lora]
+        for i, lora in enumerate([lora for lora in loras if "path" in lora]):
+            report_load_progress(f"Applying LoRA: {lora.get('name', lora['path'])}", i, len(paths))
+            lora_manager.get(pipeline, lora["path"])
+            logger.debug(f"Loading lora: {lora.get('name', lora['path'])}")
+        pipeline = lora_manager.set_loras(pipeline, [(path, weight) for path in paths])
+    return pipeline
 
 
 def initialize_controlnets(model_data):
@@ -60,11 +86,14 @@ def initialize_controlnets(model_data):
     controlnet_type = model_data.data["controlnet_type"]
     if isinstance(controlnet_type, str):
         controlnet_type = [controlnet_type]
-    for controlnet_name in controlnet_type:
+    for i, controlnet_name in enumerate(controlnet_type):
+        report_load_progress(f"Loading ControlNet: {controlnet_name}", i, len(controlnet_type))
         for md in controlnet_data:
             if md["name"] == controlnet_name:
                 controlnet_url = md["model_url"]
-                controlnet = ControlNetModel.from_pretrained(controlnet_url, torch_dtype=torch.float16)
+                controlnet = ComponentCache().get(
+                    "controlnet", controlnet_url,
+                    lambda: ControlNetModel.from_pretrained(controlnet_url, torch_dtype=torch.float16))
                 nets.append(controlnet)
     return nets
 
@@ -85,29 +114,190 @@ def load_diffusers(model_data: ModelData):
             }
             if "Onnx" in pipeline_cls:
                 pipe_args["export"] = True
+            components = ComponentCache()
+            default_vae = f"{model_identity(model_path)}/default"
             if "vae" in model_data.data:
-                pipe_args["vae"] = AutoencoderKL.from_pretrained(
-                    model_data.data["vae"],
-                    torch_dtype=torch.float16
-                )
+                vae_path = model_data.data["vae"]
+                pipe_args["vae"] = components.get(
+                    "vae", vae_path, lambda: AutoencoderKL.from_pretrained(vae_path, torch_dtype=torch.float16))
+            elif components.get("vae", default_vae) is not None:
+                # Switching back from a custom VAE
+                pipe_args["vae"] = components.get("vae", default_vae)
             if len(nets):
                 pipe_args["controlnet"] = nets
+            if "Onnx" not in pipeline_cls:
+                pipeline = pipeline_from_resident(model_data, model_path, pipeline_cls, pipe_args)
+                if pipeline is None:
+                    pipeline = pipeline_with_loras(model_data)
+            if pipeline is not None:
+                return initialize_pipeline(pipeline, loras=[], reused=True)
             logger.debug(f"Loading pipeline: {pipeline_cls} from {model_path}")
+            own_vae = "vae" not in pipe_args
+            loras = model_data.data.get("loras", [])
+            # Components that are loaded separately and never modified, so they aren't part of a snapshot
+            overrides = [name for name in pipe_args if name != "torch_dtype"]
+            snapshots = PipelineSnapshots()
+            key = snapshot_key(model_data, pipe_args["torch_dtype"]) if len(loras) and "Onnx" not in pipeline_cls \
+                else ""
+            restored = {}
+            if key:
+                with measure_load("pipeline snapshot") as stats:
+                    restored = snapshots.load(key, pipe_args["torch_dtype"])
+                    stats["loaded"] = len(restored) > 0
+                restored = {name: module for name, module in restored.items() if name not in pipe_args}
+                pipe_args.update(restored)
+            if "Onnx" not in pipeline_cls:
+                pipe_args.update(load_components(model_path, pipe_args))
             # Instantiate pipeline using pipeline_cls string
             if pipeline_cls == "DiffusionPipeline" or pipeline_cls is None or pipeline_cls == "auto":
                 src_pipe = DiffusionPipeline.from_pretrained(model_path, **pipe_args)
             else:
                 pipe_obj = get_pipeline_cls(pipeline_cls)
                 src_pipe = pipe_obj.from_pretrained(model_path, **pipe_args)
+            if own_vae and getattr(src_pipe, "vae", None) is not None:
+                components.put("vae", default_vae, src_pipe.vae)
 
-            pipeline = initialize_pipeline(src_pipe, loras=model_data.data.get("loras", []),
+            # LoRAs are already fused into restored modules
+            pipeline = initialize_pipeline(src_pipe, loras=[] if len(restored) else loras,
                                            weight=model_data.data.get("lora_weight", 0.9))
+            if key and not len(restored):
+                snapshots.save(key, pipeline, exclude=overrides)
         except Exception as e:
             logger.warning(f"Exception loading pipeline: {e}")
             traceback.print_exc()
     return pipeline
 
 
+def load_components(model_path: str, pipe_args: Dict) -> Dict:
+    """
+    Load the components listed in a diffusers model_index.json one at a time, reporting progress for each, so
+    they can be passed to from_pretrained. Components already in pipe_args are skipped.
+
+    With lazy_safetensors enabled, models with safetensors weights are memory-mapped instead of read into memory.
+
+    @return: The loaded components, or an empty dict if they couldn't be loaded, so from_pretrained loads them.
+    """
+    lazy = ConfigHandler().get_item_protected("lazy_safetensors", "models", True)
+    try:
+        with open(os.path.join(model_path, "model_index.json"), "r") as f:
+            model_index = json.load(f)
+        names = [name for name, value in model_index.items() if not name.startswith("_") and
+                 isinstance(value, list) and len(value) == 2 and value[0] is not None and name not in pipe_args]
+        components = {}
+        for i, name in enumerate(names):
+            report_load_progress(f"Loading {name}", i, len(names))
+            library_name, class_name = model_index[name]
+            if library_name in ["diffusers", "transformers"]:
+                library = importlib.import_module(library_name)
+            else:
+                library = importlib.import_module(f"diffusers.pipelines.{library_name}")
+            component_cls = getattr(library, class_name)
+            component_args = {"subfolder": name}
+            is_module = issubclass(component_cls, torch.nn.Module)
+            if is_module and "torch_dtype" in pipe_args:
+                component_args["torch_dtype"] = pipe_args["torch_dtype"]
+            component = None
+            if is_module and lazy:
+                with measure_load(f"{name} (memory-mapped)") as stats:
+                    component = load_component_lazy(component_cls, model_path, name,
+                                                    pipe_args.get("torch_dtype", None))
+                    stats["loaded"] = component is not None
+            if component is None and is_module:
+                with measure_load(name):
+                    component = component_cls.from_pretrained(model_path, **component_args)
+            elif component is None:
+                component = component_cls.from_pretrained(model_path, **component_args)
+            components[name] = component
+        report_load_progress("Building pipeline", len(names), len(names))
+        return components
+    except Exception as e:
+        logger.debug(f"Unable to load components separately, loading the whole pipeline: {e}")
+        return {}
+
+
+def pipeline_from_resident(model_data: ModelData, model_path: str, pipeline_cls: str, overrides: Dict):
+    """
+    Build a pipeline from the components of a resident pipeline for the same model and LoRAs, instead of
+    loading it from disk again. Only components in overrides, like ControlNets, are new.
+
+    @return: The pipeline, or None if there is no resident pipeline to build it from.
+    """
+    key = residency_key("diffusers", model_data)
+    # Without a VAE to attach, the base must still have the model's own VAE
+    base = ModelResidency().find(lambda k: k.model_type == key.model_type and k.identity == key.identity and
+                                 k.loras == key.loras and ("vae" in overrides or k.vae is None))
+    if base is None:
+        return None
+    if pipeline_cls is None or pipeline_cls in ["DiffusionPipeline", "auto"]:
+        class_name = get_arch(model_path)
+        pipe_obj = getattr(diffusers, class_name, None) if class_name else None
+    else:
+        pipe_obj = get_pipeline_cls(pipeline_cls)
+    if pipe_obj is None:
+        return None
+
+    components = {k: v for k, v in base.components.items() if k != "controlnet"}
+    components.update({k: v for k, v in overrides.items() if k != "torch_dtype"})
+    pipe_kwargs = {}
+    for name, param in inspect.signature(pipe_obj.__init__).parameters.items():
+        if name == "self" or param.kind in [param.VAR_POSITIONAL, param.VAR_KEYWORD]:
+            continue
+        if name in components:
+            pipe_kwargs[name] = components[name]
+        elif name in base.config:
+            pipe_kwargs[name] = base.config[name]
+        elif param.default is param.empty:
+            logger.debug(f"Can't build {pipe_obj.__name__} from resident components, missing {name}.")
+            return None
+    # Schedulers keep per-run state, so never share one between pipelines
+    if pipe_kwargs.get("scheduler", None) is not None:
+        scheduler = pipe_kwargs["scheduler"]
+        pipe_kwargs["scheduler"] = scheduler.__class__.from_config(scheduler.config)
+    logger.debug(f"Building {pipe_obj.__name__} from resident components.")
+    try:
+        return pipe_obj(**pipe_kwargs)
+    except Exception as e:
+        logger.debug(f"Unable to build {pipe_obj.__name__} from resident components: {e}")
+        return None
+
+
+def pipeline_with_loras(model_data: ModelData):
+    """
+    Take a resident pipeline of the same model that only differs in its LoRAs or their weight, and switch its LoRAs
+    in place instead of loading the model again.
+
+    @return: The pipeline, or None if there is no resident pipeline that can be changed.
+    """
+    residency = ModelResidency()
+    lora_manager = LoraManager()
+    key = residency_key("diffusers", model_data)
+    candidates = []
+    for k in residency.keys(key.model_type):
+        if k.identity != key.identity or k.pipeline != key.pipeline or k.vae != key.vae or \
+                k.controlnets != key.controlnets or k.loras == key.loras:
+            continue
+        # LoRAs restored from a snapshot are part of the weights, they can't be taken out
+        if not k.loras or len(lora_manager.applied(residency.get(k))):
+            candidates.append(k)
+    if not candidates:
+        return None
+    pipeline = residency.detach(lambda k: k in candidates, components=LORA_COMPONENTS)
+    if pipeline is None:
+        return None
+    weight = model_data.data.get("lora_weight", 0.9)
+    loras = [(lora["path"], weight) for lora in model_data.data.get("loras", []) or [] if "path" in lora]
+    logger.debug(f"Switching the LoRAs of a resident pipeline to {len(loras)} LoRAs.")
+    try:
+        report_load_progress("Applying LoRAs")
+        if torch.cuda.is_available():
+            # LoRAs are merged on the GPU
+            pipeline = pipeline.to("cuda")
+        return lora_manager.set_loras(pipeline, loras)
+    except Exception as e:
+        logger.warning(f"Unable to switch LoRAs: {e}")
+        return None
+
+
 def get_pipeline_cls(class_name):
     subclasses_params = get_pipeline_parameters()
 
@@ -214,82 +404,5 @@ def get_pipeline_parameters(ignore_keys=None):
     return subclasses_params
 
 
-def apply_lora(pipeline, checkpoint_path, alpha=0.75):
-    lora_prefix_unet = "lora_unet"
-    lora_prefix_text_encoder = "lora_te"
-    # load LoRA weight from .safetensors
-    state_dict = load_file(checkpoint_path)
-
-    visited = []
-    errors = 0
-    total = 0
-    bad_keys = []
-    # directly update weight in diffusers model
-    for key in state_dict:
-        try:
-            if ".alpha" in key or key in visited:
-                continue
-            total += 1
-
-            if "text" in key:
-                layer_infos = key.split(".")[0].split(lora_prefix_text_encoder + "_")[-1].split("_")
-                curr_layer = pipeline.text_encoder
-            else:
-                layer_infos = key.split(".")[0].split(lora_prefix_unet + "_")[-1].split("_")
-                curr_layer = pipeline.unet
-
-            temp_name = layer_infos.pop(0)
-            while len(layer_infos) > -1:
-                try:
-                    curr_layer = curr_layer.__getattr__(temp_name)
-                    if len(layer_infos) > 0:
-                        temp_name = layer_infos.pop(0)
-                    elif len(layer_infos) == 0:
-                        break
-                except Exception:
-                    if len(temp_name) > 0:
-                        temp_name += "_" + layer_infos.pop(0)
-                    else:
-                        temp_name = layer_infos.pop(0)
-
-            pair_keys = []
-            if "lora_down" in key:
-                pair_keys.append(key.replace("lora_down", "lora_up"))
-                pair_keys.append(key)
-            else:
-                pair_keys.append(key)
-                pair_keys.append(key.replace("lora_up", "lora_down"))
-
-            # update weight
-            if len(state_dict[pair_keys[0]].shape) == 4:
-                weight_up = state_dict[pair_keys[0]].to(torch.float32).reshape(state_dict[pair_keys[0]].shape[0], -1)
-                weight_down = state_dict[pair_keys[1]].to(torch.float32).transpose(-1, -2).reshape(
-                    state_dict[pair_keys[1]].shape[0], -1)
-
-                # Calculate the reshaping dimensions for the output tensor
-                out_channels, in_channels, kernel_height, kernel_width = curr_layer.weight.shape
-
-                updated_weight = torch.matmul(weight_up, weight_down).reshape(out_channels, in_channels, kernel_height,
-                                                                              kernel_width)
-                curr_layer.weight.data += alpha * updated_weight
-            else:
-                weight_up = state_dict[pair_keys[0]].to(torch.float32)
-                weight_down = state_dict[pair_keys[1]].to(torch.float32)
-                curr_layer.weight.data += alpha * torch.matmul(weight_up, weight_down)
-
-            # update visited list
-            for item in pair_keys:
-                visited.append(item)
-
-        except Exception as e:
-            errors += 1
-            logger.debug(f"Exception loading LoRA key {key}: {e} {traceback.format_exc()}")
-            bad_keys.append(key)
-
-    logger.debug(f"LoRA loaded {total - errors} / {total} keys")
-    logger.debug(f"BadKeys: {bad_keys}")
-    return pipeline
-
-
 def register_function(model_handler):
     model_handler.register_loader("diffusers", load_diffusers)
@@ -0,0 +1,296 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import torch
+
+from core.handlers.config import ConfigHandler
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 ** 2
+# How often the resident memory is sampled during a load when the peak can't be measured exactly
+RSS_SAMPLE_INTERVAL = 0.05
+# Resetting the peak resident memory is process-wide, so only one load at a time can measure it
+_peak_lock = threading.Lock()
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool
+}
+# Weight files from_pretrained would pick for a component, safetensors only
+COMPONENT_WEIGHTS = ["diffusion_pytorch_model.safetensors", "model.safetensors"]
+
+
+class SafetensorsMmap:
+    """
+    A read-only view of a safetensors file that memory-maps it instead of reading it, so tensors are only paged
+    in from disk (or the page cache) when they are actually used.
+
+    Tensors share the mapped memory when no dtype conversion is needed. The mapping is copy-on-write, so tensors
+    can be modified in place, e.g. when merging LoRAs, without changing the file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            header_size = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(header_size))
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        self._offset = 8 + header_size
+        self.metadata = header.pop("__metadata__", {}) or {}
+        self._header = header
+
+    def keys(self):
+        return self._header.keys()
+
+    def __iter__(self):
+        return iter(self._header)
+
+    def __len__(self):
+        return len(self._header)
+
+    def __contains__(self, name):
+        return name in self._header
+
+    def __getitem__(self, name):
+        return self.get_tensor(name)
+
+    def get_tensor(self, name: str, dtype: Optional[torch.dtype] = None) -> torch.Tensor:
+        """
+        Get a tensor backed by the mapped file.
+
+        @param name: The tensor name.
+        @param dtype: Convert to this dtype. This copies the tensor, unless it already has this dtype.
+        """
+        info = self._header[name]
+        tensor_dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        shape = info["shape"]
+        if end == start:
+            tensor = torch.empty(shape, dtype=tensor_dtype)
+        else:
+            tensor = torch.frombuffer(self._mmap, dtype=tensor_dtype, count=(end - start) // _element_size(
+                tensor_dtype), offset=self._offset + start).reshape(shape)
+        if dtype is not None and tensor.dtype != dtype and tensor.is_floating_point():
+            tensor = tensor.to(dtype)
+        return tensor
+
+    def state_dict(self) -> Dict[str, torch.Tensor]:
+        """
+        All tensors, as a dict like safetensors.torch.load_file returns, without reading any of them yet.
+        """
+        return {name: self.get_tensor(name) for name in self._header}
+
+
+def _element_size(dtype: torch.dtype) -> int:
+    return torch.empty((), dtype=dtype).element_size()
+
+
+def load_file(path: str) -> Dict[str, torch.Tensor]:
+    """
+    A drop-in replacement for safetensors.torch.load_file on the CPU, backed by a memory map.
+    """
+    return SafetensorsMmap(path).state_dict()
+
+
+def component_weights(model_path: str, subfolder: str) -> Optional[str]:
+    for name in COMPONENT_WEIGHTS:
+        path = os.path.join(model_path, subfolder, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def load_component_lazy(component_cls, model_path: str, subfolder: str, torch_dtype: torch.dtype = None):
+    """
+    Load a diffusers or transformers model from a safetensors file, creating the module with empty weights and
+    pointing each parameter at the memory-mapped file. Unlike from_pretrained, the file is never read into
+    memory as a whole, so the peak memory use stays close to the size of the component.
+
+    @return: The model, or None if it can't be loaded this way and from_pretrained should be used instead.
+    """
+    weights_path = component_weights(model_path, subfolder)
+    if weights_path is None:
+        return None
+    model = empty_model(component_cls, model_path=model_path, subfolder=subfolder)
+    if model is None or not fill_model(model, SafetensorsMmap(weights_path).state_dict(), torch_dtype):
+        return None
+    if hasattr(model, "register_to_config"):
+        model.register_to_config(_name_or_path=model_path)
+    return model
+
+
+def model_config(model) -> Optional[Dict]:
+    """
+    The config a diffusers or transformers model can be recreated from with empty_model().
+    """
+    config = getattr(model, "config", None)
+    if config is None:
+        return None
+    if hasattr(config, "to_dict"):
+        return config.to_dict()
+    return dict(config)
+
+
+def empty_model(component_cls, config: Dict = None, model_path: str = None, subfolder: str = None):
+    """
+    Create a diffusers or transformers model without allocating its weights, from a config or from the config
+    file in a model directory.
+
+    @return: The model, or None if it isn't a diffusers or transformers model.
+    """
+    try:
+        import accelerate
+        from diffusers import ModelMixin
+        from transformers import PreTrainedModel
+    except ImportError:
+        return None
+
+    with accelerate.init_empty_weights():
+        if issubclass(component_cls, ModelMixin):
+            if config is None:
+                config = component_cls.load_config(model_path, subfolder=subfolder)
+            return component_cls.from_config(config)
+        elif issubclass(component_cls, PreTrainedModel):
+            if config is None:
+                config = component_cls.config_class.from_pretrained(model_path, subfolder=subfolder)
+            else:
+                config = component_cls.config_class.from_dict(config)
+            return component_cls(config)
+    return None
+
+
+def fill_model(model, state_dict: Dict[str, torch.Tensor], torch_dtype: torch.dtype = None) -> bool:
+    """
+    Point the parameters and buffers of a model created by empty_model() at the tensors in a state dict. Tensors
+    that already have the right dtype aren't copied.
+
+    @return: True if every weight of the model was set.
+    """
+    from accelerate.utils import set_module_tensor_to_device
+    from transformers import PreTrainedModel
+
+    if hasattr(model, "_convert_deprecated_attention_blocks"):
+        model._convert_deprecated_attention_blocks(state_dict)
+    expected = model.state_dict()
+    for name, tensor in state_dict.items():
+        if name not in expected:
+            continue
+        if expected[name].shape != tensor.shape:
+            logger.debug(f"Shape mismatch for {name}: {tensor.shape}, expected {expected[name].shape}")
+            return False
+        # Passing the dtype keeps fp16 weights as they are, instead of converting them to the empty model's dtype
+        dtype = torch_dtype if tensor.is_floating_point() else None
+        set_module_tensor_to_device(model, name, "cpu", value=tensor, dtype=dtype)
+    if isinstance(model, PreTrainedModel):
+        model.tie_weights()
+    missing = [name for name, tensor in model.state_dict().items() if tensor.device.type == "meta"]
+    if len(missing):
+        logger.debug(f"Missing weights, not loading lazily: {missing[:5]}")
+        return False
+    model.eval()
+    return True
+
+
+def _memory_status() -> Dict[str, int]:
+    status = {}
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    status[line.split(":")[0]] = int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return status
+
+
+def _reset_peak_rss() -> bool:
+    # Writing 5 to clear_refs resets VmHWM, so the peak only covers what happens next
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _sample_peak_rss(stop: threading.Event, sampled: Dict):
+    while True:
+        sampled["peak"] = max(sampled.get("peak", 0), _memory_status().get("VmRSS", 0))
+        if stop.wait(RSS_SAMPLE_INTERVAL):
+            return
+
+
+@contextmanager
+def measure_load(description: str):
+    """
+    Log how long a load took, the resident memory before and after it, and the peak resident memory during it.
+
+    The exact peak is only measured when a single load worker is configured and no other load is measuring it,
+    as resetting it affects the whole process. Otherwise the peak is the highest of the resident memory sampled
+    every RSS_SAMPLE_INTERVAL seconds, or without /proc, the peak for the lifetime of the process.
+
+    Yields a dict that is filled with the results. Set "loaded" to False in it to skip logging, e.g. when the
+    load was abandoned for another method.
+    """
+    stats = {"loaded": True}
+    before_status = _memory_status()
+    before = before_status.get("VmRSS", 0)
+    single_worker = int(ConfigHandler().get_item_protected("load_workers", "models", 1)) <= 1
+    exclusive = single_worker and _peak_lock.acquire(blocking=False)
+    reset = exclusive and _reset_peak_rss()
+    sampler = None
+    stop = threading.Event()
+    sampled = {}
+    if not reset and "VmRSS" in before_status:
+        sampler = threading.Thread(target=_sample_peak_rss, args=(stop, sampled), daemon=True)
+        sampler.start()
+    start = time.monotonic()
+    try:
+        yield stats
+    finally:
+        elapsed = time.monotonic() - start
+        if sampler is not None:
+            stop.set()
+            sampler.join()
+        status = _memory_status()
+        if exclusive:
+            _peak_lock.release()
+        if reset and "VmHWM" in status:
+            peak, source = status["VmHWM"], ""
+        elif sampled:
+            peak, source = max(sampled["peak"], status.get("VmRSS", 0)), " (sampled)"
+        elif resource is not None:
+            # ru_maxrss is in KB on Linux
+            peak, source = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, " (process)"
+        else:
+            peak, source = None, ""
+        stats.update({"time": elapsed, "rss_before": before, "rss_after": status.get("VmRSS", 0),
+                      "peak_rss": peak})
+        if stats["loaded"]:
+            if "VmRSS" in status and peak is not None:
+                logger.info(f"Loaded {description} in {stats['time']:.2f}s, RSS {before / MB:.0f}MB -> "
+                            f"{stats['rss_after'] / MB:.0f}MB, peak {peak / MB:.0f}MB{source}")
+            else:
+                # No memory statistics on this platform
+                logger.info(f"Loaded {description} in {stats['time']:.2f}s")
@@ -0,0 +1,270 @@
+import hashlib
+import json
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+import torch
+
+from core.handlers.config import ConfigHandler
+from core.handlers.hashes import cached_file_hash
+from core.handlers.model_types.lazy_safetensors import load_file, model_config
+
+logger = logging.getLogger(__name__)
+
+# The pipeline components LoRAs change, and the prefix of their layer names in LoRA files
+LORA_PREFIXES = {"unet": "lora_unet", "text_encoder": "lora_te"}
+LORA_COMPONENTS = list(LORA_PREFIXES.keys())
+# The most weight elements merged at once, 64M, 128MB in float16
+BATCH_ELEMENTS = 64 * 1024 ** 2
+# Config entries that don't change the layout of the weights
+IGNORED_CONFIG = ["transformers_version", "torch_dtype", "architectures"]
+
+
+def _unwrap(module):
+    # torch.compile wraps the module, the weights belong to the original
+    return getattr(module, "_orig_mod", module)
+
+
+def base_arch(pipeline) -> str:
+    """
+    Identify the layout of the weights LoRAs are applied to, so LoRAs parsed for one pipeline can be used with
+    every pipeline with the same UNet and text encoder configs.
+    """
+    identity = {}
+    for name in LORA_COMPONENTS:
+        component = getattr(pipeline, name, None)
+        if component is None:
+            continue
+        component = _unwrap(component)
+        config = model_config(component) or {}
+        identity[name] = [component.__class__.__name__,
+                          {k: v for k, v in config.items() if not k.startswith("_") and k not in IGNORED_CONFIG}]
+    return hashlib.sha256(json.dumps(identity, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def build_index(pipeline) -> Dict[str, Tuple[str, str]]:
+    """
+    Map the name kohya-style LoRAs give each layer of a pipeline, the prefix of the component and the module path
+    with underscores for dots, to the component and module path.
+
+    @return: LoRA layer name -> (component name, module path).
+    """
+    index = {}
+    for name, prefix in LORA_PREFIXES.items():
+        component = getattr(pipeline, name, None)
+        if component is None:
+            continue
+        for path, module in _unwrap(component).named_modules():
+            if path and isinstance(getattr(module, "weight", None), torch.Tensor):
+                index.setdefault(f"{prefix}_{path.replace('.', '_')}", (name, path))
+    return index
+
+
+def parse_lora(checkpoint_path: str, index: Dict[str, Tuple[str, str]]) \
+        -> Dict[str, Dict[str, Tuple[torch.Tensor, torch.Tensor]]]:
+    """
+    Read a kohya-style LoRA and find the layer of the pipeline each pair of weights belongs to.
+
+    @param checkpoint_path: The LoRA file.
+    @param index: The layer names of the pipeline, from build_index().
+    @return: Component name -> module path -> (up, down), with the factors flattened to matrices whose product is
+    the change to the layer's weight.
+    """
+    state_dict = load_file(checkpoint_path)
+    factors = {}
+    total = 0
+    bad_keys = []
+    for key in state_dict:
+        if ".alpha" in key or "lora_down" not in key:
+            continue
+        total += 1
+        target = index.get(key.split(".")[0], None)
+        up_key = key.replace("lora_down", "lora_up")
+        if target is None or up_key not in state_dict:
+            bad_keys.append(key)
+            continue
+        name, path = target
+        weight_up = state_dict[up_key]
+        weight_down = state_dict[key]
+        if len(weight_up.shape) == 4:
+            weight_up = weight_up.reshape(weight_up.shape[0], -1)
+            weight_down = weight_down.transpose(-1, -2).reshape(weight_down.shape[0], -1)
+        factors.setdefault(name, {})[path] = (weight_up.contiguous(), weight_down.contiguous())
+
+    logger.debug(f"LoRA loaded {total - len(bad_keys)} / {total} keys")
+    if bad_keys:
+        logger.debug(f"BadKeys: {bad_keys}")
+    return factors
+
+
+def fused_merge(targets: List[Tuple[torch.Tensor, torch.Tensor, List[Tuple[torch.Tensor, torch.Tensor, float]]]],
+                batch_elements: int = BATCH_ELEMENTS):
+    """
+    Set weights to their original values plus the weighted deltas of any number of LoRAs, on the device of each
+    weight, in its dtype on the GPU and in float32 on the CPU.
+
+    The factors of every LoRA changing a layer are concatenated along the rank, with the LoRA weights folded into
+    the up factors, so one matmul computes the sum of their deltas. Layers with the same shape and total rank are
+    then stacked and merged together with batched matmuls.
+
+    @param targets: (weight, original weight, [(up, down, LoRA weight)]) of each layer. Layers without deltas are
+    restored to the original.
+    @param batch_elements: The largest number of weight elements merged in one batch.
+    """
+    groups = {}
+    with torch.no_grad():
+        for weight, original, deltas in targets:
+            if not deltas:
+                weight.data.copy_(original)
+                continue
+            dtype = weight.dtype if weight.device.type == "cuda" else torch.float32
+            rank = sum([up.shape[1] for up, _, _ in deltas])
+            key = (weight.device, dtype, weight.shape[0], weight.numel() // weight.shape[0], rank)
+            groups.setdefault(key, []).append((weight, original, deltas))
+
+        for (device, dtype, out_dim, in_dim, rank), layers in groups.items():
+            per_batch = max(1, batch_elements // (out_dim * in_dim))
+            for start in range(0, len(layers), per_batch):
+                batch = layers[start:start + per_batch]
+                ups = torch.stack([torch.cat([up.to(device, dtype) * scale for up, _, scale in deltas], dim=1)
+                                   for _, _, deltas in batch])
+                downs = torch.stack([torch.cat([down.to(device, dtype) for _, down, _ in deltas], dim=0)
+                                     for _, _, deltas in batch])
+                merged = torch.stack([original.to(device, dtype).reshape(out_dim, in_dim) for _, original, _ in batch])
+                merged.baddbmm_(ups, downs)
+                for (weight, _, _), layer_weight in zip(batch, merged):
+                    weight.data.copy_(layer_weight.reshape(weight.shape))
+
+
+class LoraManager:
+    """
+    Applies LoRAs to pipelines in a way that can be undone, so switching LoRAs or changing their weight updates the
+    layers in place instead of reloading the model.
+
+    The first time a layer is changed, a copy of its original weight is kept on the CPU. Every update then sets the
+    weight to the original plus the weighted LoRA deltas, so nothing drifts however often it changes, and removing
+    every LoRA restores the exact original. Only the layers LoRAs touch are copied. The layers of every component
+    are merged together, see fused_merge().
+
+    Parsed LoRAs are cached by the hash of the LoRA file and the layout of the pipeline they were applied to, as the
+    low-rank factors of the per-layer deltas, which take much less memory than the deltas themselves.
+    """
+    _instance = None
+    _lock = threading.RLock()
+    # (LoRA hash, arch) -> parsed factors
+    _factors = OrderedDict()
+    # arch -> LoRA layer names, from build_index()
+    _indexes = {}
+    # layer -> original weight
+    _originals = weakref.WeakKeyDictionary()
+    # component -> (applied LoRAs, paths of the changed layers)
+    _applied = weakref.WeakKeyDictionary()
+    max_cached = 8
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(LoraManager, cls).__new__(cls)
+            cls._instance._factors = OrderedDict()
+            cls._instance._indexes = {}
+            cls._instance._originals = weakref.WeakKeyDictionary()
+            cls._instance._applied = weakref.WeakKeyDictionary()
+            cls._instance.max_cached = max(0, int(ConfigHandler().get_item_protected("max_cached_loras", "models", 8)))
+        return cls._instance
+
+    def get(self, pipeline, checkpoint_path: str, arch: str = None) -> Tuple[str, Dict]:
+        """
+        Get the parsed factors of a LoRA for a pipeline, from the cache if it was used with the same layout before.
+
+        @return: The cache key of the LoRA and its factors.
+        """
+        arch = arch or base_arch(pipeline)
+        key = f"{cached_file_hash(checkpoint_path)}:{arch}"
+        with self._lock:
+            if key in self._factors:
+                self._factors.move_to_end(key)
+                return key, self._factors[key]
+        factors = parse_lora(checkpoint_path, self.index(pipeline, arch))
+        with self._lock:
+            self._factors[key] = factors
+            while len(self._factors) > self.max_cached:
+                self._factors.popitem(last=False)
+        return key, factors
+
+    def index(self, pipeline, arch: str = None) -> Dict[str, Tuple[str, str]]:
+        """
+        Get the LoRA layer names of a pipeline, built once for each layout and shared by every pipeline with it.
+        """
+        arch = arch or base_arch(pipeline)
+        with self._lock:
+            if arch not in self._indexes:
+                self._indexes[arch] = build_index(pipeline)
+            return self._indexes[arch]
+
+    def set_loras(self, pipeline, loras: List[Tuple[str, float]]):
+        """
+        Make the LoRAs applied to a pipeline exactly the given ones, adding, removing or reweighting them in place.
+
+        @param pipeline: The pipeline.
+        @param loras: (path, weight) of each LoRA, an empty list removes them all.
+        @return: The pipeline.
+        """
+        arch = base_arch(pipeline)
+        wanted = []
+        for path, weight in loras:
+            key, factors = self.get(pipeline, path, arch)
+            wanted.append((key, factors, float(weight)))
+        with self._lock:
+            # (layer, deltas) of every layer that changes
+            updates = []
+            for name in LORA_COMPONENTS:
+                component = getattr(pipeline, name, None)
+                if component is None:
+                    continue
+                component = _unwrap(component)
+                target = tuple([(key, weight) for key, factors, weight in wanted if name in factors])
+                current, changed = self._applied.get(component, ((), set()))
+                if current == target:
+                    continue
+                layers = {}
+                for key, factors, weight in wanted:
+                    for path, (up, down) in factors.get(name, {}).items():
+                        layers.setdefault(path, []).append((up, down, weight))
+                modules = dict(component.named_modules())
+                for path in changed | set(layers):
+                    updates.append((modules[path], layers.get(path, [])))
+                if target:
+                    self._applied[component] = (target, set(layers))
+                else:
+                    self._applied.pop(component, None)
+            self._update(updates)
+        return pipeline
+
+    def applied(self, pipeline) -> List[Tuple[str, float]]:
+        """
+        The LoRAs applied to a pipeline, as (cache key, weight).
+        """
+        loras = []
+        for name in LORA_COMPONENTS:
+            component = getattr(pipeline, name, None)
+            if component is not None:
+                for lora in self._applied.get(_unwrap(component), ((), set()))[0]:
+                    if lora not in loras:
+                        loras.append(lora)
+        return loras
+
+    def _update(self, updates: List[Tuple[torch.nn.Module, List]]):
+        targets = []
+        for layer, deltas in updates:
+            original = self._originals.get(layer, None)
+            if original is None:
+                if not deltas:
+                    continue
+                original = layer.weight.detach().to("cpu", copy=True)
+                self._originals[layer] = original
+            targets.append((layer.weight, original, deltas))
+            if not deltas:
+                del self._originals[layer]
+        fused_merge(targets)
@@ -0,0 +1,88 @@
+import copy
+import json
+import logging
+import threading
+from typing import Dict, List
+
+from diffusers import DDIMScheduler, DDPMScheduler, DEISMultistepScheduler, DPMSolverMultistepScheduler, \
+    DPMSolverSinglestepScheduler, EulerAncestralDiscreteScheduler, EulerDiscreteScheduler, HeunDiscreteScheduler, \
+    KDPM2AncestralDiscreteScheduler, KDPM2DiscreteScheduler, LMSDiscreteScheduler, PNDMScheduler, \
+    UniPCMultistepScheduler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SCHEDULER = "UniPC"
+
+# Name -> (scheduler class, config overrides)
+SCHEDULERS = {
+    "DDIM": (DDIMScheduler, {}),
+    "DDPM": (DDPMScheduler, {}),
+    "DEIS": (DEISMultistepScheduler, {}),
+    "DPM++ 2M": (DPMSolverMultistepScheduler, {}),
+    "DPM++ 2M Karras": (DPMSolverMultistepScheduler, {"use_karras_sigmas": True}),
+    "DPM++ 2S": (DPMSolverSinglestepScheduler, {}),
+    "Euler": (EulerDiscreteScheduler, {}),
+    "Euler a": (EulerAncestralDiscreteScheduler, {}),
+    "Heun": (HeunDiscreteScheduler, {}),
+    "KDPM2": (KDPM2DiscreteScheduler, {}),
+    "KDPM2 a": (KDPM2AncestralDiscreteScheduler, {}),
+    "LMS": (LMSDiscreteScheduler, {}),
+    "PNDM": (PNDMScheduler, {}),
+    "UniPC": (UniPCMultistepScheduler, {"solver_type": "bh2"})
+}
+
+# (name, base config) -> scheduler instance, only ever used as a template
+_templates = {}
+_lock = threading.Lock()
+
+
+def list_schedulers() -> List[str]:
+    return list(SCHEDULERS.keys())
+
+
+def get_scheduler(name: str, base_config: Dict):
+    """
+    Get a new scheduler instance, configured from the scheduler config a model was loaded with.
+
+    Instances are built once per scheduler and config and copied for every call, because schedulers keep
+    per-run state like their timesteps. Each job should get its own.
+
+    @param name: A name from SCHEDULERS, or a scheduler class name.
+    @param base_config: The config of the model's scheduler.
+    @return: The scheduler, or None if the name is unknown.
+    """
+    if name not in SCHEDULERS:
+        name = next((key for key, (cls, overrides) in SCHEDULERS.items()
+                     if cls.__name__ == name and not overrides), None)
+        if name is None:
+            return None
+    config = dict(base_config)
+    cache_key = (name, json.dumps(config, sort_keys=True, default=str))
+    with _lock:
+        template = _templates.get(cache_key, None)
+        if template is None:
+            scheduler_cls, overrides = SCHEDULERS[name]
+            template = scheduler_cls.from_config(config, **overrides)
+            _templates[cache_key] = template
+    return copy.deepcopy(template)
+
+
+def with_scheduler(pipeline, name: str):
+    """
+    Get a shallow copy of a pipeline using its own instance of a scheduler, so concurrent jobs can use
+    different schedulers with the same resident pipeline. The models themselves are shared, not copied.
+
+    @param pipeline: The loaded pipeline.
+    @param name: The scheduler name. If empty or unknown, the pipeline's scheduler is copied.
+    """
+    if getattr(pipeline, "scheduler", None) is None:
+        return pipeline
+    scheduler = get_scheduler(name, pipeline.scheduler.config) if name else None
+    if scheduler is None:
+        if name:
+            logger.warning(f"Unknown scheduler: {name}")
+        scheduler = copy.deepcopy(pipeline.scheduler)
+    job_pipeline = copy.copy(pipeline)
+    # Setting a registered module updates the copy's own config, the original pipeline is left alone
+    job_pipeline.scheduler = scheduler
+    return job_pipeline
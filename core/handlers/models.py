@@ -1,11 +1,15 @@
+import asyncio
 import gc
-import glob
 import importlib
 import logging
 import os
 import shutil
+import threading
+import time
 import traceback
-from typing import List, Dict, Union
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Dict, Union
 from urllib.parse import urlparse
 
 import torch
@@ -13,37 +17,149 @@ from basicsr.utils.download_util import load_file_from_url
 from huggingface_hub import snapshot_download
 
 from core.dataclasses.model_data import ModelData
+from core.handlers.catalog import ModelCatalog
+from core.handlers.config import ConfigHandler
+from core.handlers.conversions import ConversionCache
 from core.handlers.directories import DirectoryHandler
+from core.handlers.hashes import HashHandler, model_identity
+from core.handlers.prefetch import ModelPrefetcher, weight_files
+from core.handlers.residency import ModelResidency, residency_key, model_size, size_on_device
 from core.handlers.websocket import SocketHandler
 from dreambooth.sd_to_diff import extract_checkpoint
 
 logger = logging.getLogger(__name__)
 
+_load_progress = threading.local()
 
-# This class is a singleton used to easily move models in and out of CPU/GPU memory
-# If you're relying on this instead of deleting loaded models, then it might be a good idea to check
-# if they are currently on the desired device, and if not, move it there.
+
+def report_load_progress(description: str, current: int = None, total: int = None):
+    """
+    Called by model loaders to report the progress of the load running on this thread, if anyone is listening.
+
+    @param description: What is being loaded, e.g. "Loading unet".
+    @param current: The number of steps done.
+    @param total: The total number of steps.
+    """
+    callback = getattr(_load_progress, "callback", None)
+    if callback is not None:
+        try:
+            callback(description, current, total)
+        except Exception as e:
+            logger.debug(f"Unable to report load progress: {e}")
+
+
+def _weak(method: Callable) -> Callable:
+    # Bound methods are referenced weakly, so registering doesn't keep their object alive
+    if method is None:
+        return lambda: None
+    if hasattr(method, "__self__"):
+        return weakref.WeakMethod(method)
+    return lambda: method
+
+
+class _Registrant:
+    def __init__(self, to_cpu_method, to_gpu_method, footprint_method=None):
+        self.to_cpu = _weak(to_cpu_method)
+        self.to_gpu = _weak(to_gpu_method)
+        self.footprint = _weak(footprint_method)
+        self.owner = weakref.ref(to_cpu_method.__self__) if hasattr(to_cpu_method, "__self__") else None
+        # Never used ones are offloaded first
+        self.last_used = 0.0
+
+    @property
+    def alive(self) -> bool:
+        return self.to_cpu() is not None
+
+
+# This class is a singleton used to move models in and out of CPU/GPU memory. Owners of models register methods to
+# move them and to report how much VRAM they use. A job about to use the GPU declares how much memory it needs with
+# request(), and only the least recently used models are offloaded, until there is enough room.
 class ModelManager:
-    _to_cpu_handlers = []
-    _to_gpu_handlers = []
+    _registrants = []
+    _lock = threading.RLock()
     _instance = None
+    margin = 0
 
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(ModelManager, cls).__new__(cls)
+            cls._instance._registrants = []
+            cls._instance.margin = int(
+                float(ConfigHandler().get_item_protected("offload_margin_mb", "models", 512)) * 1024 ** 2)
         return cls._instance
 
-    def register(self, to_cpu_method, to_gpu_method):
-        self._to_cpu_handlers.append(to_cpu_method)
-        self._to_gpu_handlers.append(to_gpu_method)
+    def register(self, to_cpu_method, to_gpu_method, footprint_method: Callable[[], int] = None):
+        """
+        Register the methods that move an object's models. Bound methods are referenced weakly, so objects that
+        are garbage collected drop out.
+
+        @param to_cpu_method: Moves the models off the GPU.
+        @param to_gpu_method: Moves the models back to the GPU.
+        @param footprint_method: Returns the bytes of VRAM the models use. Without it, the models are only moved
+        by to_cpu() and to_gpu(), never to make room for a request.
+        """
+        with self._lock:
+            self._registrants = [r for r in self._registrants if r.alive]
+            self._registrants.append(_Registrant(to_cpu_method, to_gpu_method, footprint_method))
+
+    def used(self, owner):
+        """
+        Mark the models of an owner as just used, so they are offloaded last.
+        """
+        with self._lock:
+            for registrant in self._registrants:
+                if registrant.owner is not None and registrant.owner() is owner:
+                    registrant.last_used = time.monotonic()
+
+    def request(self, needed: int, owner=None) -> bool:
+        """
+        Make room on the GPU for a job, offloading other owners' models in least recently used order until the
+        job's memory fits.
+
+        @param needed: The bytes of VRAM the job needs.
+        @param owner: The object the job belongs to. Its own models are never offloaded.
+        @return: True if there is enough free VRAM now.
+        """
+        if not torch.cuda.is_available():
+            return True
+        if owner is not None:
+            self.used(owner)
+        with self._lock:
+            if self._free() >= needed + self.margin:
+                return True
+            candidates = [r for r in self._registrants
+                          if r.alive and (owner is None or r.owner is None or r.owner() is not owner)]
+            for registrant in sorted(candidates, key=lambda r: r.last_used):
+                footprint_method = registrant.footprint()
+                to_cpu = registrant.to_cpu()
+                footprint = footprint_method() if footprint_method is not None else 0
+                if not footprint or to_cpu is None:
+                    continue
+                logger.debug(f"Offloading {footprint / 1024 ** 3:.2f}GB to make room for {needed / 1024 ** 3:.2f}GB")
+                to_cpu()
+                gc.collect()
+                torch.cuda.empty_cache()
+                if self._free() >= needed + self.margin:
+                    return True
+            return self._free() >= needed
+
+    @staticmethod
+    def _free() -> int:
+        free, total = torch.cuda.mem_get_info()
+        # Memory cached by torch but not allocated is free for this process
+        return free + torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
 
     def to_cpu(self):
-        for handler in self._to_cpu_handlers:
-            handler()
+        for registrant in list(self._registrants):
+            method = registrant.to_cpu()
+            if method is not None:
+                method()
 
     def to_gpu(self):
-        for handler in self._to_gpu_handlers:
-            handler()
+        for registrant in list(self._registrants):
+            method = registrant.to_gpu()
+            if method is not None:
+                method()
 
 
 class ModelHandler:
@@ -62,6 +178,10 @@ class ModelHandler:
     load_params = {}
     user_name = None
     logger = None
+    _load_executor = None
+    # residency key -> concurrent.futures.Future of the load in progress, shared by all users
+    _pending_loads = {}
+    _pending_lock = threading.Lock()
 
     def __new__(cls, user_name=None, watcher=None):
         if cls._instance is None and watcher is not None:
@@ -74,12 +194,19 @@ class ModelHandler:
             cls._instance.loaded_models = {}
             cls._instance.models_path = models_path
             cls._instance.shared_path = dir_handler.get_shared_directory("models")
+            ModelCatalog()
+            HashHandler().register_callback(cls._on_hash)
+            for model_path in models_path:
+                watcher.register_directory(model_path)
             cls._instance.socket_handler = SocketHandler()
             cls._instance.socket_handler.register("models", cls._instance.list_models)
             cls._instance.socket_handler.register("load_model", cls._instance._load_model)
             cls._instance.initialize_loaders()
             manager = ModelManager()
-            manager.register(cls._instance.to_cpu, cls._instance.to_gpu)
+            manager.register(cls._instance.to_cpu, cls._instance.to_gpu, cls._instance.vram_footprint)
+            # Models nobody is using are offloaded before anyone's current models
+            residency = ModelResidency()
+            manager.register(residency.offload, None, residency.footprint)
 
         if user_name is not None:
             if user_name in cls._instances:
@@ -95,6 +222,8 @@ class ModelHandler:
                 user_instance.user_path = dir_handler.get_user_directory("models")
                 user_instance.models = {}
                 user_instance.model_watcher = cls._instance.model_watcher
+                for model_path in models_path:
+                    user_instance.model_watcher.register_directory(model_path)
                 user_instance.loaded_models = {}
                 user_instance.models_path = models_path
                 user_instance.socket_handler = SocketHandler()
@@ -102,7 +231,7 @@ class ModelHandler:
                 user_instance.socket_handler.register("load_model", user_instance._load_model, user_name)
                 user_instance.user_name = user_name
                 manager = ModelManager()
-                manager.register(user_instance.to_cpu, user_instance.to_gpu)
+                manager.register(user_instance.to_cpu, user_instance.to_gpu, user_instance.vram_footprint)
                 user_instance.initialize_loaders()
                 cls._instances[user_name] = user_instance
                 return user_instance
@@ -136,6 +265,16 @@ class ModelHandler:
                     loaded_model = model_data.hash
             return {"models": model_json, "loaded": loaded_model}
 
+    @classmethod
+    def _on_hash(cls, model_path: str, model_quick_hash: str, full_hash: str):
+        """
+        Replace the quick hash of a listed model with its full hash once the HashHandler has calculated it.
+        """
+        for models in list(cls.listed_models.values()):
+            for model in list(models):
+                if model.path == model_path and model.quick_hash == model_quick_hash:
+                    model.hash = full_hash
+
     async def find_model(self, model_type: str, value: Union[str, Dict]):
         if model_type in self.listed_models:
             models = self.listed_models[model_type]
@@ -146,13 +285,17 @@ class ModelHandler:
             self.logger.warning(f"Can't list models: {model_type}")
             models = self.load_models(model_type)
 
+        # Quick hashes in the list are replaced with full hashes by _on_hash, nothing is hashed here
         for model in models:
             if isinstance(value, dict):
-                if model.hash == value["hash"]:
-                    return model
+                found = model.hash == value["hash"] or (model.quick_hash and model.quick_hash == value["hash"])
             else:
-                if model.name == value or model.hash == value or model.display_name == value or model.path == value:
-                    return model
+                found = model.name == value or model.hash == value or model.display_name == value or \
+                        model.path == value or (model.quick_hash and model.quick_hash == value)
+            if found:
+                # Selecting a model is a weaker hint than loading it
+                ModelPrefetcher().record(self._owner(), model.path, 0.25)
+                return model
         logger.debug(f"Model not found: {value}")
         return None
 
@@ -170,7 +313,7 @@ class ModelHandler:
             return {"message": "Invalid data."}
         else:
             model_type = data["model_type"]
-            self.load_model(model_type, md)
+            await self.load_model_async(model_type, md)
             return {"loaded": md.serialize()}
 
     def initialize_loaders(self):
@@ -201,6 +344,15 @@ class ModelHandler:
 
         """
         output = []
+        seen = set()
+
+        def add(entry: Dict, name: str = None):
+            # The same model can be in the shared and the user's models, list it once
+            identities = [os.path.realpath(entry["path"]), entry.get("hash", None), entry.get("quick_hash", None)]
+            if any([identity and identity in seen for identity in identities]):
+                return
+            seen.update([identity for identity in identities if identity])
+            output.append(ModelData.from_catalog(entry, name=name))
 
         # Save these for later so when "refresh" is called, we can reload.
         if "_" in model_type:
@@ -216,49 +368,38 @@ class ModelHandler:
             }
 
             if "diffusers" == model_type:
-                diff_dirs = self.load_diffusion_models("dreambooth" in model_type)
-                for diff_dir in diff_dirs:
+                for entry in self.load_diffusion_models("dreambooth" in model_type, entries=True):
+                    diff_dir = entry["path"]
                     name = None
                     if "working" in diff_dir:
                         # Set model data.name to the parent directory of diff_dir
                         name = os.path.basename(os.path.dirname(diff_dir))
-                    model_data = ModelData(diff_dir, name=name)
-                    output.append(model_data)
+                    add(entry, name=name)
                 return output
 
             if ext_include is None:
                 ext_include = []
 
             try:
-                for mp in self.models_path:
-                    model_path = os.path.join(mp, model_type)
-                    if not os.path.exists(model_path):
-                        os.makedirs(model_path)
-
-                    for file in glob.iglob(model_path + '**/**', recursive=True):
-                        full_path = file
-                        if os.path.isdir(full_path):
-                            continue
-                        if os.path.islink(full_path) and not os.path.exists(full_path):
+                for entry in ModelCatalog().get_entries(model_type, self.models_path):
+                    full_path = entry["path"]
+                    if ext_exclude is not None and any([full_path.endswith(x) for x in ext_exclude]):
+                        continue
+                    if len(ext_include) != 0:
+                        _, extension = os.path.splitext(full_path)
+                        if extension not in ext_include:
                             continue
-                        if ext_exclude is not None and any([full_path.endswith(x) for x in ext_exclude]):
-                            continue
-                        if len(ext_include) != 0:
-                            model_type, extension = os.path.splitext(file)
-                            if extension not in ext_include:
-                                continue
-                        model_data = ModelData(full_path)
-                        if model_data not in output:
-                            output.append(model_data)
-
-                    if model_url is not None and len(output) == 0:
-                        if download_name is not None:
-                            dl = load_file_from_url(model_url, model_path, True, download_name)
-                            model_data = ModelData(dl)
-                            output.append(model_data)
-                        else:
-                            model_data = ModelData(model_url)
-                            output.append(model_data)
+                    add(entry)
+
+                if model_url is not None and len(output) == 0:
+                    model_path = os.path.join(self.models_path[0], model_type)
+                    if download_name is not None:
+                        dl = load_file_from_url(model_url, model_path, True, download_name)
+                        model_data = ModelData(dl)
+                        output.append(model_data)
+                    else:
+                        model_data = ModelData(model_url)
+                        output.append(model_data)
 
             except Exception as e:
                 self.logger.warning(f"Exception: {e}")
@@ -267,55 +408,42 @@ class ModelHandler:
 
         return output
 
-    def refresh(self, model_type: str, to_load=None, model_name=None):
+    def refresh(self, model_type: str, to_load=None, model_name=None, changes: Dict = None, rescan: bool = True):
+        """
+        Tell clients to reload their model lists for a model type.
+
+        @param model_type: The model type to reload.
+        @param to_load: Optional path of a model for clients to select.
+        @param model_name: Optional display name for to_load.
+        @param changes: Optional dict of "added", "updated" and "removed" model paths.
+        @param rescan: Rescan the model directories first. Not needed if the catalog was just updated.
+        """
+        if rescan:
+            ModelCatalog().get_entries(model_type, self.models_path, refresh=True)
         model_data = None
         if to_load:
             self.logger.debug(f"Reloading model from data: {to_load}")
-            model_data = ModelData(to_load, name=model_name).__dict__
+            model_data = ModelData(to_load, name=model_name).serialize()
         msg = {
             "name": "reload_models",
             "model_type": model_type,
             "user": self.user_name,
             "to_load": model_data
         }
+        if changes is not None:
+            msg["changes"] = changes
         logger.debug(f"Broadcasting: {msg}")
         self.socket_handler.queue.put_nowait(msg)
 
-    def load_diffusion_models(self, load_dreambooth: bool = False) -> List[str]:
-        model_directories = []
-        target_directories = []
-        for path in self.models_path:
-            target_directories.append(os.path.join(path, "diffusers"))
-            if load_dreambooth:
-                target_directories.append(os.path.join(path, "dreambooth"))
-
-        for model_path in target_directories:
-            for root, dirs, files in os.walk(model_path):
-                # Check if the current directory contains a "model_index.json" file
-                if "model_index.json" in files:
-                    model_directories.append(root)
-                    # Stop searching this directory's subdirectories
-                    dirs[:] = []
-                # Continue searching other directories
-                else:
-                    subdirs = [os.path.join(root, d) for d in dirs if os.path.isdir(os.path.join(root, d))]
-                    for subdir in subdirs:
-                        for subroot, subdirs, subfiles in os.walk(subdir):
-                            # Check if the current directory contains a "model_index.json" file
-                            if "model_index.json" in subfiles:
-                                model_directories.append(subroot)
-                                # Stop searching this directory's subdirectories
-                                subdirs[:] = []
-                            # Continue searching other directories
-                            else:
-                                subsubdirs = [os.path.join(subroot, d) for d in subdirs if
-                                              os.path.isdir(os.path.join(subroot, d))]
-                                subdirs[:] = subsubdirs
+    def load_diffusion_models(self, load_dreambooth: bool = False, entries: bool = False) -> List[Union[str, Dict]]:
+        model_types = ["diffusers"]
+        if load_dreambooth:
+            model_types.append("dreambooth")
 
+        catalog = ModelCatalog()
         output = []
-        for md in model_directories:
-            if md not in output:
-                output.append(md)
+        for model_type in model_types:
+            output.extend(catalog.get_entries(model_type, self.models_path))
 
         if len(output) == 0:
             dest_folder = os.path.join(self.models_path[1], "diffusers", "stable-diffusion-1-5")
@@ -325,10 +453,12 @@ class ModelHandler:
 
             snapshot_download(repo_id, revision=None, repo_type="model", cache_dir=None, local_dir=dest_folder,
                               local_dir_use_symlinks=False, ignore_patterns=exclude_files)
-            output.append(dest_folder)
+            output = catalog.get_entries("diffusers", self.models_path, refresh=True)
 
             self.refresh("diffusers")
-        return output
+        if entries:
+            return output
+        return [entry["path"] for entry in output]
 
     def register_loader(self, model_type, callback):
         if model_type not in self.model_loaders:
@@ -338,73 +468,245 @@ class ModelHandler:
         if model_type not in self.model_finders:
             self.model_finders[model_type] = callback
 
-    def load_model(self, model_type: str, model_data: ModelData, unload: bool = True):
+    async def load_model_async(self, model_type: str, model_data: ModelData, unload: bool = True,
+                               status_handler=None, pin: bool = False):
+        """
+        Load a model without blocking the event loop. Loads run on a dedicated executor, and concurrent requests
+        for the same model, from any user, wait for a single load.
+
+        @param model_type: The model type, used to find the registered loader.
+        @param model_data: The model to load, with any loader options in model_data.data.
+        @param unload: Make this the current model for model_type, see load_model.
+        @param status_handler: Optional StatusHandler to send per-component progress to.
+        @param pin: Pin the model for a job, see load_model.
+        """
+        loop = asyncio.get_running_loop()
+        progress = None
+        if status_handler is not None:
+            def progress(description, current, total):
+                items = {"status_2": description}
+                if total:
+                    items["progress_2_total"] = total
+                    items["progress_2_current"] = current or 0
+                status_handler.update(items=items, send=True)
+
+        def load():
+            return self.load_model(model_type, model_data, unload, progress, pin)
+
+        if not unload or model_type not in self.model_loaders:
+            return await loop.run_in_executor(self._executor(), load)
+
+        key = residency_key(model_type, model_data)
+        # Requests come from the event loops of several worker threads, so loads are shared as thread-safe futures
+        with ModelHandler._pending_lock:
+            pending = ModelHandler._pending_loads.get(key, None)
+            waiting = pending is not None
+            if not waiting:
+                pending = self._executor().submit(load)
+                ModelHandler._pending_loads[key] = pending
+
+        if waiting:
+            self.logger.debug("Waiting for the same model to finish loading.")
+            if progress is not None:
+                progress("Waiting for model to load", None, None)
+            # Don't cancel the other request's load if this one is cancelled
+            await asyncio.shield(asyncio.wrap_future(pending))
+            # It's resident now, so this only borrows it
+            return await self._await_load(self._executor().submit(load), pin)
+
+        def done(future):
+            with ModelHandler._pending_lock:
+                if ModelHandler._pending_loads.get(key, None) is future:
+                    del ModelHandler._pending_loads[key]
+
+        pending.add_done_callback(done)
+        return await self._await_load(pending, pin)
+
+    async def _await_load(self, future: Future, pin: bool):
+        """
+        Wait for a load without cancelling it if the request is cancelled. The pin of a cancelled request is
+        dropped once the load finishes, as the job using the model will never run.
+        """
+        try:
+            return await asyncio.shield(asyncio.wrap_future(future))
+        except asyncio.CancelledError:
+            if pin:
+                future.add_done_callback(
+                    lambda f: f.cancelled() or f.exception() is not None or self.unpin_model(f.result()))
+            raise
+
+    @classmethod
+    def _executor(cls) -> ThreadPoolExecutor:
+        if cls._load_executor is None:
+            workers = max(1, int(ConfigHandler().get_item_protected("load_workers", "models", 1)))
+            cls._load_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="model_loader")
+        return cls._load_executor
+
+    def load_model(self, model_type: str, model_data: ModelData, unload: bool = True, progress: Callable = None,
+                   pin: bool = False):
+        """
+        Load a model, borrowing it from the shared ModelResidency pool if it is already loaded for this or any
+        other user.
+
+        @param model_type: The model type, used to find the registered loader.
+        @param model_data: The model to load, with any loader options in model_data.data.
+        @param unload: Make this the current model for model_type. If False, the model is loaded without being
+        pooled or replacing the current one.
+        @param progress: Optional method called with (description, current, total) as the loader progresses.
+        @param pin: Pin the pooled model for a job, so nothing changes, moves or drops it until the job passes it
+        to unpin_model(), even if this handler switches to another model in the meantime.
+        """
         self.logger.debug(f"Loading model ({model_type})")
-        if model_type in self.loaded_models:
-            loaded_model_data, model = self.loaded_models[model_type]
-            if model_data != loaded_model_data and unload:
-                self.logger.debug(f"Unloading model...")
-                del model
-                del self.loaded_models[model_type]
-                if torch.has_cuda:
-                    torch.cuda.empty_cache()
-                gc.collect()
-            else:
-                if torch.cuda.is_available():
-                    model = model.to('cuda')
-                return model
+        # Don't compete with the load for the disk
+        ModelPrefetcher().cancel()
+        _load_progress.callback = progress
+        try:
+            return self._load_pooled(model_type, model_data, unload, pin)
+        finally:
+            _load_progress.callback = None
 
+    def _load_pooled(self, model_type: str, model_data: ModelData, unload: bool, pin: bool = False):
         # Convert stable-diffusion/checkpoints to diffusers
         if model_type == "stable-diffusion":
-            target_model = os.path.join(self.models_path, "diffusers", os.path.basename(model_data.path))
-            if os.path.exists(target_model):
-                self.logger.info("Model already extracted.")
-                return target_model
+            return self._convert_checkpoint(model_data)
 
-            self.logger.info("Converting sd model to diffusers.")
+        if model_type not in self.model_loaders:
+            self.logger.warning(f"No registered loader for model type: {model_type}")
+            return None
+
+        if not unload:
+            loaded = self.model_loaders[model_type](model_data)
+            return self._to_device(loaded) if loaded else None
+
+        residency = ModelResidency()
+        key = residency_key(model_type, model_data)
+        with residency.load_lock(key):
+            loaded = residency.acquire(key, self._owner(), pin)
+            if loaded is None:
+                # The previous model stays in the pool, but may be moved to the CPU or dropped to make room.
+                # Pipelines of the same model are kept, the loader can reuse their components.
+                self.release_model(model_type)
+                related = [k for k in residency.keys(model_type) if k.identity == key.identity]
+                residency.make_room(keep=self._current_keys() + related)
+                if torch.cuda.is_available() and not model_data.is_url and os.path.exists(model_data.path):
+                    # Loaders may move the weights to the GPU themselves, make room for about the size on disk
+                    ModelManager().request(sum([os.path.getsize(f) for f in weight_files(model_data.path)]),
+                                           owner=self)
+                loaded = self.model_loaders[model_type](model_data)
+                if not loaded:
+                    return None
+                residency.put(key, loaded, self._owner(), pin)
+            else:
+                self.logger.debug("Using resident model.")
+        report_load_progress("Moving model to device")
+        loaded = self._to_device(loaded)
+        current = self.loaded_models.get(model_type, None)
+        if current is not None and current[1] != key:
+            residency.release(current[1], self._owner())
+        # Only the selection is kept per user, the weights live in the pool
+        self.loaded_models[model_type] = (model_data, key)
+        residency.enforce(keep=self._current_keys())
+        self._prefetch_next(model_data)
+        return loaded
+
+    def _prefetch_next(self, model_data: ModelData):
+        """
+        Record a model load, then prefetch what this user is likely to load next while the GPU is busy.
+        """
+        if model_data.is_url:
+            return
+        prefetcher = ModelPrefetcher()
+        prefetcher.record(self._owner(), model_data.path)
+        resident = set([key.identity for key in ModelResidency().keys()])
 
-            try:
-                results = extract_checkpoint("test", model_data.path, extract_ema=True, train_unfrozen=True)
-                model_dir = results[1]
-                if os.path.exists(model_dir):
-                    diffusers_path = os.path.join(model_dir, "working")
-                    if os.path.exists(diffusers_path):
-                        dest_path = os.path.join(self.models_path, "diffusers")
-                        os.makedirs(dest_path)
-                        dest_path = os.path.join(self.models_path, "diffusers", os.path.basename(model_data.path))
-                        if not os.path.exists(dest_path):
-                            shutil.copytree(diffusers_path, dest_path)
-                    shutil.rmtree(model_dir)
+        def is_resident(path):
+            return model_identity(path) in resident
 
-            except Exception as e:
-                self.logger.warning(f"Couldn't extract checkpoint: {e}")
-        else:
-            if model_type not in self.model_loaders:
-                self.logger.warning(f"No registered loader for model type: {model_type}")
-            else:
-                loaded = self.model_loaders[model_type](model_data)
-                if loaded:
-                    if torch.has_cuda:
-                        try:
-                            loaded = loaded.to("cuda")
-                        except:
-                            self.logger.debug("Couldn't load model to GPU.")
-
-                    if torch.has_mps:
-                        try:
-                            loaded = loaded.to("ddp")
-                        except:
-                            self.logger.debug("Couldn't load model to DDP.")
-                    if unload:
-                        self.loaded_models[model_type] = (model_data, loaded)
-                    return loaded
+        prefetcher.schedule(self._owner(), exclude=is_resident)
+
+    def get_loaded_model(self, model_type: str):
+        """
+        Get the current model for a model type, if one is loaded.
+        """
+        if model_type not in self.loaded_models:
+            return None
+        _, key = self.loaded_models[model_type]
+        return ModelResidency().get(key)
+
+    def unpin_model(self, model):
+        """
+        Unpin a model loaded with pin=True, once the job using it has finished.
+        """
+        if model is not None:
+            ModelResidency().unpin(model)
+
+    def release_model(self, model_type: str):
+        """
+        Stop using the current model for a model type. It stays in the pool until it is evicted.
+        """
+        current = self.loaded_models.pop(model_type, None)
+        if current is not None:
+            ModelResidency().release(current[1], self._owner())
+
+    def _convert_checkpoint(self, model_data: ModelData):
+        models_path = getattr(self, "user_path", None) or self.shared_path
+        target_model = os.path.join(models_path, "diffusers", os.path.basename(model_data.path))
+
+        # Everything passed to the converter, the image size and prediction type are detected from the checkpoint
+        # itself, which is covered by its hash
+        params = {"extract_ema": True, "train_unfrozen": True}
+
+        def convert(dest_path):
+            results = extract_checkpoint("test", model_data.path, **params)
+            model_dir = results[1]
+            if os.path.exists(model_dir):
+                diffusers_path = os.path.join(model_dir, "working")
+                if os.path.exists(diffusers_path):
+                    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+                    shutil.copytree(diffusers_path, dest_path, dirs_exist_ok=True)
+                shutil.rmtree(model_dir)
+
+        try:
+            return ConversionCache().convert(model_data.path, target_model, params, convert)
+        except Exception as e:
+            self.logger.warning(f"Couldn't extract checkpoint: {e}")
         return None
 
+    def _to_device(self, model):
+        if torch.has_cuda:
+            # Only what isn't on the GPU yet needs room
+            needed = model_size(model) - size_on_device(model, "cuda")
+            manager = ModelManager()
+            if needed:
+                manager.request(needed, owner=self)
+            manager.used(self)
+            try:
+                model = model.to("cuda")
+            except:
+                self.logger.debug("Couldn't load model to GPU.")
+
+        if torch.has_mps:
+            try:
+                model = model.to("ddp")
+            except:
+                self.logger.debug("Couldn't load model to DDP.")
+        return model
+
+    def _owner(self):
+        return self.user_name if self.user_name is not None else ""
+
+    def _current_keys(self):
+        return [key for _, key in self.loaded_models.values()]
+
+    def vram_footprint(self) -> int:
+        """
+        The VRAM used by this user's current models, unless another user is using them too.
+        """
+        return ModelResidency().footprint(self._current_keys(), self._owner())
+
     def to_cpu(self):
         self.log_vram()
-        for model_type, model in self.loaded_models.items():
-            model_data, loaded_model = model[0], model[1]
-            self.loaded_models[model_type] = (model_data, loaded_model.to("cpu"))
+        ModelResidency().offload(self._current_keys(), self._owner())
         try:
             gc.collect()
             torch.cuda.empty_cache()
@@ -413,14 +715,11 @@ class ModelHandler:
             pass
 
     def to_gpu(self):
-        device = "cpu"
-        if torch.has_cuda:
-            device = "cuda"
-        if torch.has_mps:
-            device = "ddp"
-        for model_type, model in self.loaded_models.items():
-            model_data, loaded_model = model[0], model[1]
-            self.loaded_models[model_type] = (model_data, loaded_model.to(device))
+        for model_type in self.loaded_models:
+            model = self.get_loaded_model(model_type)
+            if model is not None:
+                self._to_device(model)
+        ModelResidency().enforce(keep=self._current_keys())
         try:
             gc.collect()
             torch.cuda.empty_cache()
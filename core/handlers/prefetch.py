@@ -0,0 +1,218 @@
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List
+
+from core.handlers.cache import CacheHandler, CachePolicy
+from core.handlers.config import ConfigHandler
+
+logger = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+READ_SIZE = 8 * 1024 * 1024
+# Weight files worth prefetching in a diffusers directory, the rest are tiny
+WEIGHT_EXTENSIONS = [".safetensors", ".bin", ".ckpt", ".pt", ".pth"]
+# Usage scores that decayed below this are forgotten
+MIN_SCORE = 0.01
+
+
+def available_memory() -> int:
+    """
+    The memory available for new allocations without swapping, or 0 if it can't be determined.
+    """
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def weight_files(model_path: str) -> List[str]:
+    if os.path.isfile(model_path):
+        return [model_path]
+    files = []
+    for dirpath, dirnames, filenames in os.walk(model_path):
+        found = [os.path.join(dirpath, f) for f in filenames if os.path.splitext(f)[1] in WEIGHT_EXTENSIONS]
+        # diffusers loads safetensors over bin if both are there
+        if any(f.endswith(".safetensors") for f in found):
+            found = [f for f in found if f.endswith(".safetensors")]
+        files.extend(found)
+    return sorted(files)
+
+
+class ModelPrefetcher:
+    """
+    Predicts which model a user is likely to load next, from how often and how recently they and everyone else
+    loaded each model, and reads its weights into the page cache in the background while the GPU is busy.
+
+    Prefetching stays within prefetch_budget_gb, is cancelled as soon as a model load starts, and stops when the
+    available memory drops below prefetch_min_free_gb. A prefetched model is prefetched again after
+    prefetch_expiry_minutes, as the kernel may have evicted its pages from the page cache since.
+
+    The global history is kept in the model_usage cache, limited to model_usage_max_entries models and
+    model_usage_ttl_days unless the cache config has a policy for it.
+    """
+    _instance = None
+    _lock = threading.Lock()
+    # (user, path) -> (score, time), and path -> (score, time) for the global history
+    _user_scores = {}
+    _global_scores = {}
+    # path -> (mtime of the files, time) when it was last prefetched
+    _prefetched = {}
+    _cancel = threading.Event()
+    _worker = None
+    enabled = True
+    budget = 0
+    min_free = 0
+    expiry = 0
+    half_life = 3600.0
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(ModelPrefetcher, cls).__new__(cls)
+            ch = ConfigHandler()
+            cls._instance.enabled = ch.get_item_protected("prefetch", "models", True)
+            cls._instance.budget = int(float(ch.get_item_protected("prefetch_budget_gb", "models", 8)) * GB)
+            cls._instance.min_free = int(float(ch.get_item_protected("prefetch_min_free_gb", "models", 4)) * GB)
+            cls._instance.expiry = float(ch.get_item_protected("prefetch_expiry_minutes", "models", 30)) * 60
+            cls._instance._user_scores = {}
+            cls._instance._global_scores = {}
+            cls._instance._prefetched = {}
+            cache_handler = CacheHandler()
+            if "model_usage" not in cache_handler.policies:
+                cache_handler.set_policy("model_usage", CachePolicy(
+                    max_entries=int(ch.get_item_protected("model_usage_max_entries", "models", 1000)),
+                    ttl=float(ch.get_item_protected("model_usage_ttl_days", "models", 30)) * 86400))
+            for path, score in cache_handler.get("model_usage").items():
+                if isinstance(score, list) and len(score) == 2:
+                    cls._instance._global_scores[path] = tuple(score)
+        return cls._instance
+
+    def _decayed(self, score: tuple, now: float) -> float:
+        value, updated = score
+        return value * 0.5 ** ((now - updated) / self.half_life)
+
+    def record(self, user: str, model_path: str, weight: float = 1.0):
+        """
+        Record that a user loaded or selected a model.
+
+        @param user: The user name, or "" for the shared handler.
+        @param model_path: The model path.
+        @param weight: How strongly this predicts the model will be loaded again, e.g. lower for just finding it.
+        """
+        now = time.time()
+        with self._lock:
+            user_score = self._decayed(self._user_scores.get((user, model_path), (0, now)), now) + weight
+            self._user_scores[(user, model_path)] = (user_score, now)
+            global_score = self._decayed(self._global_scores.get(model_path, (0, now)), now) + weight
+            self._global_scores[model_path] = (global_score, now)
+        CacheHandler().set("model_usage", model_path, [global_score, now])
+
+    def predict(self, user: str, exclude: Callable[[str], bool] = None, count: int = 3) -> List[str]:
+        """
+        Get the models a user is most likely to load next, best first.
+
+        @param user: The user name.
+        @param exclude: Optional method returning True for model paths that don't need prefetching.
+        @param count: The maximum number of models to return.
+        """
+        now = time.time()
+        scores = {}
+        with self._lock:
+            self._forget(now)
+            for path, score in self._global_scores.items():
+                scores[path] = 0.5 * self._decayed(score, now)
+            for (score_user, path), score in self._user_scores.items():
+                if score_user == user:
+                    scores[path] = scores.get(path, 0) + self._decayed(score, now)
+        candidates = [path for path in sorted(scores, key=scores.get, reverse=True)
+                      if os.path.exists(path) and (exclude is None or not exclude(path))]
+        return candidates[:count]
+
+    def _forget(self, now: float):
+        # Drop the models nobody has used in a long time. Called with the lock held.
+        for scores in [self._global_scores, self._user_scores]:
+            for key in [key for key, score in scores.items() if self._decayed(score, now) < MIN_SCORE]:
+                del scores[key]
+
+    def schedule(self, user: str, exclude: Callable[[str], bool] = None):
+        """
+        Start prefetching the models a user is likely to load next, replacing any prefetch in progress.
+        """
+        if not self.enabled or self.budget <= 0:
+            return
+        candidates = self.predict(user, exclude)
+        if not candidates:
+            return
+        self.cancel()
+        self._cancel = threading.Event()
+        self._worker = threading.Thread(target=self._prefetch, args=(candidates, self._cancel), daemon=True)
+        self._worker.start()
+
+    def cancel(self):
+        """
+        Stop any prefetch in progress, e.g. because a model is being loaded and needs the disk.
+        """
+        self._cancel.set()
+
+    def _prefetch(self, candidates: List[str], cancel: threading.Event):
+        self._expire_prefetched()
+        remaining = self.budget
+        buffer = bytearray(READ_SIZE)
+        for model_path in candidates:
+            files = weight_files(model_path)
+            try:
+                identity = {file: os.stat(file).st_mtime_ns for file in files}
+            except OSError:
+                continue
+            if self._prefetched.get(model_path, (None, 0))[0] == identity:
+                continue
+            size = sum([os.path.getsize(file) for file in files])
+            if size > remaining:
+                logger.debug(f"Not prefetching {model_path}, over the prefetch budget.")
+                continue
+            start = time.monotonic()
+            for file in files:
+                if not self._read(file, buffer, cancel):
+                    logger.debug(f"Prefetch of {model_path} cancelled.")
+                    return
+            remaining -= size
+            self._prefetched[model_path] = (identity, time.monotonic())
+            logger.debug(f"Prefetched {model_path} ({size / GB:.2f}GB) in {time.monotonic() - start:.1f}s")
+
+    def _read(self, file: str, buffer: bytearray, cancel: threading.Event) -> bool:
+        try:
+            with open(file, "rb", buffering=0) as f:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                # Network file systems often ignore the hint, so actually read it
+                while True:
+                    if cancel.is_set() or self._under_pressure():
+                        return False
+                    if not f.readinto(buffer):
+                        return True
+        except OSError as e:
+            logger.debug(f"Unable to prefetch {file}: {e}")
+            return True
+
+    def _under_pressure(self) -> bool:
+        available = available_memory()
+        return available != 0 and available < self.min_free
+
+    def _expire_prefetched(self):
+        now = time.monotonic()
+        for model_path in [path for path, (_, prefetched_at) in list(self._prefetched.items())
+                           if now - prefetched_at >= self.expiry]:
+            self._prefetched.pop(model_path, None)
+
+    def get_stats(self) -> Dict:
+        self._expire_prefetched()
+        return {
+            "prefetched": list(self._prefetched.keys()),
+            "budget": self.budget,
+            "available_memory": available_memory()
+        }
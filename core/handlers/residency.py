@@ -0,0 +1,470 @@
+import gc
+import logging
+import os
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from typing import Callable, Dict, List
+
+import torch
+
+from core.handlers.config import ConfigHandler
+from core.handlers.hashes import model_identity
+
+logger = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+
+ResidencyKey = namedtuple("ResidencyKey", ["model_type", "identity", "pipeline", "vae", "loras", "controlnets"])
+
+
+def residency_key(model_type: str, model_data) -> ResidencyKey:
+    """
+    Build the key a loaded model is cached under: the identity of the model file and everything that changes the
+    weights or modules of the resulting pipeline. The hash isn't used, it changes when the full hash replaces the
+    quick hash, which would load the same model into the pool twice.
+    """
+    data = model_data.data or {}
+    loras = tuple((lora.get("path", ""), float(data.get("lora_weight", 0.9)))
+                  for lora in data.get("loras", []) or [] if isinstance(lora, dict))
+    controlnets = data.get("controlnet_type", None) or ()
+    if isinstance(controlnets, str):
+        controlnets = (controlnets,)
+    return ResidencyKey(
+        model_type=model_type,
+        identity=model_data.path if model_data.is_url else model_identity(model_data.path),
+        pipeline=data.get("pipeline", None) or "auto",
+        vae=data.get("vae", None),
+        loras=loras,
+        controlnets=tuple(controlnets)
+    )
+
+
+def _modules(model) -> List[torch.nn.Module]:
+    if isinstance(model, torch.nn.Module):
+        return [model]
+    components = getattr(model, "components", None)
+    if isinstance(components, dict):
+        modules = []
+        for component in components.values():
+            if isinstance(component, torch.nn.Module):
+                modules.append(component)
+            elif isinstance(component, (list, tuple)):
+                modules.extend([c for c in component if isinstance(c, torch.nn.Module)])
+        return modules
+    return []
+
+
+def _module_size(module: torch.nn.Module) -> int:
+    seen = set()
+    size = 0
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        if id(tensor) not in seen:
+            seen.add(id(tensor))
+            size += tensor.numel() * tensor.element_size()
+    return size
+
+
+def _module_device(module: torch.nn.Module) -> str:
+    for param in module.parameters():
+        return param.device.type
+    return "cpu"
+
+
+def model_size(model) -> int:
+    """
+    The number of bytes used by the parameters and buffers of a model or pipeline.
+    """
+    return sum([_module_size(module) for module in _modules(model)])
+
+
+def size_on_device(model, device: str) -> int:
+    """
+    The number of bytes of a model or pipeline whose modules are on a device type, e.g. "cuda".
+    """
+    return sum([_module_size(module) for module in _modules(model) if _module_device(module) == device])
+
+
+def model_device(model) -> str:
+    for module in _modules(model):
+        for param in module.parameters():
+            return param.device.type
+    return "cpu"
+
+
+def _system_ram() -> int:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+class ComponentCache:
+    """
+    An LRU cache of loaded pipeline components, like VAEs and ControlNets, so changing one on a resident
+    pipeline only loads the component that changed, and switching back to a recent one loads nothing.
+    """
+    _instance = None
+    _components = OrderedDict()
+    _lock = threading.RLock()
+    max_components = 6
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(ComponentCache, cls).__new__(cls)
+            cls._instance._components = OrderedDict()
+            cls._instance.max_components = max(
+                0, int(ConfigHandler().get_item_protected("max_cached_components", "models", 6)))
+        return cls._instance
+
+    def get(self, kind: str, source: str, loader: Callable = None):
+        """
+        Get a component, loading it if it isn't cached.
+
+        @param kind: The component type, e.g. "vae" or "controlnet".
+        @param source: Where the component is loaded from.
+        @param loader: Called to load the component. If None, only a cached component is returned.
+        """
+        key = (kind, source)
+        with self._lock:
+            if key in self._components:
+                self._components.move_to_end(key)
+                return self._components[key]
+        if loader is None:
+            return None
+        logger.debug(f"Loading {kind}: {source}")
+        return self.put(kind, source, loader())
+
+    def put(self, kind: str, source: str, component):
+        key = (kind, source)
+        with self._lock:
+            component = self._components.setdefault(key, component)
+            self._components.move_to_end(key)
+            while len(self._components) > self.max_components:
+                self._components.popitem(last=False)
+        return component
+
+    def holds(self, module) -> bool:
+        with self._lock:
+            return any([component is module for component in self._components.values()])
+
+
+class ResidentModel:
+    def __init__(self, key: ResidencyKey, model):
+        self.key = key
+        self.model = model
+        # id -> (module, size). Pipelines built from another pipeline's components share these.
+        self.modules = {id(module): (module, _module_size(module)) for module in _modules(model)}
+        self.size = sum([size for _, size in self.modules.values()])
+        self.last_used = time.monotonic()
+        # The handlers currently using this model
+        self.users = set()
+        # The jobs running with this model, it isn't changed, moved or dropped until they finish
+        self.jobs = 0
+
+    @property
+    def pinned(self) -> bool:
+        return bool(self.users) or self.jobs > 0
+
+
+class ModelResidency:
+    """
+    A process-wide pool of loaded models, shared by every user's ModelHandler. Handlers borrow a model with
+    acquire() and give it back with release(), so users working with the same checkpoint share one copy of the
+    weights, and recently used models stay in memory so switching back to one doesn't reload it from disk.
+
+    Models are kept within a VRAM and RAM budget. When the VRAM budget is exceeded, the least recently used
+    models are moved to the CPU (or dropped, if demote_to_cpu is disabled), and when the RAM budget or the
+    maximum number of resident models is exceeded, the least recently used ones are dropped. Models that are
+    borrowed by a handler or pinned by a running job are never moved or dropped, nor are modules they share with
+    other models. A handler only borrows its current model once, jobs pin it once each for as long as they run.
+    """
+    _instance = None
+    _models = {}
+    _loading = {}
+    _lock = threading.RLock()
+    max_models = 3
+    vram_budget = 0
+    ram_budget = 0
+    demote_to_cpu = True
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(ModelResidency, cls).__new__(cls)
+            cls._instance._models = {}
+            cls._instance._loading = {}
+            cls._instance.load_config()
+        return cls._instance
+
+    def load_config(self):
+        ch = ConfigHandler()
+        self.max_models = max(1, int(ch.get_item_protected("max_resident_models", "models", 3)))
+        self.demote_to_cpu = ch.get_item_protected("demote_to_cpu", "models", True)
+        vram_gb = float(ch.get_item_protected("vram_budget_gb", "models", 0))
+        ram_gb = float(ch.get_item_protected("ram_budget_gb", "models", 0))
+        if vram_gb > 0:
+            self.vram_budget = int(vram_gb * GB)
+        elif torch.cuda.is_available():
+            # Leave room for activations while inferring
+            self.vram_budget = int(torch.cuda.get_device_properties(0).total_memory * 0.7)
+        else:
+            self.vram_budget = 0
+        self.ram_budget = int(ram_gb * GB) if ram_gb > 0 else int(_system_ram() * 0.5)
+
+    def get(self, key: ResidencyKey):
+        with self._lock:
+            resident = self._models.get(key, None)
+            if resident is None:
+                return None
+            resident.last_used = time.monotonic()
+            return resident.model
+
+    def find(self, match: Callable[[ResidencyKey], bool]):
+        """
+        Get the most recently used resident model whose key matches, e.g. to reuse its components.
+        """
+        with self._lock:
+            residents = sorted([r for r in self._models.values() if match(r.key)], key=lambda r: r.last_used)
+            return residents[-1].model if residents else None
+
+    def detach(self, match: Callable[[ResidencyKey], bool], components: List[str] = None):
+        """
+        Take the most recently used model whose key matches out of the pool, so it can be changed in place, e.g.
+        to switch its LoRAs. Models someone borrowed or a job is running with are skipped, and so are pipelines
+        sharing any of the given components with another resident model.
+
+        @return: The model, or None if none can be taken.
+        """
+        with self._lock:
+            for resident in sorted(self._models.values(), key=lambda r: r.last_used, reverse=True):
+                if resident.pinned or not match(resident.key):
+                    continue
+                changed = [getattr(resident.model, name, None) for name in components or []]
+                changed = set([id(module) for module in changed if module is not None])
+                if any([other is not resident and changed & set(other.modules.keys())
+                        for other in self._models.values()]):
+                    continue
+                del self._models[resident.key]
+                return resident.model
+            return None
+
+    def acquire(self, key: ResidencyKey, owner: str, pin: bool = False):
+        """
+        Borrow a resident model, keeping it loaded until the owner releases it.
+
+        @param key: The residency key of the model.
+        @param owner: The handler borrowing it.
+        @param pin: Also pin it for a job, until unpin() is called with the model.
+        @return: The model, or None if it isn't resident.
+        """
+        with self._lock:
+            resident = self._models.get(key, None)
+            if resident is None:
+                return None
+            resident.users.add(owner)
+            if pin:
+                resident.jobs += 1
+            resident.last_used = time.monotonic()
+            return resident.model
+
+    def unpin(self, model):
+        """
+        Unpin a model when a job using it finishes.
+        """
+        with self._lock:
+            for resident in self._models.values():
+                if resident.model is model and resident.jobs > 0:
+                    resident.jobs -= 1
+                    resident.last_used = time.monotonic()
+                    return
+
+    def release(self, key: ResidencyKey, owner: str):
+        with self._lock:
+            resident = self._models.get(key, None)
+            if resident is not None:
+                resident.users.discard(owner)
+                resident.last_used = time.monotonic()
+
+    def load_lock(self, key: ResidencyKey) -> threading.Lock:
+        """
+        Get the lock held while a model is loaded, so two handlers requesting the same model load it once.
+        """
+        with self._lock:
+            if key not in self._loading:
+                self._loading[key] = threading.Lock()
+            return self._loading[key]
+
+    def put(self, key: ResidencyKey, model, owner: str = None, pin: bool = False):
+        """
+        Add a loaded model, then evict or demote other models until everything fits in the budget again.
+
+        @param key: The residency key of the model.
+        @param model: The loaded model.
+        @param owner: Optionally borrow the model for this owner right away.
+        @param pin: Also pin it for a job, see acquire().
+        """
+        with self._lock:
+            resident = ResidentModel(key, model)
+            if owner is not None:
+                resident.users.add(owner)
+            if pin:
+                resident.jobs += 1
+            self._models[key] = resident
+            self.enforce(keep=[key])
+
+    def remove(self, key: ResidencyKey):
+        with self._lock:
+            resident = self._models.pop(key, None)
+        if resident is not None:
+            logger.debug(f"Unloading model: {key}")
+            del resident
+            self._collect()
+
+    def keys(self, model_type: str = None) -> List[ResidencyKey]:
+        with self._lock:
+            return [key for key in self._models if model_type is None or key.model_type == model_type]
+
+    def make_room(self, keep: List[ResidencyKey] = None):
+        """
+        Free memory before loading a new model, assuming it will be about as large as the largest resident one.
+        """
+        with self._lock:
+            estimate = max([resident.size for resident in self._models.values()], default=0)
+            self.enforce(keep=keep, incoming=estimate)
+
+    def enforce(self, keep: List[ResidencyKey] = None, incoming: int = 0):
+        keep = keep or []
+        freed = False
+        with self._lock:
+            pinned = [r for r in self._models.values() if r.key in keep or r.pinned]
+            # Least recently used first
+            candidates = sorted([r for r in self._models.values() if r not in pinned], key=lambda r: r.last_used)
+            protected = set()
+            for resident in pinned:
+                protected.update(resident.modules.keys())
+            if self.vram_budget:
+                for resident in candidates:
+                    if self._used("cuda") + incoming <= self.vram_budget:
+                        break
+                    if self.demote_to_cpu:
+                        for module_id, (module, _) in resident.modules.items():
+                            if module_id not in protected and _module_device(module) == "cuda":
+                                module.to("cpu")
+                                freed = True
+                        logger.debug(f"Moved model to CPU: {resident.key}")
+                    elif model_device(resident.model) == "cuda":
+                        self._drop(resident)
+                        freed = True
+            for resident in candidates:
+                if resident.key not in self._models:
+                    continue
+                # Pipelines built from the same model's components only count once
+                models = len(set([key.identity for key in self._models]))
+                over_count = models + (1 if incoming else 0) > self.max_models
+                # Without a GPU budget, incoming models are loaded into RAM
+                incoming_ram = 0 if self.vram_budget else incoming
+                over_ram = self.ram_budget and self._used("cpu") + incoming_ram > self.ram_budget
+                if not over_count and not over_ram:
+                    break
+                logger.debug(f"Evicting model: {resident.key}")
+                self._drop(resident)
+                freed = True
+            for key in [key for key, lock in self._loading.items() if key not in self._models and not lock.locked()]:
+                del self._loading[key]
+        if freed:
+            self._collect()
+
+    def _drop(self, resident: ResidentModel):
+        del self._models[resident.key]
+        in_use = set()
+        for other in self._models.values():
+            in_use.update(other.modules.keys())
+        components = ComponentCache()
+        for module_id, (module, _) in resident.modules.items():
+            if module_id in in_use:
+                continue
+            # Cached components may be wrapped, e.g. ControlNets in a MultiControlNetModel
+            for child in module.modules():
+                if components.holds(child) and _module_device(child) == "cuda":
+                    # Keep the cached component, but not in VRAM
+                    child.to("cpu")
+
+    def _used(self, device: str) -> int:
+        # Shared modules are only counted once
+        seen = set()
+        used = 0
+        for resident in self._models.values():
+            for module_id, (module, size) in resident.modules.items():
+                if module_id not in seen:
+                    seen.add(module_id)
+                    if _module_device(module) == device:
+                        used += size
+        return used
+
+    def _offloadable(self, keys: List[ResidencyKey] = None, owner: str = None):
+        # The CUDA modules of the models to offload that aren't shared with a model someone else borrowed, or
+        # with one a job is running with
+        if keys is None:
+            residents = [r for r in self._models.values() if not r.pinned]
+        else:
+            residents = [self._models[key] for key in keys if key in self._models and
+                         not (self._models[key].users - {owner}) and not self._models[key].jobs]
+        protected = set()
+        for other in self._models.values():
+            if other not in residents and other.pinned:
+                protected.update(other.modules.keys())
+        modules = {}
+        for resident in residents:
+            for module_id, (module, size) in resident.modules.items():
+                if module_id not in protected and _module_device(module) == "cuda":
+                    modules[module_id] = (module, size)
+        return modules
+
+    def footprint(self, keys: List[ResidencyKey] = None, owner: str = None) -> int:
+        """
+        The VRAM that offload() with the same arguments would free.
+        """
+        with self._lock:
+            return sum([size for _, size in self._offloadable(keys, owner).values()])
+
+    def offload(self, keys: List[ResidencyKey] = None, owner: str = None) -> int:
+        """
+        Move models to the CPU, keeping them resident. Modules that other models still use on the GPU stay there.
+
+        @param keys: The models to move, all models that aren't borrowed by default.
+        @param owner: The owner moving its own models, they aren't moved if anyone else has borrowed them.
+        @return: The bytes moved off the GPU.
+        """
+        with self._lock:
+            modules = self._offloadable(keys, owner)
+            for module, _ in modules.values():
+                module.to("cpu")
+        if modules:
+            self._collect()
+        return sum([size for _, size in modules.values()])
+
+    def to_cpu(self):
+        with self._lock:
+            for resident in self._models.values():
+                if not resident.jobs:
+                    resident.model = resident.model.to("cpu")
+        self._collect()
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                "models": [{"key": list(r.key), "size": r.size, "device": model_device(r.model),
+                            "users": len(r.users), "jobs": r.jobs}
+                           for r in sorted(self._models.values(), key=lambda r: r.last_used, reverse=True)],
+                "vram_used": self._used("cuda"),
+                "ram_used": self._used("cpu"),
+                "vram_budget": self.vram_budget,
+                "ram_budget": self.ram_budget,
+                "max_models": self.max_models
+            }
+
+    @staticmethod
+    def _collect():
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
@@ -0,0 +1,233 @@
+import hashlib
+import importlib
+import json
+import logging
+import os
+import threading
+from typing import Dict, List
+
+import torch
+from safetensors.torch import save_file
+
+from core.handlers.config import ConfigHandler
+from core.handlers.directories import DirectoryHandler
+from core.handlers.hashes import model_identity
+from core.handlers.model_types.lazy_safetensors import SafetensorsMmap, empty_model, fill_model, model_config
+
+logger = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+SNAPSHOT_EXTENSION = ".safetensors"
+
+
+def snapshot_key(model_data, torch_dtype) -> str:
+    """
+    The key a prepared pipeline is stored under: the identity of the model file, the LoRAs with their weights and
+    file versions, and the dtype the weights were cast to. The model hash isn't used, the snapshot would be orphaned
+    when the full hash replaces the quick hash.
+
+    @return: The key, or an empty string if the model isn't a local file to identify its weights by.
+    """
+    if model_data.is_url or not os.path.exists(model_data.path):
+        return ""
+    data = model_data.data or {}
+    loras = []
+    for lora in data.get("loras", []) or []:
+        if not isinstance(lora, dict) or "path" not in lora:
+            continue
+        try:
+            stat = os.stat(lora["path"])
+        except OSError:
+            return ""
+        # A LoRA replaced by a different file with the same name must not restore the old weights
+        loras.append([lora["path"], stat.st_size, stat.st_mtime_ns])
+    identity = {
+        "model": model_identity(model_data.path),
+        "loras": loras,
+        "lora_weight": float(data.get("lora_weight", 0.9)),
+        "dtype": str(torch_dtype)
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+
+def _unwrap(module):
+    # torch.compile wraps the module, the weights belong to the original
+    return getattr(module, "_orig_mod", module)
+
+
+class PipelineSnapshots:
+    """
+    A disk cache of the weights of pipelines that were modified after loading, like pipelines with LoRAs fused
+    into them, so loading the same combination again maps one file instead of repeating the work.
+
+    Each snapshot is a single safetensors file holding every modified module, with the module classes and configs
+    in its metadata. Snapshots are restored through a memory map, and the least recently used ones are removed
+    when the cache grows beyond snapshot_quota_gb.
+    """
+    _instance = None
+    _lock = threading.Lock()
+    _writing = set()
+    enabled = True
+    quota = 0
+    snapshot_dir = ""
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(PipelineSnapshots, cls).__new__(cls)
+            ch = ConfigHandler()
+            cls._instance.enabled = ch.get_item_protected("snapshot_cache", "models", True)
+            cls._instance.quota = int(float(ch.get_item_protected("snapshot_quota_gb", "models", 20)) * GB)
+            cache_dir = DirectoryHandler().get_protected_directory("cache")
+            cls._instance.snapshot_dir = os.path.join(cache_dir, "pipeline_snapshots") if cache_dir else ""
+            cls._instance._writing = set()
+            if cls._instance.snapshot_dir:
+                os.makedirs(cls._instance.snapshot_dir, exist_ok=True)
+                # Left over from snapshots that were being written when the app stopped
+                for entry in os.scandir(cls._instance.snapshot_dir):
+                    if entry.name.endswith(".tmp"):
+                        cls._remove(entry.path)
+        return cls._instance
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.snapshot_dir, key + SNAPSHOT_EXTENSION)
+
+    def load(self, key: str, torch_dtype: torch.dtype = None) -> Dict:
+        """
+        Restore the modules of a snapshot, with their weights mapped from the snapshot file.
+
+        @param key: The snapshot key.
+        @param torch_dtype: The dtype of the weights.
+        @return: Component name -> module, or an empty dict if there is no usable snapshot.
+        """
+        if not self.enabled or not key or not self.snapshot_dir:
+            return {}
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return {}
+        try:
+            snapshot = SafetensorsMmap(path)
+            components = json.loads(snapshot.metadata.get("components", "{}"))
+            modules = {}
+            for name, info in components.items():
+                component_cls = getattr(importlib.import_module(info["library"]), info["class"])
+                model = empty_model(component_cls, config=info["config"])
+                prefix = f"{name}."
+                state_dict = {tensor_name[len(prefix):]: snapshot.get_tensor(tensor_name)
+                              for tensor_name in snapshot.keys() if tensor_name.startswith(prefix)}
+                if model is None or not fill_model(model, state_dict, torch_dtype):
+                    logger.debug(f"Unable to restore {name} from snapshot {key}.")
+                    return {}
+                modules[name] = model
+        except Exception as e:
+            logger.warning(f"Unable to read pipeline snapshot {path}: {e}")
+            self._remove(path)
+            return {}
+        # The modification time is the last use, for evicting the least recently used snapshots
+        os.utime(path)
+        logger.debug(f"Restored {', '.join(modules.keys())} from snapshot {key}.")
+        return modules
+
+    def save(self, key: str, pipeline, exclude: List[str] = None):
+        """
+        Write a snapshot of the modules of a prepared pipeline in the background.
+
+        @param key: The snapshot key.
+        @param pipeline: The pipeline.
+        @param exclude: Components that weren't modified and are loaded separately, e.g. a custom VAE.
+        """
+        if not self.enabled or not key or not self.snapshot_dir or os.path.isfile(self._path(key)):
+            return
+        exclude = exclude or []
+        modules = {}
+        for name, component in getattr(pipeline, "components", {}).items():
+            if name in exclude or not isinstance(component, torch.nn.Module):
+                continue
+            module = _unwrap(component)
+            library = importlib.import_module(module.__class__.__module__.split(".")[0])
+            # Only modules that can be recreated from their config when restoring
+            if getattr(library, module.__class__.__name__, None) is not module.__class__ or \
+                    model_config(module) is None:
+                logger.debug(f"Not saving a pipeline snapshot, unable to restore {name}.")
+                return
+            modules[name] = module
+        if not modules:
+            return
+        with self._lock:
+            if key in self._writing:
+                return
+            self._writing.add(key)
+        try:
+            # Copied before writing in the background, LoRAs are changed in place on the live pipeline and the
+            # snapshot must hold the weights it was saved with
+            tensors = {}
+            components = {}
+            for name, module in modules.items():
+                components[name] = {
+                    "library": module.__class__.__module__.split(".")[0],
+                    "class": module.__class__.__name__,
+                    "config": model_config(module)
+                }
+                for tensor_name, tensor in module.state_dict().items():
+                    tensors[f"{name}.{tensor_name}"] = tensor.detach().to("cpu", copy=True).contiguous()
+        except Exception as e:
+            logger.warning(f"Unable to save pipeline snapshot {key}: {e}")
+            with self._lock:
+                self._writing.discard(key)
+            return
+        threading.Thread(target=self._write, args=(key, tensors, components), daemon=True).start()
+
+    def _write(self, key: str, tensors: Dict[str, torch.Tensor], components: Dict):
+        path = self._path(key)
+        temp_path = f"{path}.tmp"
+        try:
+            size = sum([tensor.numel() * tensor.element_size() for tensor in tensors.values()])
+            if not self._make_room(size):
+                logger.debug(f"Not saving pipeline snapshot {key}, it doesn't fit the snapshot quota.")
+                return
+            save_file(tensors, temp_path, metadata={"components": json.dumps(components, default=str)})
+            os.replace(temp_path, path)
+            logger.debug(f"Saved pipeline snapshot {key} ({size / GB:.2f}GB)")
+        except Exception as e:
+            logger.warning(f"Unable to save pipeline snapshot {key}: {e}")
+            self._remove(temp_path)
+        finally:
+            with self._lock:
+                self._writing.discard(key)
+
+    def _snapshots(self) -> List[os.DirEntry]:
+        try:
+            return [entry for entry in os.scandir(self.snapshot_dir) if entry.name.endswith(SNAPSHOT_EXTENSION)]
+        except OSError:
+            return []
+
+    def _make_room(self, size: int) -> bool:
+        """
+        Remove the least recently used snapshots until one of the given size fits the quota.
+        """
+        if size > self.quota:
+            return False
+        snapshots = sorted(self._snapshots(), key=lambda entry: entry.stat().st_mtime)
+        used = sum([entry.stat().st_size for entry in snapshots])
+        for entry in snapshots:
+            if used + size <= self.quota:
+                break
+            logger.debug(f"Removing pipeline snapshot: {entry.name}")
+            used -= entry.stat().st_size
+            # Restored pipelines keep the file mapped, removing it only unlinks it
+            self._remove(entry.path)
+        return used + size <= self.quota
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def get_stats(self) -> Dict:
+        snapshots = self._snapshots()
+        return {
+            "snapshots": len(snapshots),
+            "used": sum([entry.stat().st_size for entry in snapshots]),
+            "quota": self.quota
+        }
@@ -13,7 +13,7 @@ class BaseCaptioner:
 
     def __init__(self, config=None):
         self.config = config
-        ModelManager().register(self._to_cpu, self._to_gpu)
+        ModelManager().register(self._to_cpu, self._to_gpu, self._vram_footprint)
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self._setup()
 
@@ -32,7 +32,24 @@ class BaseCaptioner:
             except:
                 pass
 
+    def _size(self, on_gpu: bool) -> int:
+        tensors = []
+        for module in [self.model, self.processor]:
+            if isinstance(module, torch.nn.Module):
+                tensors.extend(list(module.parameters()) + list(module.buffers()))
+        return sum([t.numel() * t.element_size() for t in tensors if (t.device.type == "cuda") == on_gpu])
+
+    def _vram_footprint(self) -> int:
+        return self._size(on_gpu=True)
+
     def _to_gpu(self):
+        if self.device == "cuda":
+            # Only the least recently used models of others are moved off the GPU, and only if there isn't room
+            manager = ModelManager()
+            needed = self._size(on_gpu=False)
+            if needed:
+                manager.request(needed, owner=self)
+            manager.used(self)
         if self.model:
             try:
                 self.model = self.model.to(self.device)
@@ -1,57 +1,115 @@
+import logging
 import os
-import hashlib
-from watchdog.observers import Observer
+import threading
+import time
+
 from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+from core.handlers.catalog import ModelCatalog
+from core.handlers.models import ModelHandler
+
+logger = logging.getLogger(__name__)
 
 
 class ModelWatcher:
-    def __init__(self):
+    """
+    Watches the model directories and keeps the ModelCatalog up to date. Events are debounced per path and
+    processed in batches, so a large file being copied results in one catalog update once it stops changing.
+    """
+
+    def __init__(self, debounce: float = 2.0):
         self.directories = []
+        self.debounce = debounce
         self.observer = Observer()
-        self.handler = ModelEventHandler(self.process_changes)
+        self.handler = ModelEventHandler(self.queue_change)
+        self._changes = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._running = False
+        self._worker = None
 
     def start(self):
         for directory in self.directories:
             self.observer.schedule(self.handler, directory, recursive=True)
         self.observer.start()
-        print("ModelWatcher started.")
+        self._running = True
+        self._worker = threading.Thread(target=self._process_loop, daemon=True)
+        self._worker.start()
+        logger.info("ModelWatcher started.")
 
     def stop(self):
+        self._running = False
+        self._wake.set()
         self.observer.stop()
         self.observer.join()
-        print("ModelWatcher stopped.")
-
-    async def process_changes(self, event):
-        if event.event_type in ['created', 'modified']:
-            if event.is_directory:
-                directory_hash = self.calculate_directory_hash(event.src_path)
-                print(f"Directory modified: {event.src_path} - Hash: {directory_hash}")
-                # Trigger your desired function with the directory path and hash
+        logger.info("ModelWatcher stopped.")
+
+    def queue_change(self, path: str):
+        with self._lock:
+            # Every new event for a path pushes its deadline back
+            self._changes[path] = time.monotonic()
+        self._wake.set()
+
+    def _process_loop(self):
+        while self._running:
+            self._wake.clear()
+            with self._lock:
+                now = time.monotonic()
+                ready = [path for path, last in self._changes.items() if now - last >= self.debounce]
+                for path in ready:
+                    del self._changes[path]
+                next_due = min([last + self.debounce - now for last in self._changes.values()], default=None)
+            if ready:
+                try:
+                    self.process_changes(ready)
+                except Exception as e:
+                    logger.warning(f"Exception processing model changes: {e}")
+            if next_due is not None:
+                # Don't wake up for every event of a file that is still being written
+                time.sleep(max(next_due, 0.05))
             else:
-                file_hash = self.calculate_file_hash(event.src_path)
-                print(f"File modified: {event.src_path} - Hash: {file_hash}")
-                # Trigger your desired function with the file path and hash
-
-    def calculate_directory_hash(self, directory):
-        hasher = hashlib.sha256()
-        for root, _, files in os.walk(directory):
-            for file in files:
-                with open(os.path.join(root, file), "rb") as f:
-                    hasher.update(f.read())
-        return hasher.hexdigest()
-
-    def calculate_file_hash(self, file):
-        hasher = hashlib.sha256()
-        with open(file, "rb") as f:
-            hasher.update(f.read())
-        return hasher.hexdigest()
+                self._wake.wait()
+
+    def process_changes(self, paths):
+        """
+        Apply a batch of changed paths to the catalog and notify the model handlers that can see them.
+        """
+        catalog = ModelCatalog()
+        grouped = {}
+        for path in paths:
+            located = self._locate(path)
+            if located is not None:
+                grouped.setdefault(located, []).append(path)
+
+        for (root, model_type), changed in grouped.items():
+            changes = catalog.apply_changes(root, model_type, changed)
+            if not any(changes.values()):
+                continue
+            logger.debug(f"Model changes ({model_type}): {changes}")
+            handlers = [ModelHandler()] + list(ModelHandler._instances.values())
+            for handler in handlers:
+                if handler is not None and root in handler.models_path:
+                    handler.refresh(model_type, changes=changes, rescan=False)
+
+    def _locate(self, path: str):
+        for directory in self.directories:
+            if path.startswith(directory + os.path.sep):
+                parts = os.path.relpath(path, directory).split(os.path.sep)
+                # Hidden directories hold things like partial downloads
+                if parts[0].startswith("."):
+                    return None
+                # Ignore anything sitting directly in the models root
+                if len(parts) > 1 or os.path.isdir(path):
+                    return directory, parts[0]
+        return None
 
     def register_directory(self, directory):
         if directory not in self.directories:
             self.directories.append(directory)
             if self.observer.is_alive():
                 self.observer.schedule(self.handler, directory, recursive=True)
-                print(f"New directory registered: {directory}")
+                logger.debug(f"New directory registered: {directory}")
 
 
 class ModelEventHandler(FileSystemEventHandler):
@@ -59,4 +117,9 @@ class ModelEventHandler(FileSystemEventHandler):
         self.callback = callback
 
     def on_any_event(self, event):
-        self.callback(event)
+        if event.event_type in ["opened", "closed_no_write"]:
+            return
+        self.callback(event.src_path)
+        dest_path = getattr(event, "dest_path", "")
+        if dest_path:
+            self.callback(dest_path)
@@ -3,13 +3,16 @@ import logging
 import os.path
 from typing import Dict
 
-import requests
 import torch
 from fastapi import FastAPI, Query
 from huggingface_hub import snapshot_download
 from starlette.responses import JSONResponse
 
 from core.dataclasses.model_data import ModelData
+from core.handlers.conversions import ConversionCache
+from core.handlers.dedupe import ModelDeduplicator
+from core.handlers.downloads import DownloadManager, MB
+from core.handlers.hashes import hash_file
 from core.handlers.models import ModelHandler
 from core.handlers.status import StatusHandler
 from core.handlers.websocket import SocketHandler
@@ -57,6 +60,7 @@ async def _extract_lora(request):
 async def _download_model(request):
     user = request["user"] if "user" in request else None
     mh = ModelHandler(user_name=user)
+    sh = StatusHandler(user_name=user)
     data = request["data"]
     model_url = data["url"]
     model_type = data["model_type"]
@@ -66,6 +70,8 @@ async def _download_model(request):
         if "http" in model_url:
             model_name = model_name.split(".")[0]
     models_dir = os.path.join(mh.models_path[1], model_type)
+    # Hidden from the model watcher, and on the same file system so finished downloads can be moved into place
+    staging_dir = os.path.join(mh.models_path[1], ".downloads")
     if not os.path.exists(models_dir):
         os.makedirs(models_dir)
 
@@ -75,6 +81,7 @@ async def _download_model(request):
 
     dest_folder = os.path.join(models_dir, model_name)
     output_path = dest_folder
+    sh.start(desc=f"Downloading {model_name}")
     if from_hub:
         repo_id = model_url
         include_files = ["*.safetensors", "*.bin", "*.ckpt", "*.json", "*.txt", "*.yaml", "*.yml"]
@@ -83,32 +90,46 @@ async def _download_model(request):
             include_files = ["*.safetensors", "*.json", "*.txt", "*.yaml", "*.yml"]
             exclude_files = ["*-pruned.ckpt", "*-pruned.safetensors", "README.md", ".gitattributes", "*.bin",
                              "*.ckpt"]
-        snapshot_download(repo_id, revision=None, repo_type="model", cache_dir=None, local_dir=dest_folder,
-                          local_dir_use_symlinks=False, allow_patterns=include_files, ignore_patterns=exclude_files)
-    else:
+        # A new model is downloaded next to the models and moved in when complete, an existing one is updated
+        local_dir = dest_folder if os.path.exists(dest_folder) else os.path.join(staging_dir, model_name)
+
+        def download_snapshot():
+            with DownloadManager().slot:
+                snapshot_download(repo_id, revision=None, repo_type="model", cache_dir=None, local_dir=local_dir,
+                                  local_dir_use_symlinks=False, allow_patterns=include_files,
+                                  ignore_patterns=exclude_files)
+            if local_dir != dest_folder:
+                os.replace(local_dir, dest_folder)
+
         try:
-            # Download the file from the URL?
-            filename = model_url.split('/')[-1].replace(" ", "_")  # be careful with file names
-            file_path = os.path.join(dest_folder, filename)
-            output_path = os.path.abspath(file_path)
-            r = requests.get(model_url, stream=True)
-            if r.ok:
-                logger.debug("saving to", os.path.abspath(file_path))
-                with open(file_path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=1024 * 8):
-                        if chunk:
-                            f.write(chunk)
-                            f.flush()
-                            os.fsync(f.fileno())
-            else:  # HTTP status code 4XX/5XX
-                logger.debug("Download failed: status code {}\n{}".format(r.status_code, r.text))
-                output_path = None
-        except:
-            logger.debug("Download failed: {}".format(model_url))
+            await asyncio.to_thread(download_snapshot)
+        except Exception as e:
+            logger.warning(f"Download failed: {model_url}: {e}")
             output_path = None
+    else:
+        filename = model_url.split('/')[-1].replace(" ", "_")  # be careful with file names
+
+        def progress(current, total):
+            items = {"status": f"Downloading {filename}: {current // MB}MB"}
+            if total:
+                items.update({"progress_1_total": total // MB, "progress_1_current": current // MB})
+            sh.update(items=items)
+
+        output_path = await DownloadManager().download_async(
+            model_url, os.path.join(dest_folder, filename), staging_dir=staging_dir, sha256=data.get("sha256", None),
+            progress=progress)
 
     if output_path:
+        sh.end(f"Downloaded {model_name}.")
         mh.refresh(model_type, to_load=dest_folder)
+    else:
+        sh.end(f"Download failed: {model_name}")
+
+
+async def _dedupe_models(request):
+    data = request.get("data", {}) or {}
+    report = await asyncio.to_thread(ModelDeduplicator().deduplicate, dry_run=data.get("dry_run", False))
+    return {"name": "dedupe_models", "report": report}
 
 
 class ImportExportModule(BaseModule):
@@ -141,6 +162,7 @@ class ImportExportModule(BaseModule):
         handler.register("download_model", _download_model)
         handler.register("extract_lora", _extract_lora)
         handler.register("merge_checkpoints", _merge_checkpoints)
+        handler.register("dedupe_models", _dedupe_models)
 
 
 async def _import_model(data):
@@ -183,6 +205,11 @@ async def _import_model(data):
         "status_handler": sh,
         "prediction_type": "epsilon" if is_512 else "v_prediction"
     }
-    await asyncio.to_thread(extract_checkpoint, **extract_args)
+    # Everything except the source and destination changes the converted weights
+    params = {key: value for key, value in extract_args.items()
+              if key not in ["checkpoint_path", "dump_path", "status_handler"]}
+    params["original_config_file"] = hash_file(config_file) if config_file else None
+    await asyncio.to_thread(ConversionCache().convert, model_path, dest_dir, params,
+                            lambda dump_path: extract_checkpoint(**{**extract_args, "dump_path": dump_path}))
     mh.refresh("diffusers", model_dest, model_name=model_name)
     return {"name": "extraction_started", "message": "Extraction started.", "id": msg_id}
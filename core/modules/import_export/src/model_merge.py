@@ -5,9 +5,10 @@ import shutil
 
 import torch
 import tqdm
-from safetensors.torch import load_file, save_file
+from safetensors.torch import save_file
 
 from core.dataclasses.model_data import ModelData
+from core.handlers.model_types.lazy_safetensors import load_file
 from core.handlers.models import ModelHandler
 from core.handlers.status import StatusHandler
 
@@ -105,8 +106,8 @@ class ModelMerge:
             logger.debug(f"Loading {secondary_model.display_name}...")
             theta_1_unet_path = os.path.join(secondary_model.path, "unet", "diffusion_pytorch_model.safetensors")
             theta_1_tenc_path = os.path.join(secondary_model.path, "text_encoder", "model.safetensors")
-            theta_1_unet = load_file(theta_1_unet_path, device='cpu')
-            theta_1_tenc = load_file(theta_1_tenc_path, device='cpu')
+            theta_1_unet = load_file(theta_1_unet_path)
+            theta_1_tenc = load_file(theta_1_tenc_path)
         else:
             theta_1_unet = None
             theta_1_tenc = None
@@ -116,8 +117,8 @@ class ModelMerge:
             logger.debug(f"Loading {tertiary_model.display_name}...")
             theta_2_unet_path = os.path.join(tertiary_model.path, "unet", "diffusion_pytorch_model.safetensors")
             theta_2_tenc_path = os.path.join(tertiary_model.path, "text_encoder", "model.safetensors")
-            theta_2_unet = load_file(theta_2_unet_path, device='cpu')
-            theta_2_tenc = load_file(theta_2_tenc_path, device='cpu')
+            theta_2_unet = load_file(theta_2_unet_path)
+            theta_2_tenc = load_file(theta_2_tenc_path)
             total_keys = len(theta_2_unet.keys()) + len(theta_2_tenc.keys())
             self.status_handler.update(
                 items={"status": "Merging B and C", "progress_1_total": total_keys, "progress_1_current": 0})
@@ -139,8 +140,8 @@ class ModelMerge:
         self.status_handler.update("status", f"Loading {primary_model.display_name}...")
         theta_0_unet_path = os.path.join(primary_model.path, "unet", "diffusion_pytorch_model.safetensors")
         theta_0_tenc_path = os.path.join(primary_model.path, "text_encoder", "model.safetensors")
-        theta_0_unet = load_file(theta_0_unet_path, device='cpu')
-        theta_0_tenc = load_file(theta_0_tenc_path, device='cpu')
+        theta_0_unet = load_file(theta_0_unet_path)
+        theta_0_tenc = load_file(theta_0_tenc_path)
 
         logger.debug("Merging...")
         total_keys = len(theta_0_unet.keys()) + len(theta_0_tenc.keys())
@@ -41,6 +41,7 @@ let inferSettings = {
     prompt: "",
     prompts: [],
     scale: 7.5,
+    scheduler: "",
     seed: -1,
     steps: 30,
     use_control_resolution: true,
@@ -283,6 +284,18 @@ function inferInit() {
         }
     });
 
+    sendMessage("get_schedulers", {}, true).then((data) => {
+        console.log("Schedulers: ", data);
+        let schedulerSelect = document.getElementById("infer_scheduler");
+        for (let i = 0; i < data["schedulers"].length; i++) {
+            let option = document.createElement("option");
+            option.value = data["schedulers"][i];
+            option.text = data["schedulers"][i];
+            option.selected = option.value === data["default"];
+            schedulerSelect.add(option);
+        }
+    });
+
     $("#infer_prompt2prompt").hide();
     $("#controlnetSettings").hide();
     $("#infer_pipeline").change(function () {
@@ -668,6 +681,7 @@ function getInferSettings() {
     inferSettings.vae = vaeModelSelect.getModel();
     inferSettings.prompt = promptEl.value;
     inferSettings.pipeline = $("#infer_pipeline").val();
+    inferSettings.scheduler = $("#infer_scheduler").val() || "";
     inferSettings.negative_prompt = negEl.value;
     inferSettings.seed = parseInt(seedEl.value);
     inferSettings.scale = scaleTest.value;
@@ -8,6 +8,7 @@ from starlette.responses import JSONResponse
 from core.dataclasses.infer_data import InferSettings
 from core.handlers.model_types.controlnet_processors import model_data
 from core.handlers.model_types.diffusers_loader import get_pipeline_parameters
+from core.handlers.model_types.schedulers import DEFAULT_SCHEDULER, list_schedulers
 from core.handlers.websocket import SocketHandler
 from core.modules.base.module_base import BaseModule
 from core.modules.infer.src.infer_utils import start_inference
@@ -64,6 +65,7 @@ class InferenceModule(BaseModule):
         handler.register("get_controlnets", _get_controlnets)
         handler.register("mask_image", _mask_image)
         handler.register("get_pipelines", _get_pipelines)
+        handler.register("get_schedulers", _get_schedulers)
 
 
 async def _start_inference(msg):
@@ -124,6 +126,19 @@ async def _get_pipelines(msg):
     return {"pipelines": diffusers_data}
 
 
+async def _get_schedulers(msg):
+    """
+    Returns a dictionary containing the available schedulers.
+
+    Args:
+        msg (dict): A dictionary containing the message.
+
+    Returns:
+        dict: A dictionary with the scheduler names in the "schedulers" key and the default in the "default" key.
+    """
+    return {"schedulers": list_schedulers(), "default": DEFAULT_SCHEDULER}
+
+
 async def _mask_image(msg):
     """
     Masks the input image based on the objects detected.
@@ -17,6 +17,7 @@ from core.handlers.config import ConfigHandler
 from core.handlers.images import ImageHandler, scale_image
 from core.handlers.model_types.controlnet_processors import model_data as controlnet_data, preprocess_image
 from core.handlers.model_types.diffusers_loader import get_pipeline_parameters
+from core.handlers.model_types.schedulers import with_scheduler
 from core.handlers.models import ModelHandler
 from core.handlers.status import StatusHandler
 from core.handlers.websocket import SocketHandler
@@ -25,11 +26,10 @@ from core.modules.dreambooth.helpers.mytqdm import mytqdm
 socket_handler = SocketHandler()
 logger = logging.getLogger(__name__)
 preview_steps = 5
-pipeline = None
 
 
 async def start_inference(inference_settings: InferSettings, user, target: str = None):
-    global pipeline, preview_steps
+    global preview_steps
     model_handler = ModelHandler(user_name=user)
     status_handler = StatusHandler(user_name=user, target=target)
     image_handler = ImageHandler(user_name=user)
@@ -180,28 +180,33 @@ async def start_inference(inference_settings: InferSettings, user, target: str =
             logger.debug(f"Unable to parse VAE JSON: {e}")
     logger.debug("Sent")
 
-    pipeline = model_handler.load_model("diffusers", model_data)
+    # Pinned until the images are done, so another request can't change or move it while it is in use
+    resident_pipeline = await model_handler.load_model_async("diffusers", model_data, status_handler=status_handler,
+                                                             pin=True)
 
-    if not pipeline:
+    if not resident_pipeline:
         logger.warning("No model selected.")
         status_handler.update("status", "Unable to load inference pipeline.")
         return [], []
 
-    compel_proc = Compel(tokenizer=pipeline.tokenizer, text_encoder=pipeline.text_encoder, truncate_long_prompts=False)
-    input_prompts = [val for val in input_prompts for _ in range(inference_settings.num_images)]
-    negative_prompts = [val for val in negative_prompts for _ in range(inference_settings.num_images)]
-
-    if len(control_images) and "ControlNet" in inference_settings.pipeline:
-        ui_height = 0
-        ui_width = 0
-        control_images = [val for val in control_images for _ in range(inference_settings.num_images)]
-
-    total_images = len(input_prompts)
-    logger.debug(f"Input prompts: {input_prompts}")
     out_images = []
     out_prompts = []
     used_controls = []
     try:
+        # The loaded pipeline may be shared with other jobs, so use a copy with its own scheduler
+        pipeline = with_scheduler(resident_pipeline, inference_settings.scheduler)
+
+        compel_proc = Compel(tokenizer=pipeline.tokenizer, text_encoder=pipeline.text_encoder, truncate_long_prompts=False)
+        input_prompts = [val for val in input_prompts for _ in range(inference_settings.num_images)]
+        negative_prompts = [val for val in negative_prompts for _ in range(inference_settings.num_images)]
+
+        if len(control_images) and "ControlNet" in inference_settings.pipeline:
+            ui_height = 0
+            ui_width = 0
+            control_images = [val for val in control_images for _ in range(inference_settings.num_images)]
+
+        total_images = len(input_prompts)
+        logger.debug(f"Input prompts: {input_prompts}")
         status_handler.update(
             items={
                 "status": f"Generating {len(out_images) + (1 * inference_settings.batch_size)}/{total_images} images."})
@@ -421,6 +426,8 @@ async def start_inference(inference_settings: InferSettings, user, target: str =
     except Exception as e:
         logger.error(f"Exception inferring: {e}")
         traceback.print_exc()
+    finally:
+        model_handler.unpin_model(resident_pipeline)
 
     if len(used_controls) > 0:
         out_images.extend(used_controls)
@@ -9,7 +9,6 @@ from PIL import Image
 from fastapi import FastAPI
 
 from core.handlers.file import FileHandler
-from core.handlers.models import ModelManager
 from core.handlers.status import StatusHandler
 from core.handlers.websocket import SocketHandler
 from core.helpers.captioners.blip2 import Blip2Captioner
@@ -28,7 +27,6 @@ class TaggerModule(BaseModule):
         self.name: str = "Tagger"
         self.path = os.path.abspath(os.path.dirname(__file__))
         super().__init__(self.id, self.name, self.path)
-        mm = ModelManager()
 
     def initialize(self, app: FastAPI, handler: SocketHandler):
         self._initialize_websocket(handler)
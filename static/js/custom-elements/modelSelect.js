@@ -1,6 +1,7 @@
 class ModelSelect {
     constructor(container, options) {
         registerSocketMethod(container, "reload_models", this.modelSocketUpdate.bind(this));
+        registerSocketMethod(container, "model_hash", this.modelHashUpdate.bind(this));
         this.container = container;
         this.model_type = options.model_type;
         this.ext_include = options.ext_include;
@@ -120,6 +121,33 @@ class ModelSelect {
         }
     }
 
+    modelHashUpdate(data) {
+        // Swap a quick hash for the full hash once it has been calculated
+        const quickHash = data["quick_hash"];
+        const fullHash = data["hash"];
+        if (!quickHash || !fullHash || !this.modelList.models) {
+            return;
+        }
+        const model = this.modelList.models.find(model => model.hash === quickHash);
+        if (!model) {
+            return;
+        }
+        model.hash = fullHash;
+        model.display_name = model.name + " [" + fullHash.substring(0, 6) + "]";
+        for (let i = 0; i < this.selectElement.options.length; i++) {
+            const option = this.selectElement.options[i];
+            if (option.value === quickHash) {
+                option.value = fullHash;
+                option.textContent = model.display_name;
+            }
+        }
+        if (Array.isArray(this.value)) {
+            this.value = this.value.map(value => value === quickHash ? fullHash : value);
+        } else if (this.value === quickHash) {
+            this.value = fullHash;
+        }
+    }
+
     async refresh() {
         // Display "Loading..." in the select element
         this.selectElement.innerHTML = '<option value="" selected>Loading...</option>';
@@ -0,0 +1,38 @@
+import os
+import tempfile
+
+import pytest
+
+from core.handlers.config import ConfigHandler
+from core.handlers.directories import DirectoryHandler
+
+app_path = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+@pytest.fixture(scope="session", autouse=True)
+def directories():
+    """
+    Point the shared and protected directories at a temporary directory, so tests never touch real data.
+
+    @return: The temporary directory.
+    """
+    temp_dir = tempfile.mkdtemp()
+    DirectoryHandler(app_path, {
+        "shared_dir": os.path.join(temp_dir, "data_shared"),
+        "protected_dir": os.path.join(temp_dir, "data_protected")
+    })
+    ConfigHandler()
+    return temp_dir
+
+
+@pytest.fixture
+def write_file():
+    """
+    Write a file, creating its directory if needed.
+    """
+    def write(path, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+    return write
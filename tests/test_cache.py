@@ -0,0 +1,106 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+from core.handlers.cache import CacheHandler, CachePolicy, JsonCacheBackend, SqliteCacheBackend
+
+
+def test_write_behind():
+    cache_dir = tempfile.mkdtemp()
+    backend = JsonCacheBackend(cache_dir, flush_interval=60)
+    cache_file = os.path.join(cache_dir, "model_hash.json")
+    for i in range(10):
+        backend.set("model_hash", f"key_{i}", f"value_{i}")
+    assert not os.path.exists(cache_file)
+    assert backend.get("model_hash", "key_3") == "value_3"
+
+    backend.flush()
+    with open(cache_file, "r") as f:
+        assert json.load(f)["key_9"] == "value_9"
+    assert not [f for f in os.listdir(cache_dir) if f.endswith(".tmp")]
+
+
+def test_sqlite_migrates_json():
+    cache_dir = tempfile.mkdtemp()
+    with open(os.path.join(cache_dir, "model_hash.json"), "w") as f:
+        json.dump({"/models/a.safetensors": "abc"}, f)
+    backend = SqliteCacheBackend(cache_dir)
+    assert backend.get("model_hash", "/models/a.safetensors") == "abc"
+
+    # A second instance must not re-import over newer values
+    backend.set("model_hash", "/models/a.safetensors", "def")
+    assert SqliteCacheBackend(cache_dir).get("model_hash", "/models/a.safetensors") == "def"
+
+
+def test_sqlite_threads():
+    backend = SqliteCacheBackend(tempfile.mkdtemp())
+
+    def worker(idx):
+        for i in range(50):
+            backend.set("directory_hash", f"{idx}_{i}", i)
+
+    threads = [threading.Thread(target=worker, args=(idx,)) for idx in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(backend.get_all("directory_hash")) == 200
+
+
+def test_handler():
+    cache_handler = CacheHandler()
+    cache_handler.set("test_handler", "key", "value")
+    assert cache_handler.get("test_handler", "key") == "value"
+    assert cache_handler.get("test_handler") == {"key": "value"}
+
+
+def test_policy_eviction():
+    cache_handler = CacheHandler()
+    cache_handler.set_policy("test_lru", CachePolicy(max_entries=2))
+    cache_handler.set("test_lru", "a", 1)
+    cache_handler.set("test_lru", "b", 2)
+    assert cache_handler.get("test_lru", "a") == 1
+    cache_handler.set("test_lru", "c", 3)
+    assert cache_handler.get("test_lru", "b") is None
+    assert cache_handler.get("test_lru", "a") == 1
+    stats = cache_handler.get_stats("test_lru")["test_lru"]
+    assert stats["evictions"] == 1
+    assert stats["hits"] == 2
+    assert stats["misses"] == 1
+
+
+def test_policy_max_bytes():
+    cache_handler = CacheHandler()
+    cache_handler.set_policy("test_bytes", CachePolicy(max_bytes=25))
+    cache_handler.set("test_bytes", "a", "x" * 8)
+    cache_handler.set("test_bytes", "b", "x" * 8)
+    # Replacing an entry only counts its new size
+    cache_handler.set("test_bytes", "a", "x" * 4)
+    assert cache_handler.get_stats("test_bytes")["test_bytes"]["bytes"] == 16
+    cache_handler.set("test_bytes", "c", "x" * 8)
+    assert cache_handler.get("test_bytes", "b") is None
+    assert cache_handler.get("test_bytes", "a") == "x" * 4
+    assert cache_handler.get_stats("test_bytes")["test_bytes"]["bytes"] == 16
+
+
+def test_policy_ttl():
+    cache_handler = CacheHandler()
+    cache_handler.set_policy("test_ttl", CachePolicy(ttl=0.05))
+    cache_handler.set("test_ttl", "key", "value")
+    assert cache_handler.get("test_ttl", "key") == "value"
+    time.sleep(0.1)
+    assert cache_handler.get("test_ttl", "key") is None
+    assert cache_handler.get_stats("test_ttl")["test_ttl"]["expired"] == 1
+
+
+def test_policy_ttl_uses_stored_time():
+    cache_handler = CacheHandler()
+    # Written before a restart, by this or another process
+    cache_handler.backend.set("test_stored_ttl", "old", "value", stored_at=time.time() - 60)
+    cache_handler.backend.set("test_stored_ttl", "new", "value")
+    cache_handler.set_policy("test_stored_ttl", CachePolicy(ttl=30))
+    assert cache_handler.get("test_stored_ttl", "old") is None
+    assert cache_handler.get("test_stored_ttl", "new") == "value"
+    assert SqliteCacheBackend(cache_handler.cache_dir).get_entry("test_stored_ttl", "new")[1] > time.time() - 30
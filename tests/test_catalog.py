@@ -0,0 +1,78 @@
+import os
+import tempfile
+
+import pytest
+
+from core.handlers.cache import CacheHandler
+from core.handlers.catalog import ModelCatalog
+from core.handlers.hashes import HashHandler
+
+
+@pytest.fixture
+def submitted(monkeypatch):
+    # The paths queued for full hashing, without starting the background hashing
+    paths = []
+    monkeypatch.setattr(HashHandler, "submit", lambda self, path, quick: paths.append(path))
+    return paths
+
+
+def _root(write_file):
+    root = os.path.join(tempfile.mkdtemp(), "models")
+    write_file(os.path.join(root, "loras", "style.safetensors"), os.urandom(1024))
+    write_file(os.path.join(root, "diffusers", "model", "model_index.json"), b"{}")
+    write_file(os.path.join(root, "diffusers", "model", "unet", "model.safetensors"), os.urandom(1024))
+    return root
+
+
+def test_scan_lists_models(write_file, submitted):
+    root = _root(write_file)
+    catalog = ModelCatalog()
+    loras = catalog.get_entries("loras", [root])
+    assert [entry["path"] for entry in loras] == [os.path.join(root, "loras", "style.safetensors")]
+    assert loras[0]["quick_hash"] and loras[0]["hash"] is None
+    # A diffusers model is one entry for its directory
+    models = catalog.get_entries("diffusers", [root])
+    assert [(entry["path"], entry["is_dir"]) for entry in models] == [(os.path.join(root, "diffusers", "model"), True)]
+    assert sorted(submitted) == sorted([loras[0]["path"], models[0]["path"]])
+
+
+def test_apply_changes(write_file, submitted):
+    root = _root(write_file)
+    catalog = ModelCatalog()
+    catalog.get_entries("loras", [root])
+    style = os.path.join(root, "loras", "style.safetensors")
+    added = write_file(os.path.join(root, "loras", "new.safetensors"), os.urandom(1024))
+    write_file(style, os.urandom(2048))
+    assert catalog.apply_changes(root, "loras", [added, style]) == {"added": [added], "updated": [style],
+                                                                   "removed": []}
+    os.remove(added)
+    assert catalog.apply_changes(root, "loras", [added]) == {"added": [], "updated": [], "removed": [added]}
+    assert catalog.get_entry(added) is None
+
+
+def test_resubmits_unfinished_hashes(write_file, submitted):
+    root = _root(write_file)
+    catalog = ModelCatalog()
+    path = catalog.get_entries("loras", [root])[0]["path"]
+    # The app stopped before the full hash was calculated
+    ModelCatalog._instance = None
+    submitted.clear()
+    catalog = ModelCatalog()
+    assert path in submitted
+    # An unchanged model is resubmitted by a rescan too, the HashHandler skips ones that are already queued
+    submitted.clear()
+    catalog.get_entries("loras", [root], refresh=True)
+    assert submitted == [path]
+
+
+def test_full_hash_replaces_quick_hash(write_file, submitted):
+    root = _root(write_file)
+    catalog = ModelCatalog()
+    entry = catalog.get_entries("loras", [root])[0]
+    catalog._on_hash(entry["path"], entry["quick_hash"], "f" * 64)
+    assert catalog.get_entry(entry["path"])["hash"] == "f" * 64
+    assert CacheHandler().get("model_catalog", entry["path"])["hash"] == "f" * 64
+    # Known now, so it isn't submitted again
+    submitted.clear()
+    catalog.get_entries("loras", [root], refresh=True)
+    assert submitted == []
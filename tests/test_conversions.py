@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+
+from core.handlers.conversions import ConversionCache, MODEL_INDEX
+
+
+class Converter:
+    """
+    Writes a fake diffusers model, recording each conversion.
+    """
+
+    def __init__(self):
+        self.converted = []
+
+    def __call__(self, dest_path):
+        self.converted.append(dest_path)
+        os.makedirs(os.path.join(dest_path, "unet"), exist_ok=True)
+        with open(os.path.join(dest_path, "unet", "model.safetensors"), "w") as f:
+            f.write(str(len(self.converted)))
+        with open(os.path.join(dest_path, MODEL_INDEX), "w") as f:
+            f.write("{}")
+
+
+def _output(model_path):
+    with open(os.path.join(model_path, "unet", "model.safetensors"), "r") as f:
+        return f.read()
+
+
+def test_reuses_conversion_of_copies(write_file):
+    checkpoint = write_file(os.path.join(tempfile.mkdtemp(), "model.safetensors"), os.urandom(4096))
+    copy = os.path.join(tempfile.mkdtemp(), "renamed.safetensors")
+    shutil.copy(checkpoint, copy)
+    dest = os.path.join(tempfile.mkdtemp(), "diffusers")
+    converter = Converter()
+    params = {"extract_ema": True}
+    first = ConversionCache().convert(checkpoint, os.path.join(dest, "model"), params, converter)
+    assert first == os.path.join(dest, "model")
+    assert ConversionCache().convert(checkpoint, first, params, converter) == first
+    # A copy of the same checkpoint elsewhere is linked, not converted
+    second = ConversionCache().convert(copy, os.path.join(dest, "renamed"), params, converter)
+    assert second == os.path.join(dest, "renamed")
+    assert len(converter.converted) == 1 and _output(second) == "1"
+    # Other parameters change the output
+    ConversionCache().convert(checkpoint, os.path.join(dest, "no_ema"), {"extract_ema": False}, converter)
+    assert len(converter.converted) == 2
+
+
+def test_converts_again_when_checkpoint_changes(write_file):
+    checkpoint = write_file(os.path.join(tempfile.mkdtemp(), "model.safetensors"), os.urandom(4096))
+    dest = os.path.join(tempfile.mkdtemp(), "diffusers", "model")
+    converter = Converter()
+    ConversionCache().convert(checkpoint, dest, {}, converter)
+    # Replaced by a different checkpoint with the same name
+    write_file(checkpoint, os.urandom(4096))
+    assert ConversionCache().convert(checkpoint, dest, {}, converter) == dest
+    assert len(converter.converted) == 2 and _output(dest) == "2"
+
+
+def test_replaces_unknown_model_at_destination(write_file):
+    checkpoint = write_file(os.path.join(tempfile.mkdtemp(), "model.safetensors"), os.urandom(4096))
+    dest = os.path.join(tempfile.mkdtemp(), "diffusers", "model")
+    # Not recorded as a conversion of this checkpoint, e.g. of another one that had the same name
+    write_file(os.path.join(dest, MODEL_INDEX), b"{}")
+    write_file(os.path.join(dest, "unet", "model.safetensors"), b"old")
+    converter = Converter()
+    assert ConversionCache().convert(checkpoint, dest, {}, converter) == dest
+    assert len(converter.converted) == 1 and _output(dest) == "1"
+    assert sorted(os.listdir(os.path.dirname(dest))) == ["model"]
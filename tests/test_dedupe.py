@@ -0,0 +1,34 @@
+import os
+import tempfile
+
+from core.handlers.dedupe import ModelDeduplicator
+
+
+def test_deduplicate_links_identical_files(write_file):
+    shared = os.path.join(tempfile.mkdtemp(), "models")
+    user = os.path.join(tempfile.mkdtemp(), "models")
+    data = os.urandom(64 * 1024)
+    write_file(os.path.join(shared, "loras", "style.safetensors"), data)
+    write_file(os.path.join(user, "loras", "style copy.safetensors"), data)
+    write_file(os.path.join(user, "diffusers", "model", "unet", "diffusion_pytorch_model.safetensors"), data)
+    # Same size, different content
+    write_file(os.path.join(user, "loras", "other.safetensors"), os.urandom(64 * 1024))
+    # Rewritten in place by training, never linked
+    write_file(os.path.join(user, "dreambooth", "model", "working", "model.safetensors"), data)
+
+    dedupe = ModelDeduplicator()
+    dedupe.min_size = 1024
+    dedupe.method = "hardlink"
+    report = dedupe.deduplicate(roots=[shared, user], dry_run=True)
+    assert report["linked"] == 2 and report["reclaimed"] == 2 * len(data)
+    assert os.stat(os.path.join(shared, "loras", "style.safetensors")).st_nlink == 1
+
+    report = dedupe.deduplicate(roots=[shared, user])
+    assert report["groups"] == 1 and report["linked"] == 2 and report["reclaimed"] == 2 * len(data)
+    assert os.stat(os.path.join(shared, "loras", "style.safetensors")).st_nlink == 3
+    assert os.stat(os.path.join(user, "loras", "other.safetensors")).st_nlink == 1
+    assert os.stat(os.path.join(user, "dreambooth", "model", "working", "model.safetensors")).st_nlink == 1
+    with open(os.path.join(user, "loras", "style copy.safetensors"), "rb") as f:
+        assert f.read() == data
+
+    assert dedupe.deduplicate(roots=[shared, user])["linked"] == 0
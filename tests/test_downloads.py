@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from core.handlers.downloads import DownloadManager, PART_EXTENSION
+
+DATA = os.urandom(5 * 1024 * 1024 + 123)
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    served = []
+
+    def do_GET(self):
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(DATA) - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(DATA)}")
+        else:
+            start, end = 0, len(DATA) - 1
+            self.send_response(200)
+        body = DATA[start:end + 1]
+        self.served.append(len(body))
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/model.safetensors"
+
+
+def _manager():
+    manager = DownloadManager()
+    manager.segments = 4
+    manager.min_segment = 1024 * 1024
+    return manager
+
+
+def test_parallel_download():
+    server, url = _serve()
+    RangeHandler.served.clear()
+    dest = os.path.join(tempfile.mkdtemp(), "models", "model.safetensors")
+    staging = os.path.join(os.path.dirname(dest), ".downloads")
+    progress = []
+    result = _manager().download(url, dest, staging_dir=staging, sha256=hashlib.sha256(DATA).hexdigest(),
+                                 progress=lambda current, total: progress.append((current, total)))
+    server.shutdown()
+    assert result == dest
+    with open(dest, "rb") as f:
+        assert f.read() == DATA
+    # The probe, then one request per segment
+    assert len(RangeHandler.served) == 5
+    assert progress[-1] == (len(DATA), len(DATA))
+    assert os.listdir(staging) == []
+    assert _manager()._active == {}
+
+
+def test_resume_download():
+    server, url = _serve()
+    manager = _manager()
+    dest = os.path.join(tempfile.mkdtemp(), "model.safetensors")
+    staging = tempfile.mkdtemp()
+    name = hashlib.sha1(f"{url}\0{os.path.abspath(dest)}".encode()).hexdigest()[:16]
+    part_path = os.path.join(staging, name + PART_EXTENSION)
+    # An interrupted download: the first half of the only segment was written
+    half = len(DATA) // 2
+    with open(part_path, "wb") as f:
+        f.write(DATA[:half])
+        f.truncate(len(DATA))
+    with open(part_path + ".json", "w") as f:
+        json.dump({"url": url, "size": len(DATA), "validator": '"v1"', "segments": [[0, len(DATA) - 1, half]]}, f)
+    RangeHandler.served.clear()
+    assert manager.download(url, dest, staging_dir=staging) == dest
+    server.shutdown()
+    with open(dest, "rb") as f:
+        assert f.read() == DATA
+    assert sum(RangeHandler.served) == 1 + len(DATA) - half
+
+
+def test_checksum_mismatch():
+    server, url = _serve()
+    dest = os.path.join(tempfile.mkdtemp(), "model.safetensors")
+    staging = tempfile.mkdtemp()
+    assert _manager().download(url, dest, staging_dir=staging, sha256="0" * 64) is None
+    server.shutdown()
+    assert not os.path.exists(dest)
+    assert os.listdir(staging) == []
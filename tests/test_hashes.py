@@ -0,0 +1,29 @@
+import hashlib
+import os
+import tempfile
+
+from core.handlers import hashes
+
+
+def test_hash_file(write_file):
+    file_path = os.path.join(tempfile.mkdtemp(), "model.bin")
+    data = os.urandom(3 * hashes.CHUNK_SIZE + 17)
+    write_file(file_path, data)
+    assert hashes.hash_file(file_path) == hashlib.sha256(data).hexdigest()
+
+
+def test_directory_hash_only_rehashes_changed_files(monkeypatch, write_file):
+    model_dir = tempfile.mkdtemp()
+    for component in ["unet", "vae", "text_encoder"]:
+        write_file(os.path.join(model_dir, component, "model.safetensors"), os.urandom(1024))
+    first_hash = hashes.hash_directory(model_dir)
+    assert hashes.get_cached_directory_hash(model_dir) == first_hash
+
+    hashed = []
+    hash_file = hashes.hash_file
+    monkeypatch.setattr(hashes, "hash_file", lambda path, throttle=0: hashed.append(path) or hash_file(path))
+    write_file(os.path.join(model_dir, "unet", "model.safetensors"), os.urandom(2048))
+    assert hashes.get_cached_directory_hash(model_dir) is None
+    second_hash = hashes.hash_directory(model_dir)
+    assert second_hash != first_hash
+    assert hashed == [os.path.join(model_dir, "unet", "model.safetensors")]
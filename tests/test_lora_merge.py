@@ -0,0 +1,119 @@
+import os
+import tempfile
+from types import SimpleNamespace
+
+import torch
+from safetensors.torch import save_file
+
+from core.handlers.model_types.lazy_safetensors import load_file
+from core.handlers.model_types.lora_weights import LoraManager, build_index
+
+device = "cuda" if torch.cuda.is_available() else "cpu"
+dtype = torch.float16 if device == "cuda" else torch.float32
+
+
+def _pipeline(layers=16, dim=320):
+    unet = torch.nn.Module()
+    unet.blocks = torch.nn.ModuleList([torch.nn.Linear(dim, dim, bias=False) for _ in range(layers)])
+    unet.conv_in = torch.nn.Conv2d(dim, dim, 3, bias=False)
+    text_encoder = torch.nn.Module()
+    text_encoder.q_proj = torch.nn.Linear(dim // 2, dim // 2, bias=False)
+    return SimpleNamespace(unet=unet.to(device, dtype), text_encoder=text_encoder.to(device, dtype))
+
+
+def _lora(pipeline, rank=8, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    tensors = {}
+    for name, (component, path) in build_index(pipeline).items():
+        weight = getattr(pipeline, component).get_submodule(path).weight
+        if len(weight.shape) == 4:
+            down_shape, up_shape = (rank, weight.shape[1], 3, 3), (weight.shape[0], rank, 1, 1)
+        else:
+            down_shape, up_shape = (rank, weight.shape[1]), (weight.shape[0], rank)
+        tensors[f"{name}.lora_down.weight"] = torch.randn(down_shape, generator=generator) * 0.01
+        tensors[f"{name}.lora_up.weight"] = torch.randn(up_shape, generator=generator) * 0.01
+    path = os.path.join(tempfile.mkdtemp(), f"lora_{seed}.safetensors")
+    save_file(tensors, path)
+    return path
+
+
+def _loop_merge(pipeline, loras):
+    # One layer at a time in float32 on the CPU, the way LoRAs were applied before
+    index = build_index(pipeline)
+    for path, alpha in loras:
+        state_dict = load_file(path)
+        for key in state_dict:
+            if "lora_down" not in key:
+                continue
+            component, module_path = index[key.split(".")[0]]
+            layer = getattr(pipeline, component).get_submodule(module_path)
+            weight_up = state_dict[key.replace("lora_down", "lora_up")].to(torch.float32)
+            weight_down = state_dict[key].to(torch.float32)
+            if len(weight_up.shape) == 4:
+                weight_up = weight_up.reshape(weight_up.shape[0], -1)
+                weight_down = weight_down.transpose(-1, -2).reshape(weight_down.shape[0], -1)
+            delta = torch.matmul(weight_up, weight_down).reshape(layer.weight.shape)
+            merged = layer.weight.data.to("cpu", torch.float32) + alpha * delta
+            layer.weight.data.copy_(merged)
+
+
+def _weights(pipeline):
+    return {f"{name}.{key}": value.clone() for name in ["unet", "text_encoder"]
+            for key, value in getattr(pipeline, name).state_dict().items()}
+
+
+def _state(weights, component):
+    prefix = f"{component}."
+    return {key[len(prefix):]: value for key, value in weights.items() if key.startswith(prefix)}
+
+
+def test_fused_merge_matches_loop():
+    pipeline = _pipeline()
+    reference = _pipeline()
+    original = _weights(pipeline)
+    reference.unet.load_state_dict(_state(original, "unet"))
+    reference.text_encoder.load_state_dict(_state(original, "text_encoder"))
+    loras = [(_lora(pipeline, seed=seed), weight) for seed, weight in [(1, 0.5), (2, 0.8), (3, 1.0)]]
+    LoraManager().set_loras(pipeline, loras)
+    _loop_merge(reference, loras)
+    merged = _weights(pipeline)
+    expected = _weights(reference)
+    for key in expected:
+        assert torch.allclose(merged[key].float(), expected[key].float(), atol=1e-3), key
+
+
+def test_reweight_and_remove():
+    manager = LoraManager()
+    pipeline = _pipeline()
+    original = _weights(pipeline)
+    lora = _lora(pipeline, seed=4)
+    manager.set_loras(pipeline, [(lora, 0.7)])
+    manager.set_loras(pipeline, [(lora, 0.9)])
+    reweighted = _weights(pipeline)
+    fresh = _pipeline()
+    fresh.unet.load_state_dict(_state(original, "unet"))
+    fresh.text_encoder.load_state_dict(_state(original, "text_encoder"))
+    manager.set_loras(fresh, [(lora, 0.9)])
+    for key, value in _weights(fresh).items():
+        assert torch.equal(reweighted[key], value), key
+    # Removing the LoRA restores the exact original weights
+    manager.set_loras(pipeline, [])
+    for key, value in _weights(pipeline).items():
+        assert torch.equal(original[key], value), key
+
+
+def test_switching_loras_matches_loop():
+    manager = LoraManager()
+    pipeline = _pipeline()
+    original = _weights(pipeline)
+    loras = [(_lora(pipeline, seed=10 + i), 0.8) for i in range(5)]
+    # Switching in place, from more LoRAs to fewer and back, must match merging from the original weights
+    for count in [1, 5, 3, 1, 0]:
+        manager.set_loras(pipeline, loras[:count])
+        reference = _pipeline()
+        reference.unet.load_state_dict(_state(original, "unet"))
+        reference.text_encoder.load_state_dict(_state(original, "text_encoder"))
+        _loop_merge(reference, loras[:count])
+        expected = _weights(reference)
+        for key, value in _weights(pipeline).items():
+            assert torch.allclose(value.float(), expected[key].float(), atol=1e-3), (count, key)
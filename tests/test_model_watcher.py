@@ -0,0 +1,47 @@
+import os
+import tempfile
+import threading
+import time
+
+from core.helpers.model_watcher import ModelWatcher
+
+
+def test_locate():
+    watcher = ModelWatcher()
+    root = os.path.join(tempfile.mkdtemp(), "models")
+    os.makedirs(os.path.join(root, "loras"))
+    watcher.register_directory(root)
+    assert watcher._locate(os.path.join(root, "loras", "style.safetensors")) == (root, "loras")
+    assert watcher._locate(os.path.join(root, "loras")) == (root, "loras")
+    # Partial downloads, files in the root itself and paths outside the roots are ignored
+    assert watcher._locate(os.path.join(root, ".downloads", "model.part")) is None
+    assert watcher._locate(os.path.join(root, "notes.txt")) is None
+    assert watcher._locate(os.path.join(tempfile.mkdtemp(), "loras", "style.safetensors")) is None
+
+
+def test_changes_are_debounced():
+    watcher = ModelWatcher(debounce=0.2)
+    processed = []
+    done = threading.Event()
+
+    def process_changes(paths):
+        processed.extend(paths)
+        if len(processed) >= 2:
+            done.set()
+
+    watcher.process_changes = process_changes
+    watcher._running = True
+    worker = threading.Thread(target=watcher._process_loop, daemon=True)
+    worker.start()
+    # A file being copied changes many times, it is only processed once it stops changing
+    for _ in range(5):
+        watcher.queue_change("/models/loras/a.safetensors")
+        time.sleep(0.05)
+    watcher.queue_change("/models/loras/b.safetensors")
+    start = time.monotonic()
+    assert done.wait(2)
+    assert time.monotonic() - start >= 0.15
+    watcher._running = False
+    watcher._wake.set()
+    worker.join(2)
+    assert sorted(processed) == ["/models/loras/a.safetensors", "/models/loras/b.safetensors"]
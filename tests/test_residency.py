@@ -0,0 +1,131 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from core.handlers.models import ModelManager
+from core.handlers.residency import ComponentCache, ModelResidency, ResidencyKey
+
+
+def _key(identity, loras=()):
+    return ResidencyKey("diffusers", identity, "auto", None, loras, ())
+
+
+def _pipeline(unet=None):
+    unet = unet or torch.nn.Linear(8, 8)
+    text_encoder = torch.nn.Linear(8, 8)
+    return SimpleNamespace(components={"unet": unet, "text_encoder": text_encoder}, unet=unet,
+                           text_encoder=text_encoder)
+
+
+@pytest.fixture
+def residency():
+    residency = ModelResidency()
+    residency._models.clear()
+    residency._loading.clear()
+    residency.max_models = 2
+    residency.vram_budget = 0
+    residency.ram_budget = 0
+    return residency
+
+
+def test_evicts_least_recently_used(residency):
+    residency.put(_key("a"), _pipeline())
+    residency.put(_key("b"), _pipeline())
+    time.sleep(0.01)
+    residency.get(_key("a"))
+    residency.put(_key("c"), _pipeline())
+    assert residency.keys() == [_key("a"), _key("c")]
+
+
+def test_borrowed_and_pinned_models_stay(residency):
+    residency.put(_key("a"), _pipeline(), owner="user")
+    model = _pipeline()
+    residency.put(_key("b"), model, pin=True)
+    residency.put(_key("c"), _pipeline())
+    residency.put(_key("d"), _pipeline())
+    assert set(residency.keys()) == {_key("a"), _key("b"), _key("d")}
+    # Released and finished, so they can go
+    residency.release(_key("a"), "user")
+    residency.unpin(model)
+    residency.enforce(keep=[_key("d")])
+    assert len(residency.keys()) == 2 and _key("d") in residency.keys()
+
+
+def test_pins_are_counted_per_job(residency):
+    model = _pipeline()
+    residency.put(_key("a"), model, owner="user", pin=True)
+    assert residency.acquire(_key("a"), "user", pin=True) is model
+    # The handler switched to another model, but both jobs are still running
+    residency.release(_key("a"), "user")
+    residency.unpin(model)
+    assert residency.detach(lambda k: True) is None
+    residency.unpin(model)
+    assert residency.detach(lambda k: True) is model
+    assert residency.keys() == []
+
+
+def test_detach_keeps_shared_components(residency):
+    base = _pipeline()
+    # Built from the same UNet, e.g. a ControlNet pipeline
+    residency.put(_key("a"), base)
+    residency.put(_key("a", loras=(("lora", 0.9),)), _pipeline(unet=base.unet))
+    assert residency.detach(lambda k: k == _key("a"), components=["unet"]) is None
+    assert residency.detach(lambda k: k == _key("a"), components=["text_encoder"]) is base
+
+
+def test_component_cache_lru():
+    cache = ComponentCache()
+    cache._components.clear()
+    cache.max_components = 2
+    loaded = []
+
+    def loader(name):
+        loaded.append(name)
+        return torch.nn.Linear(4, 4)
+
+    vae = cache.get("vae", "a", lambda: loader("a"))
+    cache.get("vae", "b", lambda: loader("b"))
+    assert cache.get("vae", "a", lambda: loader("a")) is vae
+    cache.get("vae", "c", lambda: loader("c"))
+    assert cache.get("vae", "b") is None
+    assert cache.holds(vae) and loaded == ["a", "b", "c"]
+
+
+class Owner:
+    def __init__(self, footprint, gpu):
+        self.size = footprint
+        self.gpu = gpu
+        self.offloaded = False
+
+    def to_cpu(self):
+        self.offloaded = True
+        self.gpu["free"] += self.size
+
+    def to_gpu(self):
+        pass
+
+    def footprint(self):
+        return 0 if self.offloaded else self.size
+
+
+def test_request_offloads_least_recently_used(monkeypatch):
+    gpu = {"free": 1}
+    monkeypatch.setattr(torch.cuda, "is_available", lambda: True)
+    monkeypatch.setattr(torch.cuda, "empty_cache", lambda: None)
+    monkeypatch.setattr(ModelManager, "_free", staticmethod(lambda: gpu["free"]))
+    manager = ModelManager()
+    manager._registrants = []
+    manager.margin = 0
+    owners = [Owner(4, gpu) for _ in range(4)]
+    for owner in owners:
+        manager.register(owner.to_cpu, owner.to_gpu, owner.footprint)
+    for owner in [owners[2], owners[0], owners[1], owners[3]]:
+        time.sleep(0.01)
+        manager.used(owner)
+    # The job's own models are never offloaded, the others go least recently used first
+    assert manager.request(4, owner=owners[2])
+    assert [owner.offloaded for owner in owners] == [True, False, False, False]
+    assert manager.request(12, owner=owners[2])
+    assert [owner.offloaded for owner in owners] == [True, True, False, True]
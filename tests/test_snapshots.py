@@ -0,0 +1,43 @@
+import os
+import tempfile
+
+import torch
+
+from core.dataclasses.model_data import ModelData
+from core.handlers.snapshots import PipelineSnapshots, SNAPSHOT_EXTENSION, snapshot_key
+
+
+def test_snapshot_key_follows_model_file(write_file):
+    model_path = write_file(os.path.join(tempfile.mkdtemp(), "model.safetensors"), os.urandom(1024))
+    lora_path = write_file(os.path.join(tempfile.mkdtemp(), "lora.safetensors"), os.urandom(256))
+    model_data = ModelData(model_path)
+    model_data.data = {"loras": [{"path": lora_path}], "lora_weight": 0.8}
+    key = snapshot_key(model_data, torch.float16)
+    assert key and key == snapshot_key(model_data, torch.float16)
+    # The full hash replacing the quick hash doesn't orphan the snapshot
+    model_data.hash = "f" * 64
+    assert snapshot_key(model_data, torch.float16) == key
+    assert snapshot_key(model_data, torch.float32) != key
+    model_data.data["lora_weight"] = 0.5
+    assert snapshot_key(model_data, torch.float16) != key
+    model_data.data["lora_weight"] = 0.8
+    # Replaced by a different file with the same name
+    write_file(model_path, os.urandom(2048))
+    assert snapshot_key(model_data, torch.float16) != key
+    assert snapshot_key(ModelData("https://example.com/model.safetensors"), torch.float16) == ""
+
+
+def test_make_room_removes_least_recently_used(write_file):
+    snapshots = PipelineSnapshots()
+    snapshots.snapshot_dir = tempfile.mkdtemp()
+    snapshots.quota = 300
+    paths = []
+    for i in range(3):
+        path = write_file(os.path.join(snapshots.snapshot_dir, f"{i}{SNAPSHOT_EXTENSION}"), b"0" * 100)
+        # The modification time is the last use
+        os.utime(path, (1000 + i, 1000 + i))
+        paths.append(path)
+    assert not snapshots._make_room(400)
+    assert snapshots._make_room(150)
+    assert [os.path.exists(path) for path in paths] == [False, False, True]
+    assert snapshots.get_stats() == {"snapshots": 1, "used": 100, "quota": 300}